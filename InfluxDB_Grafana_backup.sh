@@ -12,10 +12,9 @@ sudo mount -t cifs -o username=RPi_backup,password=<YOURPASSWORD>,vers=3.0 //<NA
 
 # backup InfluxDB
 echo '----- backup InfluxDB' >> /home/pi/InfluxDB_Grafana_backup.log
-influxd backup -portable /home/pi/backups/influxdb/ >> /home/pi/InfluxDB_Grafana_backup.log
-rm /home/pi/backups/influxdb/InfluxDB_backup.zip >> /home/pi/InfluxDB_Grafana_backup.log
-zip -r -m /home/pi/backups/influxdb/InfluxDB_backup.zip /home/pi/backups/influxdb/* >> /home/pi/InfluxDB_Grafana_backup.log
-sudo cp /home/pi/backups/influxdb/InfluxDB_backup.zip /mnt/Synology/backups/influxdb/InfluxDB_backup_$(date +%Y-%m-%d_%H-%M-%S).zip >> /home/pi/InfluxDB_Grafana_backup.log
+# incremental, only the points written since the last backup, see backup.py
+cd /home/pi/particulate-matter-monitor
+python3 backup.py -c airmonitor_config.yml --target /mnt/Synology/backups/influxdb/ >> /home/pi/InfluxDB_Grafana_backup.log 2>&1
 
 # backup Grafana
 echo '----- backup Grafana' >> /home/pi/InfluxDB_Grafana_backup.log
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive sampling of a sensor driven by the variability of its readings:
+while PM2.5 or PM10 scatter or change quickly, e.g. from cooking smoke, the
+sensor is sampled at the fast interval; while the readings are stable it
+steps back to the normal and then to the sparse interval. Whenever the gap
+between two samples is long enough, the sensor is stopped in between, so
+the SPS30 fan only runs for the warm-up before each sample.
+
+The current interval, the state of the sensor and the mode changes are
+exposed as metrics.
+"""
+
+import collections
+import logging
+import math
+import time
+
+import metrics
+
+my_logger = logging.getLogger('MyLogger.sensor')
+
+PM_FIELDS = ('mass_concentration_PM2_5', 'mass_concentration_PM10')
+MODES = ('fast', 'normal', 'sparse')
+DEFAULT_INTERVALS = {'fast': 5, 'normal': 60, 'sparse': 600}
+SETTINGS = ('intervals', 'fields', 'window', 'stddev', 'rate', 'hysteresis',
+            'calm_samples', 'min_off')
+
+
+class AdaptivePolicy:
+    """
+    Choose the sampling mode from the readings. A reading is active when a
+    field's standard deviation over the window or its rate of change exceeds
+    its threshold, and calm when both stay below hysteresis times the
+    thresholds. An active reading switches to fast mode at once, every
+    calm_samples calm readings in a row step one mode slower.
+    """
+
+    def __init__(self, intervals=None, fields=PM_FIELDS, window=300,
+                 stddev=3.0, rate=5.0, hysteresis=0.5, calm_samples=5):
+        """
+        :param intervals: dictionary of seconds between samples per mode,
+        fast, normal and sparse
+        :param fields: fields watched for changes
+        :param window: seconds of readings for the standard deviation and
+        the rate of change
+        :param stddev: standard deviation threshold, in field units
+        :param rate: rate of change threshold, in field units per minute
+        :param hysteresis: fraction of the thresholds below which a reading
+        counts as calm
+        :param calm_samples: calm readings before stepping one mode slower
+        """
+        intervals = dict(DEFAULT_INTERVALS, **(intervals or {}))
+        if set(intervals) != set(MODES):
+            raise ValueError('adaptive intervals must be given for {}'.format(
+                ', '.join(MODES)))
+        if not intervals['fast'] <= intervals['normal'] <= intervals['sparse']:
+            raise ValueError('adaptive intervals must not decrease from fast '
+                             'over normal to sparse')
+        if intervals['fast'] <= 0 or calm_samples < 1:
+            raise ValueError('adaptive intervals and calm_samples must be '
+                             'positive')
+        self.intervals = intervals
+        self.fields = tuple(fields)
+        self.window = window
+        self.stddev = stddev
+        self.rate = rate
+        self.hysteresis = hysteresis
+        self.calm_samples = calm_samples
+        self.mode = 'normal'
+        self.calm = 0
+        self.readings = collections.deque()  # (seconds, values)
+
+    @property
+    def interval(self):
+        """ seconds until the next sample in the current mode """
+        return self.intervals[self.mode]
+
+    def statistics(self):
+        """
+        :return: dictionary of (standard deviation, rate of change per
+        minute) per field, None where there are too few readings
+        """
+        result = {}
+        for idx, field in enumerate(self.fields):
+            series = [(seconds, values[idx]) for seconds, values in self.readings
+                      if values[idx] is not None]
+            stddev = rate = None
+            if len(series) >= 3:
+                mean = sum(value for _, value in series) / len(series)
+                stddev = math.sqrt(sum((value - mean) ** 2
+                                       for _, value in series)
+                                   / (len(series) - 1))
+            if len(series) >= 2 and series[-1][0] > series[0][0]:
+                rate = abs(series[-1][1] - series[0][1]) * 60 \
+                    / (series[-1][0] - series[0][0])
+            result[field] = (stddev, rate)
+        return result
+
+    def update(self, fields, seconds):
+        """
+        Add a reading and choose the mode for the next sample.
+
+        :param fields: dictionary of field values
+        :param seconds: monotonic time of the reading in seconds
+        :return: the mode
+        """
+        values = []
+        for field in self.fields:
+            value = fields.get(field)
+            values.append(None if value is None or value != value else value)
+        self.readings.append((seconds, values))
+        # keep the readings of the window, but at least the previous one for
+        # the rate of change after a sparse interval
+        while len(self.readings) > 2 and \
+                seconds - self.readings[0][0] > self.window:
+            self.readings.popleft()
+        active = calm = False
+        statistics = self.statistics()
+        if any(value is not None for value in values):
+            active = any(
+                (stddev is not None and stddev > self.stddev)
+                or (rate is not None and rate > self.rate)
+                for stddev, rate in statistics.values())
+            calm = all(
+                (stddev is None or stddev < self.stddev * self.hysteresis)
+                and (rate is None or rate < self.rate * self.hysteresis)
+                for stddev, rate in statistics.values())
+        if active:
+            self.calm = 0
+            self.mode = 'fast'
+        elif calm:
+            self.calm += 1
+            if self.calm >= self.calm_samples and self.mode != MODES[-1]:
+                self.calm = 0
+                self.mode = MODES[MODES.index(self.mode) + 1]
+        else:
+            self.calm = 0
+        return self.mode
+
+
+class AdaptiveDriver:
+    """
+    SensorDriver wrapper sampling the wrapped driver on the schedule of an
+    AdaptivePolicy, see schedule(). The sensor is stopped between samples
+    that are at least min_off seconds plus its warm-up apart.
+    """
+
+    def __init__(self, driver, policy, min_off=120, clock=time.monotonic,
+                 retry_delay=5, max_retry_delay=300):
+        """
+        :param driver: SensorDriver instance, e.g. SPS30Driver
+        :param policy: AdaptivePolicy instance
+        :param min_off: min. seconds the sensor is stopped between samples,
+        shorter gaps keep it measuring
+        :param clock: monotonic clock function
+        :param retry_delay: seconds before the first retry of a failed
+        restart, doubled on every further failure
+        :param max_retry_delay: max. seconds between restart retries
+        """
+        self.driver = driver
+        self.policy = policy
+        self.min_off = min_off
+        self.clock = clock
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.name = driver.name
+        self.measurement = driver.measurement
+        self.tags = driver.tags
+        self.warm_up = driver.warm_up
+        self.measuring = False
+        self.mode = None
+        self.set_mode(policy.mode)
+
+    @property
+    def interval(self):
+        return self.policy.interval
+
+    def set_mode(self, mode):
+        if mode != self.mode:
+            if self.mode is not None:
+                my_logger.info('{} switches to {} sampling every {} '
+                               'seconds'.format(self.name, mode,
+                                                self.policy.interval))
+                metrics.SAMPLING_MODE_CHANGES.labels(self.name, mode).inc()
+            self.mode = mode
+            metrics.SAMPLING_INTERVAL.labels(self.name).set(
+                self.policy.interval)
+
+    def start(self):
+        self.driver.start()
+        self.measuring = True
+        metrics.SENSOR_MEASURING.labels(self.name).set(1)
+
+    def read(self):
+        fields = self.driver.read()
+        if fields:
+            self.set_mode(self.policy.update(fields, self.clock()))
+        return fields
+
+    def restart(self, stop_event):
+        """
+        Start the sensor after an off period, with retry as in
+        SensorScheduler.start until it started or stop_event is set.
+
+        :return: True if the sensor started
+        """
+        delay = self.retry_delay
+        while not stop_event.is_set():
+            try:
+                self.start()
+                return True
+            except Exception:
+                my_logger.exception('restarting {} failed, retry in {} '
+                                    'seconds'.format(self.name, delay))
+                metrics.SAMPLE_FAILURES.labels(self.name).inc()
+            stop_event.wait(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+        return False
+
+    def stop(self):
+        if self.measuring:
+            self.driver.stop()
+            self.measuring = False
+            metrics.SENSOR_MEASURING.labels(self.name).set(0)
+
+    def close(self):
+        self.driver.close()
+
+    def schedule(self, stop_event):
+        """
+        Yield the tick times of a fixed rate schedule with the interval of
+        the current mode until stop_event is set. Like fixed_rate_schedule,
+        ticks missed because a cycle overran are skipped. The sensor is
+        stopped between ticks that leave it off for at least min_off seconds
+        and started again warm_up seconds before the next tick.
+        """
+        next_tick = self.clock()
+        while not stop_event.is_set():
+            yield next_tick
+            interval = self.policy.interval
+            next_tick += interval
+            now = self.clock()
+            if now > next_tick:
+                missed = int((now - next_tick) // interval) + 1
+                my_logger.warning('sample cycle overran, skipping {} '
+                                  'tick(s)'.format(missed))
+                next_tick += missed * interval
+            if next_tick - now >= self.warm_up + self.min_off:
+                self.stop()
+                stop_event.wait(next_tick - self.warm_up - now)
+                if not self.restart(stop_event):
+                    break
+                now = self.clock()
+            stop_event.wait(next_tick - now)
+
+
+def make_adaptive(driver, settings):
+    """
+    :param driver: SensorDriver instance
+    :param settings: dictionary of AdaptivePolicy arguments and min_off,
+    interval normal defaults to the interval of the driver
+    :return: AdaptiveDriver wrapping the driver
+    """
+    for key in settings:
+        if key not in SETTINGS:
+            raise ValueError('unknown adaptive setting \'{}\', expected one '
+                             'of {}'.format(key, ', '.join(SETTINGS)))
+    policy_settings = {key: value for key, value in settings.items()
+                       if key != 'min_off'}
+    policy_settings['intervals'] = dict({'normal': driver.interval},
+                                        **settings.get('intervals', {}))
+    return AdaptiveDriver(driver, AdaptivePolicy(**policy_settings),
+                          min_off=settings.get('min_off', 120))
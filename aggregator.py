@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fixed-capacity ring buffer of sensor samples with rolling statistics, and an
+aggregator that turns a stream of sample points into one aggregate point per
+measurement and time window.
+"""
+
+import logging
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from sensors import make_point
+
+my_logger = logging.getLogger('MyLogger')
+
+STATISTICS = ('mean', 'median', 'min', 'max', 'stddev', 'p95')
+
+
+class SampleRing:
+    """
+    Ring buffer of the last capacity samples, one column per field.
+
+    Running sums make mean and standard deviation O(1) per sample; median,
+    min and max are computed over the buffer with NumPy on request. Missing
+    values are stored as NaN and ignored by all statistics.
+    """
+
+    def __init__(self, fields, capacity):
+        """
+        :param fields: field names, in column order
+        :param capacity: max. number of samples kept
+        """
+        self.fields = tuple(fields)
+        self.columns = {field: col for col, field in enumerate(self.fields)}
+        self.capacity = capacity
+        self.values = np.full((capacity, len(self.fields)), np.nan)
+        self.clear()
+
+    def clear(self):
+        self.values.fill(np.nan)
+        self.pos = 0
+        self.size = 0
+        self.appends = 0
+        self.counts = np.zeros(len(self.fields))
+        self.sums = np.zeros(len(self.fields))
+        self.squares = np.zeros(len(self.fields))
+
+    def __len__(self):
+        return self.size
+
+    def append(self, sample):
+        """
+        :param sample: dictionary of field values, missing fields or None
+        values count as missing
+        """
+        row = np.full(len(self.fields), np.nan)
+        for field, value in sample.items():
+            col = self.columns.get(field)
+            if col is not None and value is not None:
+                row[col] = value
+        if self.size == self.capacity:
+            self.update_sums(self.values[self.pos], -1)
+        else:
+            self.size += 1
+        self.values[self.pos] = row
+        self.update_sums(row, 1)
+        self.pos = (self.pos + 1) % self.capacity
+        self.appends += 1
+        if self.appends % self.capacity == 0:
+            self.recompute_sums()  # keep float rounding from accumulating
+
+    def update_sums(self, row, sign):
+        valid = ~np.isnan(row)
+        values = np.where(valid, row, 0.0)
+        self.counts += sign * valid
+        self.sums += sign * values
+        self.squares += sign * values * values
+
+    def recompute_sums(self):
+        filled = self.filled()
+        valid = ~np.isnan(filled)
+        values = np.where(valid, filled, 0.0)
+        self.counts = valid.sum(axis=0).astype(float)
+        self.sums = values.sum(axis=0)
+        self.squares = (values * values).sum(axis=0)
+
+    def filled(self):
+        """ the stored samples, oldest first """
+        if self.size < self.capacity:
+            return self.values[:self.size]
+        return np.roll(self.values, -self.pos, axis=0)
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts
+
+    def stddev(self):
+        """ sample standard deviation """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sums / self.counts
+            variance = (self.squares - self.counts * mean * mean) / (self.counts - 1)
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def median(self):
+        return self.reduce(np.nanmedian)
+
+    def min(self):
+        return self.reduce(np.nanmin)
+
+    def max(self):
+        return self.reduce(np.nanmax)
+
+    def p95(self):
+        """ 95th percentile """
+        return self.reduce(lambda values, axis: np.nanpercentile(values, 95,
+                                                                 axis=axis))
+
+    def reduce(self, func):
+        if self.size == 0:
+            return np.full(len(self.fields), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN fields
+            return func(self.values[:self.size], axis=0)
+
+    def statistic(self, name):
+        return getattr(self, name)()
+
+
+class Aggregator:
+    """
+    Collect sample points per series, i.e. measurement and tags, and pass one
+    aggregate point per series and window to the output function.
+
+    The primary statistic is written under the plain field name, so the
+    aggregate points replace the sample points one to one, the other
+    statistics as <field>_<statistic>. Can be used as output function of
+    SensorScheduler.
+    """
+
+    def __init__(self, output, window=60, statistics=('mean',),
+                 primary='mean', capacity=3600, clock=time.monotonic):
+        """
+        :param output: function called with a list of aggregate points
+        :param window: seconds per aggregate point
+        :param statistics: statistics to write, see STATISTICS
+        :param primary: statistic written under the plain field name
+        :param capacity: max. samples per series and window
+        :param clock: monotonic clock function
+        """
+        for name in tuple(statistics) + (primary,):
+            if name not in STATISTICS:
+                raise ValueError('unknown statistic \'{}\', expected one of '
+                                 '{}'.format(name, ', '.join(STATISTICS)))
+        self.output = output
+        self.window = window
+        self.statistics = tuple(statistics)
+        self.primary = primary
+        self.capacity = capacity
+        self.clock = clock
+        self.rings = {}
+        self.window_start = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, points):
+        aggregates = []
+        with self.lock:
+            now = self.clock()
+            for point in points:
+                series = (point['measurement'],
+                          tuple(sorted(point.get('tags', {}).items())))
+                ring = self.rings.get(series)
+                if ring is None:
+                    ring = SampleRing(sorted(point['fields']), self.capacity)
+                    self.rings[series] = ring
+                    self.window_start[series] = now
+                ring.append(point['fields'])
+                if now - self.window_start[series] >= self.window:
+                    aggregates.append(self.aggregate(series))
+                    self.window_start[series] = now
+        aggregates = [point for point in aggregates if point['fields']]
+        if aggregates:
+            self.output(aggregates)
+
+    def aggregate(self, series):
+        """ build the aggregate point and start a new window """
+        measurement, tags = series
+        ring = self.rings[series]
+        fields = {}
+        names = self.statistics
+        if self.primary not in names:
+            names = (self.primary,) + names
+        for name in names:
+            suffix = '' if name == self.primary else '_' + name
+            for field, value in zip(ring.fields, ring.statistic(name)):
+                if np.isfinite(value):
+                    fields[field + suffix] = float(value)
+        my_logger.info('aggregated {} samples of measurement \'{}\''.format(
+            len(ring), measurement))
+        ring.clear()
+        return make_point(measurement, fields, tags=dict(tags))
+
+    def flush(self):
+        """ emit the aggregates of all started windows """
+        with self.lock:
+            aggregates = [self.aggregate(series)
+                          for series, ring in self.rings.items()
+                          if len(ring)]
+        aggregates = [point for point in aggregates if point['fields']]
+        if aggregates:
+            self.output(aggregates)
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Backfill of measurements the database missed, e.g. while it was down, from
+the SPS30 response frames in airmonitor.log and from spool files.
+
+    python backfill.py -c airmonitor_config.yml --log airmonitor.log.1 airmonitor.log
+    python backfill.py -c airmonitor_config.yml --spool airmonitor_spool.jsonl
+
+The Read Measured Values frames are decoded with the SHDLC codec, in any of
+the formats the log has used: a list of hex strings, space separated hex
+values, or the hex string of the trace channel. The frames of a sample are
+averaged to one point per serial device, stamped with the log time of the
+last frame and tagged with the serial number of the sensor as by the
+daemon, taken from the device information responses in the log or from
+the device cache. Points
+close to a point already in the database are skipped, the others are
+written in large batches. The files are streamed, so memory use does not
+depend on their size; gzip-compressed files are read as well.
+"""
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import zoneinfo
+
+import numpy as np
+
+from cleaner import open_clients, query_range
+from dbwriter import group_by_policy
+from devicecache import DeviceCache
+from localstore import to_ns
+from pmmonitor import MEASURED_VALUES_FIELDS, MEASURED_VALUES_STRUCTS, \
+    MISOFrameError, OUTPUT_FORMAT_FLOAT, OUTPUT_FORMAT_INTEGER, \
+    decode_measured_values, decode_miso_frame, unstuff_bytes
+
+my_logger = logging.getLogger('MyLogger.database')
+
+MARKER = b' frame'  # received MISO frame or sending MOSI frame
+# the device is logged since the daemon reads several sensors
+LINE_PATTERN = re.compile(rb'(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) '
+                          rb'.*?(received MISO|sending MOSI) frame'
+                          rb'(?: (?:from|to) (\S+))?: (.*)')
+RECEIVED = b'received MISO'
+HEX_BYTE = re.compile(rb'0[xX]([0-9a-fA-F]{1,2})\b')
+READ_MEASURED_VALUES = 0x03
+DEVICE_INFORMATION = 0xd0
+SERIAL_NUMBER = 0x03  # device information subcommand
+# payload length: output format
+PAYLOAD_FORMATS = {
+    MEASURED_VALUES_STRUCTS[OUTPUT_FORMAT_FLOAT].size: OUTPUT_FORMAT_FLOAT,
+    MEASURED_VALUES_STRUCTS[OUTPUT_FORMAT_INTEGER].size: OUTPUT_FORMAT_INTEGER,
+}
+MERGE_SECONDS = 10  # the readings of one sample are taken within this time
+TOLERANCE_SECONDS = 30  # a point this close to a stored point is a duplicate
+BATCH_SIZE = 5000
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Write the measurements '
+                                                 'from log and spool files to '
+                                                 'the database.')
+    parser.add_argument('-c', '--config', type=str,
+                        default='airmonitor_config.yml',
+                        help='configuration file')
+    parser.add_argument('--log', type=str, nargs='*', default=[],
+                        help='log files, oldest first, e.g. airmonitor.log.1 '
+                             'airmonitor.log')
+    parser.add_argument('--spool', type=str, nargs='*', default=[],
+                        help='spool files of unsent batches')
+    parser.add_argument('--timezone', type=str, default=None,
+                        help='time zone of the log times, e.g. Europe/Berlin, '
+                             'default: the local time zone')
+    parser.add_argument('--tag', type=str, action='append', default=[],
+                        help='tag of the points from the log, e.g. '
+                             'serial_number=ABC123')
+    parser.add_argument('--devices', type=str, default=None,
+                        help='device cache of the daemon with the serial '
+                             'numbers of the sensors, default: the cache of '
+                             'the configuration')
+    parser.add_argument('--merge-seconds', type=float, default=MERGE_SECONDS,
+                        help='frames within this time are averaged to one '
+                             'point, 0 writes every frame')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE_SECONDS,
+                        help='seconds to a stored point within which a point '
+                             'is skipped as duplicate')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='points per write request')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='decode and count, but do not write')
+    return parser.parse_args()
+
+
+def read_configuration(args):
+    """
+    Read the configuration file.
+
+    :param args: command line arguments submitted with the start of the script
+    :return: configuration dictionary
+    """
+    import yaml
+    with open(args.config, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    return cfg
+
+
+def open_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def parse_frame(text):
+    """
+    :param text: logged frame, e.g. "['0x7e', '0x0', ...]", "0x7e 0x0 ..."
+    or "7e00..."
+    :return: the frame as bytes, None if unreadable
+    """
+    if b'0x' in text or b'0X' in text:
+        return bytes(int(value, 16) for value in HEX_BYTE.findall(text))
+    try:
+        return bytes.fromhex(text.strip().decode('ascii'))
+    except ValueError:
+        return None
+
+
+def decode_measurement(frame):
+    """
+    :return: tuple of the measured values of a valid Read Measured Values
+    response, None for any other frame
+    """
+    if len(frame) < 3 or frame[2] != READ_MEASURED_VALUES:
+        return None
+    try:
+        state, payload = decode_miso_frame(frame, READ_MEASURED_VALUES)
+    except MISOFrameError:
+        return None
+    output_format = PAYLOAD_FORMATS.get(len(payload))
+    if state != 0x00 or output_format is None:
+        return None
+    return tuple(decode_measured_values(payload, output_format))
+
+
+def requests_serial_number(frame):
+    """ :return: True for a MOSI frame asking for the serial number """
+    frame = unstuff_bytes(frame)
+    return len(frame) > 4 and frame[2] == DEVICE_INFORMATION \
+        and frame[4] == SERIAL_NUMBER
+
+
+def decode_serial_number(frame):
+    """
+    :return: the serial number of a valid device information response,
+    None for any other frame
+    """
+    if len(frame) < 3 or frame[2] != DEVICE_INFORMATION:
+        return None
+    try:
+        state, payload = decode_miso_frame(frame, DEVICE_INFORMATION)
+    except MISOFrameError:
+        return None
+    if state != 0x00 or not payload:
+        return None
+    return payload.rstrip(b'\x00').decode('ascii', 'replace')
+
+
+def cached_serial_numbers(path):
+    """
+    :param path: device cache file of the daemon, see DeviceCache
+    :return: dictionary of the serial number per serial device, whatever
+    the age of the cached values
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    serial_numbers = {}
+    for device, entries in DeviceCache(path).entries.items():
+        info = entries.get('device_information', {}).get('value') or {}
+        if info.get('serial_number'):
+            serial_numbers[device] = info['serial_number']
+    return serial_numbers
+
+
+class LogTime:
+    """
+    Convert the local log times to UTC in ns, with the UTC offset looked up
+    once per hour of log time.
+    """
+
+    def __init__(self, timezone=None):
+        """
+        :param timezone: time zone name, the local time zone if None
+        """
+        self.timezone = zoneinfo.ZoneInfo(timezone) if timezone else None
+        self.hour = None
+        self.hour_ns = 0
+
+    def __call__(self, match):
+        hour = match.group(1, 2, 3, 4)
+        if hour != self.hour:
+            local = datetime.datetime(*(int(value) for value in hour))
+            if self.timezone is None:
+                local = local.astimezone()
+            else:
+                local = local.replace(tzinfo=self.timezone)
+            self.hour = hour
+            self.hour_ns = int(local.timestamp()) * 10 ** 9
+        return self.hour_ns + (int(match.group(5)) * 60 + int(match.group(6))) \
+            * 10 ** 9 + int(match.group(7)) * 10 ** 6
+
+
+def iter_log_points(paths, measurement, tags=None, timezone=None,
+                    merge_seconds=MERGE_SECONDS, stats=None,
+                    serial_numbers=None):
+    """
+    Stream the points of the measured values frames in the log files.
+
+    :param paths: log files, oldest first
+    :param measurement: measurement name of the points
+    :param tags: dictionary of tag values of the points
+    :param timezone: time zone name of the log times, local if None
+    :param merge_seconds: frames of a device within this time of the first
+    frame of a sample are averaged to one point
+    :param stats: dictionary counting lines, frames and skipped frames
+    :param serial_numbers: dictionary of the serial number per serial
+    device, e.g. from cached_serial_numbers(), for the sensors whose device
+    information the log does not show
+    :return: generator of points with time in ns
+    """
+    stats = {} if stats is None else stats
+    for key in ('lines', 'frames', 'skipped'):
+        stats.setdefault(key, 0)
+    log_time = LogTime(timezone)
+    merge_ns = int(merge_seconds * 10 ** 9)
+    serial_numbers = dict(serial_numbers or {})
+    requested = set()  # devices asked for their serial number
+    samples = {}  # device, None for logs without: (first time, readings)
+    for path in paths:
+        lines = 0
+        with open_file(path) as log_file:
+            for line in log_file:
+                lines += 1
+                if MARKER not in line:
+                    continue
+                match = LINE_PATTERN.match(line)
+                if match is None and RECEIVED not in line:
+                    continue  # neither a MISO frame nor a readable request
+                frame = parse_frame(match.group(10)) if match else None
+                device = match.group(9) if match else None
+                device = device.decode('utf-8', 'replace') if device else None
+                if match and match.group(8) != RECEIVED:
+                    if frame and requests_serial_number(frame):
+                        requested.add(device)
+                    continue
+                if frame and device in requested:
+                    serial_number = decode_serial_number(frame)
+                    if serial_number:
+                        serial_numbers[device] = serial_number
+                        requested.discard(device)
+                values = decode_measurement(frame) if frame else None
+                if values is None:
+                    stats['skipped'] += 1
+                    continue
+                stats['frames'] += 1
+                timestamp = log_time(match)
+                first, sample = samples.get(device, (timestamp, []))
+                if sample and timestamp - first > merge_ns:
+                    yield make_log_point(measurement, tags, sample,
+                                         serial_numbers.get(device))
+                    first, sample = timestamp, []
+                sample.append((timestamp, values))
+                samples[device] = (first, sample)
+        stats['lines'] += lines
+        my_logger.info('read {} lines of {}'.format(lines, path))
+    for device, (first, sample) in samples.items():
+        yield make_log_point(measurement, tags, sample,
+                             serial_numbers.get(device))
+
+
+def make_log_point(measurement, tags, sample, serial_number=None):
+    """
+    average the readings of a sample, stamped with the last reading and
+    tagged with the serial number unless tags have one, as by SPS30Driver
+    """
+    count = len(sample)
+    fields = dict(zip(MEASURED_VALUES_FIELDS,
+                      [sum(values) / count
+                       for values in zip(*(values for _, values in sample))]))
+    point = {'measurement': measurement, 'time': sample[-1][0],
+             'fields': fields}
+    tags = dict(tags or {})
+    if serial_number and 'serial_number' not in tags:
+        tags['serial_number'] = serial_number
+    if tags:
+        point['tags'] = tags
+    return point
+
+
+def iter_spool_points(paths, stats=None):
+    """
+    Stream the points of spool files, see dbwriter.Spool.
+
+    :return: generator of points with time in ns, rollup points keep their
+    retention policy
+    """
+    stats = {} if stats is None else stats
+    stats.setdefault('skipped', 0)
+    for path in paths:
+        with open_file(path) as spool_file:
+            for line in spool_file:
+                try:
+                    points = json.loads(line)
+                except ValueError:
+                    stats['skipped'] += 1
+                    continue
+                for point in points:
+                    point['time'] = to_ns(point['time'])
+                    yield point
+
+
+def drop_existing(client, points, tolerance_ns):
+    """
+    :param client: InfluxDBClient or LocalStore instance
+    :param points: points with time in ns
+    :param tolerance_ns: max. distance to a stored point of a duplicate
+    :return: the points without a stored point of the same series, i.e.
+    retention policy, measurement and tags, within tolerance_ns
+    """
+    by_series = {}
+    for point in points:
+        series = (point.get('retention_policy'), point['measurement'],
+                  tuple(sorted((point.get('tags') or {}).items())))
+        by_series.setdefault(series, []).append(point)
+    new_points = []
+    for (policy, measurement, tags), group in by_series.items():
+        times = np.array([point['time'] for point in group], dtype=np.int64)
+        rows = query_range(client, measurement, int(times.min()) - tolerance_ns,
+                           int(times.max()) + tolerance_ns + 1,
+                           tags=dict(tags), retention_policy=policy)
+        if rows.empty:
+            new_points.extend(group)
+            continue
+        stored = np.sort(rows['time'].to_numpy(dtype=np.int64))
+        pos = np.searchsorted(stored, times)
+        after = stored[np.minimum(pos, len(stored) - 1)]
+        before = stored[np.maximum(pos - 1, 0)]
+        distance = np.minimum(np.abs(after - times), np.abs(times - before))
+        new_points.extend(point for point, duplicate
+                          in zip(group, distance <= tolerance_ns)
+                          if not duplicate)
+    return new_points
+
+
+def backfill(client, points, batch_size=BATCH_SIZE,
+             tolerance=TOLERANCE_SECONDS, dry_run=False, stats=None):
+    """
+    Write the points missing in the database, batch by batch.
+
+    :param client: InfluxDBClient or LocalStore instance
+    :param points: iterable of points with time in ns
+    :param batch_size: points per duplicate query and write request
+    :param tolerance: seconds to a stored point within which a point is
+    skipped as duplicate
+    :param dry_run: count, but do not write
+    :param stats: dictionary counting points, duplicates and written points
+    :return: stats
+    """
+    stats = {} if stats is None else stats
+    for key in ('points', 'duplicates', 'written'):
+        stats.setdefault(key, 0)
+    tolerance_ns = int(tolerance * 10 ** 9)
+
+    def write(batch):
+        stats['points'] += len(batch)
+        if dry_run:
+            return
+        new_points = drop_existing(client, batch, tolerance_ns)
+        stats['duplicates'] += len(batch) - len(new_points)
+        for policy, group in group_by_policy(new_points):
+            client.write_points(group, retention_policy=policy)
+            stats['written'] += len(group)
+        my_logger.info('backfilled {} of {} points'.format(len(new_points),
+                                                           len(batch)))
+
+    batch = []
+    for point in points:
+        batch.append(point)
+        if len(batch) >= batch_size:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+    return stats
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = read_configuration(args)
+    client = None if args.dry_run else open_clients(cfg)[0]
+    stats = {}
+    tags = dict(tag.split('=', 1) for tag in args.tag)
+    serial_numbers = cached_serial_numbers(
+        args.devices or cfg['SensirionSPS30'].get('cache',
+                                                  'airmonitor_devices.json'))
+    log_points = iter_log_points(args.log, cfg['SensirionSPS30']['measurement'],
+                                 tags, args.timezone, args.merge_seconds, stats,
+                                 serial_numbers)
+    for points in (log_points, iter_spool_points(args.spool, stats)):
+        backfill(client, points, args.batch_size, args.tolerance,
+                 args.dry_run, stats)
+    print(', '.join('{}: {}'.format(key, value)
+                    for key, value in sorted(stats.items())))
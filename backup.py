@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental backup of the measurements. Each run exports only the time
+range written since the previous backup, as gzip-compressed line protocol
+with a manifest of point counts and checksums, so a run costs time and
+space in proportion to the new data rather than the whole history.
+
+    python backup.py -c airmonitor_config.yml --target /mnt/Synology/backups/influxdb
+    python backup.py -c airmonitor_config.yml --target ... --verify
+    python backup.py -c airmonitor_config.yml --target ... --restore
+
+A backup is a directory <target>/<until>/ holding one <measurement>.lp.gz
+file per measurement with new points, <policy>.<measurement>.lp.gz for the
+rollups in their retention policies, and manifest.json, written last, so
+an interrupted run leaves no manifest and is repeated by the next run.
+Each run exports the last hour of the previous one again, and stops short
+of now by the flush interval of the writers, so points written late are
+not missed. Restore creates the rollup retention policies and continuous
+queries from the configuration and replays the backups in order into
+InfluxDB or the sqlite backend.
+"""
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from cleaner import DEFAULT_CHUNK_HOURS, NS_PER_HOUR, open_clients, \
+    query_first, query_range, to_ns
+from lineprotocol import LineEncoder, parse_line
+from localstore import LocalStore
+
+my_logger = logging.getLogger('MyLogger.database')
+
+MANIFEST = 'manifest.json'
+BACKUP_ID_FORMAT = '%Y%m%dT%H%M%SZ'
+RESTORE_BATCH_SIZE = 5000
+COMPRESS_LEVEL = 6  # level 9 costs much more CPU for a few percent
+DEFAULT_OVERLAP_HOURS = 1
+SETTLE_MARGIN = 60  # seconds on top of the flush interval of the writers
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Back up the measurements '
+                                                 'incrementally or restore '
+                                                 'them.')
+    parser.add_argument('-c', '--config', type=str,
+                        default='airmonitor_config.yml',
+                        help='configuration file')
+    parser.add_argument('--target', type=str, required=True,
+                        help='backup directory, e.g. on the mounted NAS')
+    parser.add_argument('--restore', action='store_true',
+                        help='write the backups in target to the database')
+    parser.add_argument('--verify', action='store_true',
+                        help='only check the files against the manifests')
+    parser.add_argument('--since', type=str, default=None,
+                        help='export from this time on, e.g. '
+                             '2019-11-17T00:00Z, default: where the last '
+                             'backup stopped')
+    parser.add_argument('--until', type=str, default=None,
+                        help='export up to this time, default: now less '
+                             'the flush interval of the database writer')
+    parser.add_argument('--full', action='store_true',
+                        help='ignore the previous backups and export the '
+                             'whole series')
+    parser.add_argument('--overlap-hours', type=float,
+                        default=DEFAULT_OVERLAP_HOURS,
+                        help='export this many hours before where the last '
+                             'backup stopped again, for points written late, '
+                             'e.g. from the spool')
+    parser.add_argument('--chunk-hours', type=float,
+                        default=DEFAULT_CHUNK_HOURS,
+                        help='hours of data loaded per query')
+    return parser.parse_args()
+
+
+def read_configuration(args):
+    """
+    Read the configuration file.
+
+    :param args: command line arguments submitted with the start of the script
+    :return: configuration dictionary
+    """
+    import yaml
+    with open(args.config, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    return cfg
+
+
+def frame_lines(frame, measurement):
+    """
+    :param frame: query result with a time column in ns, the text columns
+    are taken as tags, all others as fields
+    :return: generator of lines in line protocol, missing and NaN values
+    are left out
+    """
+    encoder = LineEncoder()
+    tag_columns = [column for column in frame.columns
+                   if column != 'time' and frame[column].dtype == object
+                   and frame[column].map(lambda value: value != value
+                                         or value is None
+                                         or isinstance(value, str)).all()]
+    field_columns = [column for column in frame.columns
+                     if column != 'time' and column not in tag_columns]
+    for row in frame.to_dict('records'):
+        fields = {column: row[column] for column in field_columns}
+        tags = {column: row[column] for column in tag_columns
+                if row[column] is not None and row[column] == row[column]}
+        line = encoder.line(measurement, tags, fields, int(row['time']))
+        if line is not None:
+            yield line
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as backup_file:
+        for block in iter(lambda: backup_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifests(target):
+    """
+    :return: the manifests of the complete backups in target, oldest first
+    """
+    if not os.path.isdir(target):
+        return []
+    manifests = []
+    for name in sorted(os.listdir(target)):
+        path = os.path.join(target, name, MANIFEST)
+        if os.path.exists(path):
+            with open(path, 'r') as manifest_file:
+                manifests.append(json.load(manifest_file))
+    return manifests
+
+
+def high_water_marks(manifests):
+    """
+    :return: dictionary of the end (ns) of the backed up range per measurement
+    """
+    ends = {}
+    for manifest in manifests:
+        for measurement, end in manifest['ranges'].items():
+            ends[measurement] = max(end[1], ends.get(measurement, 0))
+    return ends
+
+
+def export_measurement(client, measurement, start, end, path,
+                       chunk_hours=DEFAULT_CHUNK_HOURS, retention_policy=None):
+    """
+    Stream the points with start <= time < end to a gzip-compressed line
+    protocol file, one time-bounded query at a time.
+
+    :param retention_policy: retention policy of the points, None for the
+    default one
+    :return: manifest entry of the file, None without points
+    """
+    chunk_ns = int(chunk_hours * NS_PER_HOUR)
+    points = 0
+    with gzip.open(path, 'wt', encoding='utf-8',
+                   compresslevel=COMPRESS_LEVEL) as backup_file:
+        for chunk_start in range(start, end, chunk_ns):
+            rows = query_range(client, measurement, chunk_start,
+                               min(chunk_start + chunk_ns, end),
+                               retention_policy=retention_policy)
+            if rows.empty:
+                continue
+            for line in frame_lines(rows, measurement):
+                backup_file.write(line)
+                backup_file.write('\n')
+                points += 1
+    if not points:
+        os.remove(path)
+        return None
+    return {'file': os.path.basename(path), 'measurement': measurement,
+            'retention_policy': retention_policy, 'points': points, 'bytes': os.path.getsize(path),
+            'sha256': file_checksum(path)}
+
+
+def run_backup(client, measurements, target, since=None, until=None,
+               full=False, overlap_hours=DEFAULT_OVERLAP_HOURS,
+               chunk_hours=DEFAULT_CHUNK_HOURS, policies=(None,),
+               settle=60 + SETTLE_MARGIN):
+    """
+    Export the points written since the previous backup in target.
+
+    :param client: InfluxDBClient or LocalStore instance
+    :param measurements: names of the measurements to back up
+    :param target: backup directory
+    :param since: start time in ns, default: end of the previous backup or
+    first row
+    :param until: end time in ns (exclusive), default: settle seconds ago
+    :param full: ignore the previous backups
+    :param overlap_hours: hours before the end of the previous backup
+    exported again, for points written late, e.g. from the spool
+    :param chunk_hours: hours of data loaded per query
+    :param policies: retention policies to back up, None for the default
+    one, e.g. [None, 'rollup_1m', 'rollup_1h']
+    :param settle: seconds the points may wait in the database writers
+    :return: the manifest, None if there was nothing to back up
+    """
+    if until is None:
+        until = time.time_ns() - int(settle * 10 ** 9)
+    ends = {} if full else high_water_marks(read_manifests(target))
+    ranges = {}
+    sources = {}  # range name: (measurement, retention policy)
+    for policy in policies:
+        for measurement in measurements:
+            name = LocalStore.table_name(measurement, policy)
+            start = since
+            if start is None and name in ends:
+                start = ends[name] - int(overlap_hours * NS_PER_HOUR)
+            if start is None:
+                first_row = query_first(client, measurement,
+                                        retention_policy=policy)
+                if first_row.empty:
+                    continue
+                start = int(first_row['time'].iloc[0])
+            if start < until:
+                ranges[name] = [start, until]
+                sources[name] = (measurement, policy)
+    if not ranges:
+        return None
+    backup_id = datetime.datetime.fromtimestamp(
+        until // 10 ** 9, datetime.timezone.utc).strftime(BACKUP_ID_FORMAT)
+    suffix = 0
+    while os.path.exists(os.path.join(target, backup_id, MANIFEST)):
+        suffix += 1  # e.g. a second export of the same range with since
+        backup_id = '{}-{:d}'.format(backup_id.split('-')[0], suffix)
+    directory = os.path.join(target, backup_id)
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'id': backup_id, 'created': time.time_ns(), 'ranges': ranges,
+                'files': []}
+    for name, (start, end) in ranges.items():
+        measurement, policy = sources[name]
+        entry = export_measurement(
+            client, measurement, start, end,
+            os.path.join(directory, '{}.lp.gz'.format(name)),
+            chunk_hours, retention_policy=policy)
+        if entry is not None:
+            manifest['files'].append(entry)
+            my_logger.info('backed up {} points of {} ({} bytes)'.format(
+                entry['points'], name, entry['bytes']))
+    tmp_path = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+    return manifest
+
+
+def verify_backups(target):
+    """
+    :return: list of the missing or damaged files as <backup id>/<file>
+    """
+    damaged = []
+    for manifest in read_manifests(target):
+        for entry in manifest['files']:
+            path = os.path.join(target, manifest['id'], entry['file'])
+            if not os.path.exists(path) or file_checksum(path) != entry['sha256']:
+                damaged.append('{}/{}'.format(manifest['id'], entry['file']))
+    return damaged
+
+
+def restore(client, target, batch_size=RESTORE_BATCH_SIZE):
+    """
+    Write all backups in target to the database, oldest first. Points
+    exported twice are overwritten with the same values.
+
+    :param client: InfluxDBClient or LocalStore instance
+    :param target: backup directory
+    :param batch_size: points per write request
+    :return: number of restored points
+    """
+    damaged = verify_backups(target)
+    if damaged:
+        raise ValueError('damaged backup files: {}'.format(', '.join(damaged)))
+    restored = 0
+    for manifest in read_manifests(target):
+        for entry in manifest['files']:
+            path = os.path.join(target, manifest['id'], entry['file'])
+            policy = entry.get('retention_policy')
+            batch = []
+            with gzip.open(path, 'rt', encoding='utf-8') as backup_file:
+                for line in backup_file:
+                    batch.append(parse_line(line))
+                    if len(batch) >= batch_size:
+                        client.write_points(batch, retention_policy=policy)
+                        restored += len(batch)
+                        batch = []
+            if batch:
+                client.write_points(batch, retention_policy=policy)
+                restored += len(batch)
+            my_logger.info('restored {} of {}'.format(entry['file'],
+                                                      manifest['id']))
+    return restored
+
+
+def backup_measurements(cfg):
+    return cfg.get('backup', {}).get('measurements',
+                                     [cfg['SensirionSPS30']['measurement'],
+                                      cfg['DHT22']['measurement']])
+
+
+def backup_policies(cfg):
+    """
+    :return: the retention policies to back up, None for the default one
+    and those of the configured rollups
+    """
+    if 'rollups' not in cfg:
+        return [None]
+    from rollups import policy_name, rollup_settings
+    measurements, intervals, statistics = rollup_settings(cfg)
+    return [None] + [policy_name(interval) for interval in intervals]
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = read_configuration(args)
+    if args.verify:
+        damaged = verify_backups(args.target)
+        for name in damaged:
+            print('damaged: {}'.format(name))
+        raise SystemExit(1 if damaged else 0)
+    client = open_clients(cfg)[0]
+    if args.restore:
+        if 'rollups' in cfg and not isinstance(client, LocalStore):
+            from rollups import set_up_rollups
+            set_up_rollups(client, cfg)  # the policies written to
+        print('restored {} points'.format(restore(client, args.target)))
+    else:
+        run_backup(client, backup_measurements(cfg), args.target,
+                   since=to_ns(args.since), until=to_ns(args.until),
+                   full=args.full, overlap_hours=args.overlap_hours,
+                   chunk_hours=args.chunk_hours,
+                   policies=backup_policies(cfg),
+                   settle=cfg['database'].get('flush_interval', 60)
+                   + SETTLE_MARGIN)
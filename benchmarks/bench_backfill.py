@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the backfill from airmonitor.log on a synthetic log, one
+sample of three measured values frames per minute among the other log
+lines, written to a LocalStore in a temporary directory.
+
+Usage: python benchmarks/bench_backfill.py [--lines 1000000] [--dry-run]
+"""
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import backfill  # noqa: E402
+import pmmonitor  # noqa: E402
+from localstore import LocalStore  # noqa: E402
+from simulator import TYPICAL_VALUES  # noqa: E402
+
+LINES_PER_SAMPLE = 20
+SAMPLE_LINES = (
+    '{} - INFO - start_measurement - start measurement\n',
+    '{} - INFO - read - take measurement 1\n',
+    '{} - INFO - get_response - received MISO frame: {}\n',
+    '{} - INFO - read - take measurement 2\n',
+    '{} - INFO - get_response - received MISO frame: {}\n',
+    '{} - INFO - read - take measurement 3\n',
+    '{} - INFO - get_response - received MISO frame: {}\n',
+    '{} - INFO - read - calculate averages for measurement values\n',
+)
+
+
+def write_log(path, lines):
+    frame = str([hex(byte) for byte in pmmonitor.encode_miso_frame(
+        0x03, 0x00, struct.pack('>10f', *TYPICAL_VALUES))])
+    start = 1546300800
+    with open(path, 'w') as log_file:
+        for sample in range(lines // LINES_PER_SAMPLE):
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S,000',
+                                  time.gmtime(start + sample * 60))
+            for line in SAMPLE_LINES:
+                log_file.write(line.format(stamp, frame))
+            for _ in range(LINES_PER_SAMPLE - len(SAMPLE_LINES)):
+                log_file.write('{} - DEBUG - write - writing points\n'.format(
+                    stamp))
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark the backfill.')
+    parser.add_argument('--lines', type=int, default=1000000,
+                        help='lines of the synthetic log')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only decode, do not write')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, 'airmonitor.log')
+        write_log(log_path, args.lines)
+        store = LocalStore(os.path.join(directory, 'airmonitor.sqlite'))
+        stats = {}
+        start = time.perf_counter()
+        points = backfill.iter_log_points([log_path], 'SensirionSPS30',
+                                          timezone='UTC', stats=stats)
+        backfill.backfill(store, points, dry_run=args.dry_run, stats=stats)
+        seconds = time.perf_counter() - start
+        store.close()
+    print('{:,} lines, {:,} frames, {:,} points written in {:.2f} s, '
+          '{:,.0f} lines/min'.format(stats['lines'], stats['frames'],
+                                     stats['written'], seconds,
+                                     stats['lines'] / seconds * 60))
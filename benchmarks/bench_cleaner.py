@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the outlier cleaning engine on synthetic DHT22 series of
+increasing length, sampled once per minute. Linear scaling shows as a
+constant time per row.
+
+Usage: python benchmarks/bench_cleaner.py [--years 0.5 1 2 4]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import cleaner  # noqa: E402
+
+RULES = {
+    'humidity': {'min': 0, 'max': 100, 'also_repair': ['temperature'],
+                 'spike': {'window': 15, 'threshold': 6, 'min_deviation': 2},
+                 'max_rate': 0.5},
+    'temperature': {'min': -40, 'max': 80,
+                    'spike': {'window': 15, 'threshold': 6, 'min_deviation': 1}},
+}
+ROWS_PER_YEAR = 365 * 24 * 60
+
+
+def synthetic_series(rows, seed=0):
+    """ daily cycle plus noise, with 0.1 % outliers in runs of 1 to 3 """
+    rng = np.random.default_rng(seed)
+    minutes = np.arange(rows)
+    daily = np.sin(2 * np.pi * minutes / (24 * 60))
+    humidity = 55 + 10 * daily + rng.normal(0, 0.5, rows)
+    temperature = 21 + 3 * daily + rng.normal(0, 0.1, rows)
+    starts = rng.choice(rows - 3, rows // 1000, replace=False)
+    for length in (1, 2, 3):
+        run = starts[length - 1::3]
+        for offset in range(length):
+            humidity[run + offset] = rng.uniform(100, 3000, len(run))
+    return pd.DataFrame({
+        'time': 1546300800 * 10 ** 9 + minutes * 60 * 10 ** 9,
+        'humidity': humidity,
+        'temperature': temperature,
+    })
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark the cleaner.')
+    parser.add_argument('--years', type=float, nargs='+',
+                        default=[0.5, 1, 2, 4],
+                        help='series lengths in years')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print('{:>6} {:>10} {:>10} {:>10} {:>12}'.format(
+        'years', 'rows', 'repaired', 'seconds', 'us/row'))
+    for years in args.years:
+        frame = synthetic_series(int(years * ROWS_PER_YEAR))
+        start = time.perf_counter()
+        repaired, final = cleaner.clean_frame(frame, 0, RULES)
+        seconds = time.perf_counter() - start
+        print('{:>6} {:>10,} {:>10,} {:>10.2f} {:>12.2f}'.format(
+            years, len(frame), len(repaired), seconds,
+            seconds / len(frame) * 1e6))
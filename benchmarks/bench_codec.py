@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the SHDLC frame codec and the measured values decoding: calls
+per second of the legacy hex string list implementation versus the
+byte-native codec and struct decoding in pmmonitor.
+
+Usage: python benchmarks/bench_codec.py [-n NUMBER]
+"""
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pmmonitor  # noqa: E402
+
+
+# Read Measured Values response as received from the sensor, incl. stuffing.
+MISO_FRAME = bytes.fromhex('7e000300284126bada413098db4135176f413719e7'
+                           '4292cf6042a9aa7442aac5e342aae05e42aae5fc3f1e'
+                           '2124487e')
+
+
+# --- legacy implementation, as it was before the byte-native codec ---------
+
+def legacy_checksum(data):
+    checksum = sum(data)
+    checksum = checksum & 0xFF
+    checksum = ~checksum & 0xFF
+    return checksum
+
+
+def legacy_byte_stuffing(frame):
+    stuffing = {
+        '0x7e': ['0x7d', '0x5e'],
+        '0x7d': ['0x7d', '0x5d'],
+        '0x11': ['0x7d', '0x31'],
+        '0x13': ['0x7d', '0x33'],
+    }
+    new_frame = [frame[0]]
+    for index, byte in enumerate(frame[1:-1]):
+        if byte in stuffing.keys():
+            new_frame.extend(stuffing[byte])
+        else:
+            new_frame.append(byte)
+    new_frame.append(frame[-1])
+    return new_frame
+
+
+def legacy_byte_unstuffing(frame):
+    unstuffing = {
+        ('0x7d', '0x5e'): '0x7e',
+        ('0x7d', '0x5d'): '0x7d',
+        ('0x7d', '0x31'): '0x11',
+        ('0x7d', '0x33'): '0x13',
+    }
+    ptr = 0
+    key_len = len(list(unstuffing.keys())[0])
+    while ptr < len(frame):
+        seq = tuple(frame[ptr:ptr + key_len])
+        if seq in unstuffing.keys():
+            frame[ptr:ptr + key_len] = [unstuffing[seq]]
+        ptr += 1
+    return frame
+
+
+def legacy_build_mosi_frame(command, data=''):
+    frame = ['0x7e', '0x0', command, '0x{:x}'.format(len(data))]
+    frame.extend(data)
+    check = legacy_checksum([int(frame[1], 16), int(frame[2], 16),
+                             int(frame[3], 16)] + [int(byte, 16)
+                                                   for byte in data])
+    frame.append('0x{:x}'.format(check))
+    frame.append('0x7e')
+    frame = [byte for byte in frame]
+    return legacy_byte_stuffing(frame)
+
+
+def legacy_send(command, data):
+    mosi_frame = legacy_build_mosi_frame(command, data)
+    mosi_frame = ''.join(['{:02x}'.format(int(byte, 0))
+                          for byte in mosi_frame])
+    return bytes.fromhex(mosi_frame)
+
+
+def legacy_receive(data, last_cmd):
+    miso_frame = [hex(data[pos]) for pos in range(len(data))]
+    frame = legacy_byte_unstuffing(list(miso_frame))
+    frame_int = [int(byte, 16) for byte in frame]
+    chk = legacy_checksum(frame_int[1:-2])
+    assert frame[0] == '0x7e' and frame[1] == '0x0'
+    assert frame[2] == last_cmd
+    assert int(frame[4], 16) == len(frame[5:-2])
+    assert frame_int[-2] == chk and frame[-1] == '0x7e'
+    return miso_frame[5:-2]
+
+
+def legacy_bytes_to_float(hex_bytes):
+    hexstr = ''.join(hex_bytes)
+    return struct.unpack('>f', bytes.fromhex(hexstr))[0]
+
+
+def legacy_decode_values(rsp):
+    hexstr = ['{:02x}'.format(int(byte[2:], 16)) for byte in rsp]
+    return {name: legacy_bytes_to_float(hexstr[pos * 4:pos * 4 + 4])
+            for pos, name in enumerate(pmmonitor.MEASURED_VALUES_FIELDS)}
+
+
+# --- benchmark --------------------------------------------------------------
+
+def legacy_round_trip():
+    legacy_send('0x3', [])
+    legacy_receive(MISO_FRAME, '0x3')
+
+
+def codec_round_trip():
+    pmmonitor.encode_mosi_frame(0x03, b'')
+    pmmonitor.decode_miso_frame(MISO_FRAME, 0x03)
+
+
+PAYLOAD = pmmonitor.decode_miso_frame(MISO_FRAME, 0x03)[1]
+PAYLOAD_HEX_LIST = pmmonitor.bytes_to_hex_list(PAYLOAD)
+
+
+def legacy_decode():
+    legacy_decode_values(PAYLOAD_HEX_LIST)
+
+
+def struct_decode():
+    pmmonitor.decode_measured_values(PAYLOAD)
+
+
+def frames_per_second(func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    return number / seconds
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark the SHDLC codec.')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='round trips per measurement')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    before = frames_per_second(legacy_round_trip, args.number)
+    after = frames_per_second(codec_round_trip, args.number)
+    print('SHDLC round trip (encode MOSI + decode 47 byte MISO frame)')
+    print('  before (hex string lists): {:>12,.0f} frames/s'.format(before))
+    print('  after (byte-native codec): {:>12,.0f} frames/s'.format(after))
+    print('  speed-up:                  {:>12.1f} x'.format(after / before))
+    before = frames_per_second(legacy_decode, args.number)
+    after = frames_per_second(struct_decode, args.number)
+    print('Measured values decoding (40 byte payload)')
+    print('  before (hex strings):      {:>12,.0f} payloads/s'.format(before))
+    print('  after (struct.Struct):     {:>12,.0f} payloads/s'.format(after))
+    print('  speed-up:                  {:>12.1f} x'.format(after / before))
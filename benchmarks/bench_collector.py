@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Load test of collector.py on localhost: hundreds of simulated monitors push
+gzip-compressed batches of SPS30 and DHT22 points over HTTP or UDP, a
+fraction of them twice as after a lost response, to a collector writing to
+a stand-in of the InfluxDB /write endpoint that only counts the lines.
+
+Reports the pushes and points per second, the push latency over HTTP, the
+duplicates dropped and how many database writes the points took.
+
+Usage: python benchmarks/bench_collector.py [--nodes 300] [--batches 20]
+    [--points 50] [--transport http] [--duplicates 0.05]
+"""
+
+import argparse
+import asyncio
+import gzip
+import http.server
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import collector  # noqa: E402
+import metrics  # noqa: E402
+from lineprotocol import (LineEncoder, LineProtocolClient,  # noqa: E402
+                          frame_batch)
+from pmmonitor import MEASURED_VALUES_FIELDS  # noqa: E402
+from simulator import TYPICAL_VALUES  # noqa: E402
+
+FIELDS = dict(zip(MEASURED_VALUES_FIELDS, TYPICAL_VALUES))
+
+
+class CountingWriteStandIn(http.server.BaseHTTPRequestHandler):
+    """ counts the requests and lines written to /write """
+
+    protocol_version = 'HTTP/1.1'  # keep the pool connections open
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.lines += body.count(b'\n') + 1
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def make_payloads(node, batches, points, start_ns):
+    """
+    :return: list of gzip-compressed batches of a node, one SPS30 and one
+    DHT22 point per second
+    """
+    encoder = LineEncoder({'node': node})
+    payloads = []
+    second = 0
+    for seq in range(1, batches + 1):
+        lines = []
+        for _ in range(points // 2):
+            timestamp = start_ns + second * 10 ** 9
+            lines.append(encoder.line('SensirionSPS30', None, FIELDS,
+                                      timestamp))
+            lines.append(encoder.line('DHT22', None,
+                                      {'humidity': 45.0 + random.random(),
+                                       'temperature': 21.0}, timestamp))
+            second += 1
+        body = '\n'.join(lines).encode('utf-8')
+        payloads.append(gzip.compress(frame_batch(body, node, 'bench', seq),
+                                      compresslevel=5))
+    return payloads
+
+
+async def http_node(port, payloads, duplicates, latencies):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        for payload in payloads:
+            for _ in range(2 if random.random() < duplicates else 1):
+                start = time.perf_counter()
+                writer.write('POST /push HTTP/1.1\r\nHost: collector\r\n'
+                             'Content-Encoding: gzip\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(
+                                 len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                status = await reader.readline()
+                while (await reader.readline()) not in (b'\r\n', b''):
+                    pass
+                latencies.append(time.perf_counter() - start)
+                if not status.startswith(b'HTTP/1.1 204'):
+                    raise RuntimeError('push failed: {!r}'.format(status))
+    finally:
+        writer.close()
+
+
+async def udp_node(port, payloads, duplicates, interval):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=('127.0.0.1', port))
+    try:
+        for payload in payloads:
+            for _ in range(2 if random.random() < duplicates else 1):
+                transport.sendto(payload)
+            await asyncio.sleep(interval)  # the socket buffer is limited
+    finally:
+        transport.close()
+
+
+async def run_nodes(args, ports, payloads, latencies):
+    if args.transport == 'http':
+        nodes = [http_node(ports[0], node_payloads, args.duplicates,
+                           latencies) for node_payloads in payloads]
+    else:
+        nodes = [udp_node(ports[1], node_payloads, args.duplicates,
+                          args.udp_interval) for node_payloads in payloads]
+    await asyncio.gather(*nodes)
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Load test the collector '
+                                                 'with many simulated '
+                                                 'monitors.')
+    parser.add_argument('--nodes', type=int, default=300,
+                        help='simulated monitors')
+    parser.add_argument('--batches', type=int, default=20,
+                        help='pushes per monitor')
+    parser.add_argument('--points', type=int, default=50,
+                        help='points per push')
+    parser.add_argument('--transport', choices=('http', 'udp'), default='http')
+    parser.add_argument('--duplicates', type=float, default=0.05,
+                        help='fraction of pushes sent twice')
+    parser.add_argument('--udp-interval', type=float, default=0.02,
+                        help='seconds between the datagrams of a monitor')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='max. lines per database write')
+    parser.add_argument('--pool-size', type=int, default=4,
+                        help='database connections')
+    return parser.parse_args()
+
+
+def main(args):
+    backend = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                              CountingWriteStandIn)
+    backend.lock = threading.Lock()
+    backend.requests = backend.lines = 0
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+
+    gateway = collector.Collector(
+        lambda: LineProtocolClient('127.0.0.1', backend.server_port,
+                                   database='airmonitor'),
+        batch_size=args.batch_size, flush_interval=0.5,
+        pool_size=args.pool_size, max_backlog=10 ** 7)
+    ready = threading.Event()
+    ports = []
+    state = {}
+
+    async def serve():
+        state['loop'] = asyncio.get_running_loop()
+        state['stop'] = asyncio.Event()
+        await collector.serve(gateway, '127.0.0.1', 0, 0, state['stop'],
+                              lambda *bound: (ports.extend(bound),
+                                              ready.set()))
+
+    server_thread = threading.Thread(target=asyncio.run, args=(serve(),))
+    server_thread.start()
+    ready.wait()
+
+    start_ns = time.time_ns()
+    payloads = [make_payloads('node-{:03d}'.format(idx), args.batches,
+                              args.points, start_ns)
+                for idx in range(args.nodes)]
+    expected = args.nodes * args.batches * (args.points // 2 * 2)
+    latencies = []
+    start = time.perf_counter()
+    asyncio.run(run_nodes(args, ports, payloads, latencies))
+    pushed = time.perf_counter() - start
+    deadline = time.monotonic() + 30
+    while backend.lines < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    written = time.perf_counter() - start
+    state['loop'].call_soon_threadsafe(state['stop'].set)
+    server_thread.join()
+    gateway.close()
+    backend.shutdown()
+
+    results = {sample[1]: sample[3] for sample
+               in metrics.COLLECTOR_BATCHES.samples()}
+    pushes = sum(results.values())
+    print('{} monitors over {}, {} pushes of {} points'.format(
+        args.nodes, args.transport, args.nodes * args.batches, args.points))
+    print('pushes/s            {:>12,.0f}'.format(pushes / pushed))
+    print('points/s written    {:>12,.0f}'.format(backend.lines / written))
+    if latencies:
+        latencies.sort()
+        print('push latency p50    {:>12.2f} ms'.format(
+            latencies[len(latencies) // 2] * 1000))
+        print('push latency p99    {:>12.2f} ms'.format(
+            latencies[int(len(latencies) * 0.99)] * 1000))
+    for result in ('accepted', 'duplicate', 'invalid', 'overloaded'):
+        print('{:<20}{:>12,.0f}'.format(result, results.get((result,), 0)))
+    print('points written      {:>12,} of {:,}'.format(backend.lines,
+                                                       expected))
+    print('database writes     {:>12,} ({:,.0f} points each)'.format(
+        backend.requests, backend.lines / max(backend.requests, 1)))
+
+
+if __name__ == '__main__':
+    main(parse_args())
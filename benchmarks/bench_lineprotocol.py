@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of building and serializing SPS30 points for one write
+request: the former path of points with strftime timestamps through the
+line protocol serializer of InfluxDBClient.write_points, against points
+with integer ns timestamps through LineEncoder, both gzip-compressed as
+sent with InfluxDBClient(gzip=True) and LineProtocolClient.
+
+Usage: python benchmarks/bench_lineprotocol.py [-n 5000] [--repeat 5]
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lineprotocol import LineEncoder  # noqa: E402
+from pmmonitor import MEASURED_VALUES_FIELDS  # noqa: E402
+from sensors import make_point  # noqa: E402
+from simulator import TYPICAL_VALUES  # noqa: E402
+
+FIELDS = dict(zip(MEASURED_VALUES_FIELDS, TYPICAL_VALUES))
+TAGS = {'serial_number': 'SIM0123456789ABC'}
+
+
+def former_path(count):
+    from influxdb.line_protocol import make_lines
+    points = []
+    for _ in range(count):
+        timestamp = datetime.datetime.utcnow()
+        points.append({'measurement': 'SensirionSPS30',
+                       'time': timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                       'tags': TAGS, 'fields': dict(FIELDS)})
+    body = make_lines({'points': points}, precision=None).encode('utf-8')
+    return gzip.compress(body, compresslevel=5)
+
+
+def encoder_path(count, encoder):
+    points = [make_point('SensirionSPS30', dict(FIELDS), tags=TAGS)
+              for _ in range(count)]
+    return gzip.compress(encoder.encode(points), compresslevel=5)
+
+
+def best_of(repeat, function, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), len(body)
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark the line '
+                                                 'protocol serialization.')
+    parser.add_argument('-n', type=int, default=5000,
+                        help='points per request body')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs, the fastest is reported')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print('{:<28} {:>12} {:>12}'.format('path', 'us/point', 'gzip bytes'))
+    for name, function, extra in (
+            ('strftime + make_lines', former_path, ()),
+            ('time_ns + LineEncoder', encoder_path, (LineEncoder(),))):
+        seconds, size = best_of(args.repeat, function, args.n, *extra)
+        print('{:<28} {:>12.2f} {:>12,}'.format(name, seconds / args.n * 1e6,
+                                                size))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark of SensirionSPS30 against the simulated sensor: start
+measurement, then read measured values repeatedly through SHDLC, the frame
+reader and the codec. Reports commands per second, command latency
+percentiles and CPU time per sample, which includes the simulated sensor
+running in the same process.
+
+With --pty the simulated sensor is served on a pseudo-terminal and opened
+with pyserial, so the serial I/O path is measured as well. With --devices
+several sensors are polled in parallel, one thread per port as in the
+daemon; with a realistic --latency the commands/s scale with the ports.
+
+Usage: python benchmarks/bench_sensor.py [-n NUMBER] [--latency SECONDS]
+                                         [--corruption P] [--pty]
+                                         [--devices N]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pmmonitor  # noqa: E402
+from simulator import PtyBridge, SimulatedSPS30  # noqa: E402
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run(pm_sensor, number):
+    """
+    :return: tuple (latencies in seconds, failed reads)
+    """
+    pm_sensor.start_measurement()
+    latencies = []
+    failed = 0
+    for _ in range(number):
+        start = time.perf_counter()
+        try:
+            record = pm_sensor.read_measured_record()
+        except pmmonitor.MISOFrameError:
+            record = None
+        latencies.append(time.perf_counter() - start)
+        if record is None:
+            failed += 1
+    return latencies, failed
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark SensirionSPS30 '
+                                                 'against the simulator.')
+    parser.add_argument('-n', '--number', type=int, default=2000,
+                        help='read measured values commands')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated response latency in seconds')
+    parser.add_argument('--corruption', type=float, default=0.0,
+                        help='probability of a corrupted response')
+    parser.add_argument('--pty', action='store_true',
+                        help='go through a pseudo-terminal and pyserial')
+    parser.add_argument('--devices', type=int, default=1,
+                        help='sensors polled in parallel')
+    parser.add_argument('--log', action='store_true',
+                        help='keep the per-frame logging enabled')
+    return parser.parse_args()
+
+
+def open_sensor(args, bridges):
+    sensor = SimulatedSPS30(latency=args.latency, corruption=args.corruption,
+                            seed=len(bridges))
+    if args.pty:
+        bridges.append(PtyBridge(sensor).start())
+        shdlc = pmmonitor.SHDLC(device=bridges[-1].device)
+    else:
+        bridges.append(None)
+        shdlc = pmmonitor.SHDLC(port=sensor)
+    return pmmonitor.SensirionSPS30(shdlc)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.log:
+        logging.getLogger('MyLogger').setLevel(logging.WARNING)
+    bridges = []
+    pm_sensors = [open_sensor(args, bridges) for _ in range(args.devices)]
+    results = [None] * args.devices
+
+    def worker(idx):
+        results[idx] = run(pm_sensors[idx], args.number)
+
+    threads = [threading.Thread(target=worker, args=(idx,))
+               for idx in range(args.devices)]
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        for pm_sensor, bridge in zip(pm_sensors, bridges):
+            pm_sensor.shdlc.close_serial_port()
+            if bridge is not None:
+                bridge.close()
+    latencies = sorted(latency for result in results for latency in result[0])
+    failed = sum(result[1] for result in results)
+    commands = args.number * args.devices
+    print('SensirionSPS30 read measured values via {}, {} device(s)'.format(
+        'pty + pyserial' if args.pty else 'in-process serial stand-in',
+        args.devices))
+    print('  commands:       {:>12,d} ({} failed)'.format(commands, failed))
+    print('  commands/s:     {:>12,.0f}'.format(commands / wall))
+    for fraction in (0.5, 0.9, 0.99):
+        print('  latency p{:<2.0f}:    {:>12.1f} µs'.format(
+            fraction * 100, percentile(latencies, fraction) * 1e6))
+    print('  CPU per sample: {:>12.1f} µs'.format(cpu / commands * 1e6))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the cold start of a single sample cycle as run by cron: a new
+interpreter imports pmmonitor, reads a simulated SPS30 once and writes the
+point to the sqlite backend. Also lists the slowest imports of pmmonitor as
+reported by python -X importtime.
+
+Usage: python benchmarks/bench_startup.py [-n 10]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CYCLE = '''
+import pmmonitor
+import simulator
+from sensors import SensorScheduler
+
+database = pmmonitor.open_database({'database': {'backend': 'sqlite'}})
+driver = pmmonitor.SPS30Driver('SensirionSPS30', pm_sensor=pmmonitor.SensirionSPS30(
+    pmmonitor.SHDLC(port=simulator.SimulatedSPS30())))
+driver.warm_up = 0
+SensorScheduler([driver], database.write).run_once()
+database.close()
+'''
+
+
+def environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    return env
+
+
+def cold_cycle(directory):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', CYCLE], cwd=directory,
+                   env=environment(), check=True)
+    return time.perf_counter() - start
+
+
+def slowest_imports(count):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import pmmonitor'], env=environment(),
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == 'pmmonitor':
+            break
+        if depth == 0:
+            times = []  # imported at startup, e.g. by site
+        elif depth == 1:  # imported by pmmonitor, listed before it
+            times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)[:count]
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Benchmark the cold start.')
+    parser.add_argument('-n', type=int, default=10,
+                        help='number of cold starts')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        seconds = [cold_cycle(directory) for _ in range(args.n)]
+    print('cold single sample cycle: median {:.0f} ms, min {:.0f} ms'.format(
+        statistics.median(seconds) * 1000, min(seconds) * 1000))
+    print('slowest imports of pmmonitor (cumulative):')
+    for cumulative, name in slowest_imports(8):
+        print('{:>10.1f} ms  {}'.format(cumulative / 1000, name))
@@ -3,11 +3,29 @@
 
 
 import argparse
-import yaml
-from influxdb import InfluxDBClient
-from influxdb import DataFrameClient
+import itertools
+import json
+import os
+import re
+import time
+import numpy as np
 import pandas as pd
 
+from localstore import LocalStore
+
+NS_PER_HOUR = 3600 * 10 ** 9
+DEFAULT_CHUNK_HOURS = 24
+MAX_PENDING_ROWS = 100000  # rows held back waiting for a valid value
+MAD_SCALE = 1.4826  # MAD to standard deviation for normal distributed data
+SPIKE_WINDOW = 11
+SPIKE_THRESHOLD = 5
+# used without a 'cleaning' section in the configuration
+DEFAULT_RULES = {
+    'DHT22': {
+        'humidity': {'max': 100, 'also_repair': ['temperature']},
+    },
+}
+
 
 def parse_args():
     """ parse the args from the command line call """
@@ -15,6 +33,19 @@ def parse_args():
     parser.add_argument('-c', '--config', type=str,
                         default='airmonitor_config.yml',
                         help='configuration file')
+    parser.add_argument('--since', type=str, default=None,
+                        help='clean from this time on, e.g. 2019-11-17T00:00Z, '
+                             'default: where the last run stopped')
+    parser.add_argument('--until', type=str, default=None,
+                        help='clean up to this time, default: now')
+    parser.add_argument('--full', action='store_true',
+                        help='ignore where the last run stopped and clean '
+                             'the whole series')
+    parser.add_argument('--chunk-hours', type=float,
+                        default=DEFAULT_CHUNK_HOURS,
+                        help='hours of data loaded per query')
+    parser.add_argument('--state', type=str, default='cleaner_state.json',
+                        help='file remembering where the last run stopped')
     return parser.parse_args()
 
 
@@ -25,51 +56,464 @@ def read_configuration(args):
     :param args: command line arguments submitted with the start of the script
     :return: configuration dictionary
     """
+    import yaml
     with open(args.config, 'r') as ymlfile:
-        cfg = yaml.load(ymlfile)
+        cfg = yaml.safe_load(ymlfile)
     return cfg
 
 
-def clean_DHT22_outliers(cfg):
+def to_ns(timestamp):
+    """
+    Convert a time string to a UTC timestamp in nanoseconds.
+
+    :param timestamp: time string, e.g. '2019-11-17T23:25:00Z', or None
+    :return: nanoseconds since epoch or None
+    """
+    if timestamp is None:
+        return None
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.value
+
+
+def read_state(path):
+    """
+    :return: dictionary of high-water-mark timestamps (ns) per measurement
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def write_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, path)
+
+
+def query_frame(client, query):
+    return pd.DataFrame(client.query(query, epoch='ns').get_points())
+
+
+def quote_tag_value(value):
+    return "'{}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def tag_filter(tags):
+    """
+    :param tags: tag dictionary of a series, None for all series
+    :return: InfluxQL conditions selecting the series
+    """
+    if tags is None:
+        return ''
+    return ''.join(' and "{}" = {}'.format(key, quote_tag_value(value))
+                   for key, value in sorted(tags.items()))
+
+
+def parse_series_key(key):
+    """
+    :param key: series key as listed by show series, e.g.
+    'DHT22,node=kitchen,serial_number=1'
+    :return: tag dictionary
+    """
+    pairs = re.split(r'(?<!\\),', key)[1:]
+    return {re.sub(r'\\(.)', r'\1', name): re.sub(r'\\(.)', r'\1', value)
+            for name, value in (re.split(r'(?<!\\)=', pair, 1)
+                                for pair in pairs)}
+
+
+def list_series(client, measurement):
+    """
+    :return: list of the tag dictionaries of the series of a measurement,
+    {} for points without tags
+    """
+    if isinstance(client, LocalStore):
+        return client.series(measurement)
+    series = [parse_series_key(row['key']) for row in client.query(
+        f'show series from "{measurement}"').get_points()]
+    keys = {key for tags in series for key in tags}
+    # an empty tag value selects the points without the tag
+    return [dict(dict.fromkeys(keys, ''), **tags) for tags in series]
+
+
+def source(measurement, retention_policy=None):
+    """ :return: the measurement in an InfluxQL from clause """
+    if retention_policy is None:
+        return f'"{measurement}"'
+    return f'"{retention_policy}"."{measurement}"'
+
+
+def query_range(client, measurement, start, end, tags=None,
+                retention_policy=None):
+    """
+    all rows with start <= time < end, of one series if tags are given, in
+    the retention policy or the default one
+    """
+    if isinstance(client, LocalStore):
+        return client.query_range(client.table_name(measurement,
+                                                    retention_policy),
+                                  start, end, tags=tags)
+    return query_frame(client, f'select * from '
+                               f'{source(measurement, retention_policy)} '
+                               f'where time >= {start} and time < {end}'
+                               f'{tag_filter(tags)}')
+
+
+def query_before(client, measurement, timestamp, limit=1, tags=None):
+    """ the last rows before timestamp, in ascending time order """
+    if isinstance(client, LocalStore):
+        return client.query_before(measurement, timestamp, limit, tags=tags)
+    rows = query_frame(client, f'select * from "{measurement}" '
+                               f'where time < {timestamp}{tag_filter(tags)} '
+                               f'order by time desc limit {limit}')
+    return rows.iloc[::-1].reset_index(drop=True)
+
+
+def query_first(client, measurement, since=0, limit=1, tags=None,
+                retention_policy=None):
+    """ the first rows at or after since """
+    if isinstance(client, LocalStore):
+        return client.query_first(client.table_name(measurement,
+                                                    retention_policy),
+                                  since, limit, tags=tags)
+    return query_frame(client, f'select * from '
+                               f'{source(measurement, retention_policy)} '
+                               f'where time >= {since}{tag_filter(tags)} '
+                               f'limit {limit}')
+
+
+def spike_reach(rule):
+    """
+    Rows on either side of a value that its spike check depends on. The MAD
+    is a rolling median of deviations from rolling medians, so it reaches
+    two half windows.
+    """
+    return 2 * (rule['spike'].get('window', SPIKE_WINDOW) // 2)
+
+
+def lookbehind(rules):
+    """ number of rows before a row that its rules look at """
+    rows = 1  # previous good value for the interpolation
+    for rule in rules.values():
+        if 'spike' in rule:
+            rows = max(rows, spike_reach(rule))
+    return rows
+
+
+def lookahead(rules):
+    """ number of rows after a row that its rules look at """
+    rows = 0
+    for rule in rules.values():
+        if 'spike' in rule:
+            rows = max(rows, spike_reach(rule))
+        if 'max_rate' in rule:
+            rows = max(rows, 1)
+    return rows
+
+
+def detect_outliers(frame, rules):
+    """
+    Flag values that break the cleaning rules.
+
+    Rules per field:
+      min, max: valid value range
+      spike: {window, threshold, min_deviation}, values deviating from the
+        rolling median by more than threshold times the rolling MAD (scaled
+        to a standard deviation) and by more than min_deviation
+      max_rate: max. change per second, flags values that jump away from
+        and back again by more than this rate
+      also_repair: list of fields whose values are repaired, too, if this
+        field's value is an outlier
+
+    :param frame: DataFrame with a DatetimeIndex
+    :param rules: dictionary of rules per field
+    :return: DataFrame of bool, True for the values to repair
+    """
+    bad = pd.DataFrame(False, index=frame.index, columns=list(frame.columns))
+    for field, rule in rules.items():
+        if field not in frame:
+            continue
+        values = frame[field].astype(float)
+        mask = np.zeros(len(values), dtype=bool)
+        if 'min' in rule:
+            mask |= (values < rule['min']).to_numpy()
+        if 'max' in rule:
+            mask |= (values > rule['max']).to_numpy()
+        if 'spike' in rule:
+            window = rule['spike'].get('window', SPIKE_WINDOW)
+            threshold = rule['spike'].get('threshold', SPIKE_THRESHOLD)
+            min_deviation = rule['spike'].get('min_deviation', 0)
+            median = values.rolling(window, center=True, min_periods=1).median()
+            deviation = (values - median).abs()
+            mad = deviation.rolling(window, center=True, min_periods=1).median()
+            limit = np.maximum(threshold * MAD_SCALE * mad, min_deviation)
+            mask |= (deviation > limit).to_numpy()
+        if 'max_rate' in rule:
+            seconds = np.diff(frame.index.asi8) / 1e9
+            change = np.diff(values.to_numpy())
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = change / seconds
+            jump = np.abs(rate) > rule['max_rate']
+            # a jump into the value and an opposite jump out of it
+            spike = jump[:-1] & jump[1:] & (np.sign(rate[:-1]) != np.sign(rate[1:]))
+            mask[1:-1] |= spike
+        bad[field] |= mask
+        for other in rule.get('also_repair', []):
+            if other in bad:
+                bad[other] |= mask
+    return bad
+
+
+def repair_outliers(frame, bad):
+    """
+    Replace flagged values by time-weighted interpolation between the nearest
+    valid values, so runs of outliers are bridged as a whole. Outliers at the
+    start or end of the frame take the nearest valid value.
+
+    :param frame: DataFrame with a DatetimeIndex
+    :param bad: DataFrame of bool from detect_outliers()
+    :return: repaired copy of frame
+    """
+    repaired = frame.copy()
+    for field in bad.columns[bad.any().to_numpy()]:
+        values = frame[field].astype(float).mask(bad[field])
+        values = values.interpolate(method='time', limit_area='inside')
+        values = values.ffill().bfill()
+        repaired[field] = repaired[field].astype(float)
+        repaired.loc[bad[field], field] = values[bad[field]]
+    return repaired
+
+
+def clean_frame(frame, first, rules, stop=None):
+    """
+    Detect and repair outliers in a chunk of rows.
+
+    Rows before first and from stop on are context only. Rows are final up
+    to the last valid row whose rule windows are complete, later rows have
+    to be checked again together with the following rows.
+
+    :param frame: DataFrame of consecutive rows with a 'time' column in ns
+    :param first: index of the first row to check
+    :param rules: dictionary of rules per field
+    :param stop: index of the first row after the rows to check, default:
+    the end of the frame
+    :return: tuple (DataFrame of the repaired rows, index of the first row
+    that is not final)
+    """
+    indexed = frame.set_index(pd.DatetimeIndex(pd.to_datetime(frame['time'],
+                                                              utc=True)))
+    indexed = indexed.drop(columns='time')
+    bad = detect_outliers(indexed, rules)
+    row_bad = bad.any(axis=1).to_numpy()
+    complete = len(frame) - lookahead(rules)
+    valid = np.flatnonzero(~row_bad[:complete])
+    final = max(valid[-1] + 1 if len(valid) else first, first)
+    if complete - final > MAX_PENDING_ROWS:
+        final = complete  # sensor broken for long, repair with what we have
+    if stop is not None:
+        final = min(final, stop)
+    rows = np.arange(len(frame))
+    selected = row_bad & (rows >= first) & (rows < final)
+    if not selected.any():
+        return frame.iloc[:0], final
+    repaired = repair_outliers(indexed, bad)
+    repaired = repaired.reset_index(drop=True)
+    repaired.insert(0, 'time', frame['time'].to_numpy())
+    return repaired[selected], final
+
+
+def write_fixed(df_client, fixed_measurements, measurement, tags=None):
+    """
+    Overwrite the repaired rows of a series.
+
+    :param tags: tag dictionary of the series, written as tag columns so the
+    rows replace the original points
+    """
+    tags = {key: value for key, value in (tags or {}).items() if value != ''}
+    fixed_measurements = fixed_measurements.copy()
+    fixed_measurements['time'] = pd.to_datetime(fixed_measurements['time'],
+                                                utc=True)
+    fixed_measurements = fixed_measurements.set_index('time')
+    for key, value in tags.items():
+        fixed_measurements[key] = value
+    df_client.write_points(fixed_measurements, measurement,
+                           tag_columns=sorted(tags))
+
+
+def open_clients(cfg):
+    """
+    :return: tuple (client, df_client), both the LocalStore for the sqlite
+    backend
+    """
+    if cfg['database'].get('backend', 'influxdb') == 'sqlite':
+        store = LocalStore(cfg['database'].get('path', 'airmonitor.sqlite'))
+        return store, store
+    from influxdb import DataFrameClient, InfluxDBClient
     client = InfluxDBClient(host=cfg['database']['host'],
                             port=cfg['database']['port'],
                             username=cfg['database']['user'],
                             password=cfg['database']['password'],
                             database=cfg['database']['name'])
-    query = f"select * from {cfg['DHT22']['measurement']}"
-    df = pd.DataFrame(client.query(query, epoch='ns').get_points())
-
-    # filter false readings
-    false_readings = df[df['humidity'] > 100].index
-    fixed_measurements = df.iloc[false_readings]
-
-    # fix humidity readings
-    false_readings = df[df['humidity'] > 100].index
-    s1 = df.iloc[false_readings - 1]['humidity'].reset_index(drop=True)
-    s2 = df.iloc[false_readings + 1]['humidity'].reset_index(drop=True)
-    fixed = pd.concat([s1, s2], axis=1).mean(axis=1)
-    fixed.index = false_readings
-    fixed_measurements['humidity'] = fixed
-
-    # fix temperature readings
-    s1 = df.iloc[false_readings - 1]['temperature'].reset_index(drop=True)
-    s2 = df.iloc[false_readings + 1]['temperature'].reset_index(drop=True)
-    fixed = pd.concat([s1, s2], axis=1).mean(axis=1)
-    fixed.index = false_readings
-    fixed_measurements['temperature'] = fixed
-    fixed_measurements['time'] = pd.to_datetime(fixed_measurements['time'])
-    fixed_measurements = fixed_measurements.set_index('time')
-
-    # write fixed values back to database
     df_client = DataFrameClient(host=cfg['database']['host'],
                                 port=cfg['database']['port'],
                                 username=cfg['database']['user'],
                                 password=cfg['database']['password'],
                                 database=cfg['database']['name'])
-    df_client.write_points(fixed_measurements, cfg['DHT22']['measurement'])
+    return client, df_client
+
+
+def clean_all(cfg, **kwargs):
+    """
+    Clean all measurements configured in the 'cleaning' section of the
+    configuration, see clean_outliers() for the keyword arguments.
+
+    :param cfg: configuration dictionary
+    :return: dictionary of the number of repaired rows per measurement
+    """
+    client, df_client = open_clients(cfg)
+    fixed = {}
+    for section, rules in cfg.get('cleaning', DEFAULT_RULES).items():
+        measurement = cfg[section]['measurement']
+        fixed[measurement] = clean_outliers(client, df_client, measurement,
+                                            rules, **kwargs)
+    return fixed
+
+
+def clean_DHT22_outliers(cfg, **kwargs):
+    """
+    Clean the DHT22 measurement, see clean_outliers() for the keyword
+    arguments.
+    """
+    client, df_client = open_clients(cfg)
+    rules = cfg.get('cleaning', DEFAULT_RULES).get('DHT22', DEFAULT_RULES['DHT22'])
+    return clean_outliers(client, df_client, cfg['DHT22']['measurement'],
+                          rules, **kwargs)
+
+
+def series_key(measurement, tags):
+    """
+    :return: key of a series in the state file, the measurement name for
+    points without tags
+    """
+    return ','.join([measurement] + ['{}={}'.format(key, value)
+                                     for key, value in sorted(tags.items())
+                                     if value != ''])
+
+
+def clean_outliers(client, df_client, measurement, rules, since=None,
+                   until=None, chunk_hours=DEFAULT_CHUNK_HOURS,
+                   state_path=None, full=False):
+    """
+    Detect and repair outliers, streaming each series of the measurement,
+    e.g. of each node and sensor, in time-bounded chunks.
+
+    The rows a chunk could not finalize, plus the rows the rules need as
+    context, are carried over into the next chunk, so the result does not
+    depend on the chunk boundaries. The rows right after the window are
+    fetched once as right-hand context of the last rows.
+
+    Without since the run starts where the previous run stopped, as
+    remembered per series in the state file, so only new data is processed.
+
+    :param client: InfluxDBClient or LocalStore instance
+    :param df_client: DataFrameClient or LocalStore instance
+    :param measurement: measurement name
+    :param rules: dictionary of rules per field, see detect_outliers()
+    :param since: start time in ns, default: high-water mark or first row
+    :param until: end time in ns (exclusive), default: now
+    :param chunk_hours: hours of data loaded per query
+    :param state_path: file remembering where the last run stopped
+    :param full: ignore the state file and start at the first row
+    :return: number of repaired rows
+    """
+    state = read_state(state_path)
+    if until is None:
+        until = time.time_ns()
+    fixed_count = 0
+    changed = False
+    for tags in list_series(client, measurement):
+        key = series_key(measurement, tags)
+        series_since = since
+        if series_since is None and not full:
+            # state files written before the series were told apart
+            series_since = state.get(key, state.get(measurement))
+        count, high_water_mark = clean_series(
+            client, df_client, measurement, tags, rules, series_since, until,
+            chunk_hours)
+        fixed_count += count
+        if high_water_mark is not None \
+                and high_water_mark > state.get(key, 0):
+            state[key] = high_water_mark
+            changed = True
+
+    if state_path is not None and changed:
+        write_state(state_path, state)
+    return fixed_count
+
+
+def clean_series(client, df_client, measurement, tags, rules, since, until,
+                 chunk_hours):
+    """
+    Detect and repair the outliers of one series, see clean_outliers().
+
+    :param tags: tag dictionary of the series
+    :return: tuple (number of repaired rows, high-water mark or None)
+    """
+    if since is None:
+        first_row = query_first(client, measurement, tags=tags)
+        if first_row.empty:
+            return 0, None
+        since = int(first_row['time'].iloc[0])
+    chunk_ns = int(chunk_hours * NS_PER_HOUR)
+    context = lookbehind(rules)
+
+    def series_rows(rows):
+        """ the rows without the tag columns """
+        return rows.drop(columns=list(tags), errors='ignore')
+
+    carry = series_rows(query_before(client, measurement, since, context,
+                                     tags=tags))
+    first = len(carry)
+    high_water_mark = None
+    fixed_count = 0
+    chunks = ((start, min(start + chunk_ns, until))
+              for start in range(since, until, chunk_ns))
+    # the rows at or after until are the right-hand context of the last rows
+    tail = [(until, None)]
+    for start, end in itertools.chain(chunks, tail):
+        if end is None:
+            rows = query_first(client, measurement, start,
+                               lookahead(rules) + 1, tags=tags)
+        else:
+            rows = query_range(client, measurement, start, end, tags=tags)
+        if rows.empty:
+            continue
+        rows = series_rows(rows)
+        frame = pd.concat([carry, rows], ignore_index=True) \
+            if not carry.empty else rows
+        # the rows at or after until are never repaired
+        stop = int(np.searchsorted(frame['time'].to_numpy(), until))
+        fixed_measurements, final = clean_frame(frame, first, rules, stop)
+        if not fixed_measurements.empty:
+            write_fixed(df_client, fixed_measurements, measurement, tags)
+            fixed_count += len(fixed_measurements)
+        keep = max(0, final - context)
+        carry = frame.iloc[keep:].reset_index(drop=True)
+        first = final - keep
+        if final < len(frame):
+            high_water_mark = int(frame['time'].iloc[final])  # not final yet
+        else:
+            high_water_mark = int(frame['time'].iloc[-1]) + 1
+        high_water_mark = min(high_water_mark, until)
+    return fixed_count, high_water_mark
 
 
 if __name__ == '__main__':
     args = parse_args()
     cfg = read_configuration(args)
-    clean_DHT22_outliers(cfg)
+    clean_all(cfg, since=to_ns(args.since), until=to_ns(args.until),
+              chunk_hours=args.chunk_hours, state_path=args.state,
+              full=args.full)
@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Collector between a fleet of monitors and the central database. The
+monitors push batches of line protocol, see lineprotocol.CollectorClient,
+over HTTP (POST /push) or UDP, each batch gzip-compressed and numbered per
+node and session. The collector drops batches it already received, e.g.
+repeated after a lost response, merges the lines of all nodes and writes
+them in large batches through a pool of database connections, instead of
+one writer and HTTP request per monitor and sample.
+
+Usage: python collector.py [-c airmonitor_config.yml], settings in section
+collector, the database in section database.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import socket
+import time
+
+import metrics
+from dbwriter import client_errors
+from lineprotocol import parse_batch, parse_line
+
+my_logger = logging.getLogger('MyLogger.database')
+
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+STATUS_TEXT = {200: 'OK', 204: 'No Content', 400: 'Bad Request',
+               404: 'Not Found', 413: 'Payload Too Large',
+               503: 'Service Unavailable'}
+RESULT_STATUS = {'accepted': 204, 'duplicate': 204, 'invalid': 400,
+                 'overloaded': 503}
+
+
+class SequenceTracker:
+    """
+    Remember the received sequence numbers per stream, i.e. node and
+    session: all up to low, and the ones above low in a set. Sequence
+    numbers more than window below the highest one count as received.
+    """
+
+    def __init__(self, window=4096):
+        self.window = window
+        self.streams = {}  # stream: [low, set above low, last seen]
+
+    def accept(self, stream, seq, now=None):
+        """
+        :return: True if seq is new in the stream, False for a duplicate
+        """
+        now = time.monotonic() if now is None else now
+        state = self.streams.get(stream)
+        if state is None:
+            # the collector may have restarted, earlier batches are welcome
+            state = self.streams[stream] = [seq - self.window - 1, set(), now]
+        low, above = state[0], state[1]
+        state[2] = now
+        if seq <= low or seq in above:
+            return False
+        above.add(seq)
+        if seq - low > self.window:
+            low = seq - self.window
+            above = {number for number in above if number > low}
+        while low + 1 in above:
+            low += 1
+            above.discard(low)
+        state[0], state[1] = low, above
+        return True
+
+    def expire(self, max_idle, now=None):
+        """ forget the streams without batches for max_idle seconds """
+        now = time.monotonic() if now is None else now
+        for stream in [stream for stream, state in self.streams.items()
+                       if now - state[2] > max_idle]:
+            del self.streams[stream]
+
+
+class Collector:
+    """
+    Accept pushed batches, see push(), and write the merged lines to the
+    database from run(), as soon as batch_size lines are queued or the
+    oldest is flush_interval seconds old, with up to pool_size writes in
+    parallel. Lines of failed writes are queued again, while more than
+    max_backlog lines are queued new batches are refused.
+    """
+
+    def __init__(self, client_factory, batch_size=5000, flush_interval=1.0,
+                 pool_size=4, max_backlog=500000, window=4096,
+                 max_backoff=60):
+        """
+        :param client_factory: function returning a new database client,
+        e.g. a LineProtocolClient, called pool_size times
+        :param batch_size: max. lines per database write
+        :param flush_interval: max. seconds a line is queued
+        :param pool_size: number of database connections
+        :param max_backlog: max. queued lines
+        :param window: sequence numbers remembered per stream
+        :param max_backoff: max. seconds between attempts while the
+        database is down
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool_size = pool_size
+        self.max_backlog = max_backlog
+        self.max_backoff = max_backoff
+        self.tracker = SequenceTracker(window)
+        self.clients = queue.Queue()
+        for _ in range(pool_size):
+            self.clients.put(client_factory())
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix='collector')
+        self.queued = {}  # retention policy: list of lines
+        self.backlog = 0
+        self.oldest = None
+        self.wakeup = None
+        self.failures = 0
+
+    def push(self, payload):
+        """
+        :param payload: batch as sent by CollectorClient
+        :return: accepted, duplicate, invalid or overloaded
+        """
+        try:
+            node, session, seq, policy, body = parse_batch(payload)
+            lines = [line for line in body.decode('utf-8').split('\n')
+                     if line and not line.startswith('#')]
+        except ValueError as err:  # UnicodeDecodeError included
+            my_logger.warning('dropping invalid batch: {}'.format(err))
+            result = 'invalid'
+        else:
+            if self.backlog + len(lines) > self.max_backlog:
+                result = 'overloaded'  # not recorded, the node sends again
+            elif not self.tracker.accept((node, session), seq):
+                result = 'duplicate'
+            else:
+                result = 'accepted'
+                self.queue_lines(policy, lines)
+        metrics.COLLECTOR_BATCHES.labels(result).inc()
+        return result
+
+    def queue_lines(self, policy, lines, front=False):
+        if not lines:
+            return
+        queued = self.queued.setdefault(policy, [])
+        if front:
+            queued[:0] = lines
+        else:
+            queued.extend(lines)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        self.backlog += len(lines)
+        metrics.COLLECTOR_BACKLOG.set(self.backlog)
+        if self.backlog >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    def take_batches(self):
+        """
+        :return: list of (retention policy, lines) of all queued lines
+        """
+        batches = []
+        for policy, lines in self.queued.items():
+            for start in range(0, len(lines), self.batch_size):
+                batches.append((policy, lines[start:start + self.batch_size]))
+        self.queued, self.backlog, self.oldest = {}, 0, None
+        metrics.COLLECTOR_BACKLOG.set(0)
+        return batches
+
+    def write(self, policy, lines):
+        """
+        Write lines with a client of the pool, in a thread of the executor.
+
+        :return: True if written or rejected, False if worth retrying
+        """
+        client = self.clients.get()
+        retry_errors, rejected_errors = client_errors(client)
+        metrics.DB_BATCH_POINTS.observe(len(lines))
+        start = time.perf_counter()
+        try:
+            if hasattr(client, 'write'):
+                client.write('\n'.join(lines).encode('utf-8'), policy)
+            else:  # e.g. LocalStore
+                client.write_points([parse_line(line) for line in lines],
+                                    retention_policy=policy)
+        except retry_errors as err:
+            my_logger.error('writing to database failed with error: '
+                            '\'{}\'.'.format(err))
+            metrics.DB_WRITE_ERRORS.labels('retry').inc()
+            return False
+        except rejected_errors as err:
+            my_logger.error('database rejected {} lines with error: '
+                            '\'{}\'.'.format(len(lines), err))
+            metrics.DB_WRITE_ERRORS.labels('rejected').inc()
+            return True
+        finally:
+            metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - start)
+            self.clients.put(client)
+        return True
+
+    async def flush(self):
+        """
+        Write all queued lines.
+
+        :return: True if everything was written
+        """
+        batches = self.take_batches()
+        if not batches:
+            return True
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.executor, self.write, policy, lines)
+            for policy, lines in batches])
+        failed = [batch for batch, written in zip(batches, results)
+                  if not written]
+        for policy, lines in reversed(failed):
+            self.queue_lines(policy, lines, front=True)
+        return not failed
+
+    async def run(self, stop_event):
+        """
+        Flush the queued lines until stop_event, an asyncio.Event, is set,
+        then flush once more.
+        """
+        self.wakeup = asyncio.Event()
+        while not stop_event.is_set():
+            if self.failures:
+                # back off while the database is down, new lines do not
+                # shorten the wait
+                timeout = min(self.flush_interval * 2 ** self.failures,
+                              self.max_backoff)
+                waiter = stop_event
+            elif self.oldest is None:
+                timeout, waiter = self.flush_interval, self.wakeup
+            else:
+                timeout = self.oldest + self.flush_interval - time.monotonic()
+                waiter = self.wakeup
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(waiter.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            self.failures = 0 if await self.flush() else self.failures + 1
+            self.tracker.expire(86400)
+        await self.flush()
+
+    def close(self):
+        self.executor.shutdown()
+        while not self.clients.empty():
+            self.clients.get().close()
+
+
+class PushProtocol(asyncio.DatagramProtocol):
+    """ pass every datagram to Collector.push """
+
+    def __init__(self, collector):
+        self.collector = collector
+
+    def datagram_received(self, data, addr):
+        self.collector.push(data)
+
+
+async def handle_http(collector, reader, writer):
+    """
+    Serve POST /push with a batch as body and GET /metrics, keeping the
+    connection open for the next request.
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            try:
+                method, path, _ = request_line.decode('latin-1').split()
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                await respond(writer, 400)
+                break
+            if length > MAX_REQUEST_BYTES:
+                await respond(writer, 413)
+                break
+            body = await reader.readexactly(length)
+            path = path.split('?')[0]
+            if method == 'POST' and path == '/push':
+                await respond(writer, RESULT_STATUS[collector.push(body)])
+            elif method == 'GET' and path == '/metrics':
+                await respond(writer, 200, metrics.REGISTRY.render().encode(),
+                              'text/plain; version=0.0.4')
+            else:
+                await respond(writer, 404)
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def respond(writer, status, body=b'', content_type='text/plain'):
+    head = 'HTTP/1.1 {} {}\r\nContent-Length: {}\r\n'.format(
+        status, STATUS_TEXT[status], len(body))
+    if body:
+        head += 'Content-Type: {}\r\n'.format(content_type)
+    writer.write(head.encode('latin-1') + b'\r\n' + body)
+    await writer.drain()
+
+
+async def serve(collector, address='0.0.0.0', http_port=8087, udp_port=8089,
+                stop_event=None, started=None):
+    """
+    Receive pushes over HTTP and UDP and write them until stop_event is set.
+
+    :param http_port: TCP port for POST /push, None to not serve HTTP,
+    0 for any free port
+    :param udp_port: UDP port for datagrams, None to not receive UDP
+    :param stop_event: asyncio.Event, serves forever if None
+    :param started: function called with the (http port, udp port) bound
+    """
+    loop = asyncio.get_running_loop()
+    stop_event = stop_event or asyncio.Event()
+    server = transport = None
+    ports = [None, None]
+    if http_port is not None:
+        server = await asyncio.start_server(
+            lambda reader, writer: handle_http(collector, reader, writer),
+            address, http_port)
+        ports[0] = server.sockets[0].getsockname()[1]
+    if udp_port is not None:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: PushProtocol(collector), local_addr=(address, udp_port))
+        # room for the bursts of many nodes while a batch is parsed
+        transport.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RECEIVE_BUFFER)
+        ports[1] = transport.get_extra_info('sockname')[1]
+    my_logger.info('collector listening on http port {}, udp port {}'.format(
+        *ports))
+    if started is not None:
+        started(*ports)
+    try:
+        await collector.run(stop_event)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if transport is not None:
+            transport.close()
+        await collector.flush()
+
+
+def make_collector(cfg):
+    """ Collector writing to the database of section database """
+    collector_cfg = cfg.get('collector', {})
+    database_cfg = cfg['database']
+    if database_cfg.get('backend', 'influxdb') == 'sqlite':
+        from localstore import LocalStore
+        store = LocalStore(database_cfg.get('path', 'airmonitor.sqlite'))
+
+        def client_factory():
+            return store
+        pool_size = 1  # one writer for the file
+    else:
+        from lineprotocol import LineProtocolClient
+
+        def client_factory():
+            return LineProtocolClient(database_cfg.get('host'),
+                                      database_cfg.get('port'),
+                                      database_cfg.get('user'),
+                                      database_cfg.get('password'),
+                                      database_cfg.get('name'),
+                                      compress=database_cfg.get('gzip', True))
+        pool_size = collector_cfg.get('pool_size', 4)
+    return Collector(client_factory,
+                     batch_size=collector_cfg.get('batch_size', 5000),
+                     flush_interval=collector_cfg.get('flush_interval', 1.0),
+                     pool_size=pool_size,
+                     max_backlog=collector_cfg.get('max_backlog', 500000))
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Collect the measurements '
+                                                 'of many monitors into the '
+                                                 'database.')
+    parser.add_argument('-c', '--config', type=str,
+                        default='airmonitor_config.yml',
+                        help='configuration file')
+    return parser.parse_args()
+
+
+def read_configuration(args):
+    """
+    Read the configuration file.
+
+    :param args: command line arguments submitted with the start of the script
+    :return: configuration dictionary
+    """
+    import yaml
+    with open(args.config, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    return cfg
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = read_configuration(args)
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    collector_cfg = cfg.get('collector', {})
+    collector = make_collector(cfg)
+    try:
+        asyncio.run(serve(collector,
+                          address=collector_cfg.get('address', '0.0.0.0'),
+                          http_port=collector_cfg.get('http_port', 8087),
+                          udp_port=collector_cfg.get('udp_port', 8089)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
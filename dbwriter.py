@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batched InfluxDB writes with a background flush thread and an on-disk spool
+for batches that could not be written while the database was unreachable.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+from lineprotocol import ClientError, ServerError
+
+my_logger = logging.getLogger('MyLogger.database')
+
+
+def influxdb_errors():
+    """ errors of InfluxDBClient and DataFrameClient """
+    import requests
+    from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+    return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            InfluxDBServerError), (InfluxDBClientError,)
+
+
+def sqlite_errors():
+    """ errors of LocalStore, e.g. 'database is locked' is worth a retry """
+    import sqlite3
+    return (sqlite3.OperationalError,), (sqlite3.IntegrityError,
+                                         sqlite3.DataError,
+                                         sqlite3.InterfaceError)
+
+
+# errors per backend, by the top-level module of the client class or of
+# one of its base classes
+BACKEND_ERRORS = {
+    'influxdb': influxdb_errors,
+    'localstore': sqlite_errors,
+    }
+
+
+def client_errors(client):
+    """
+    The errors of a backend are only looked up for its client, so the other
+    clients do not import it.
+
+    :param client: database client, e.g. LineProtocolClient or LocalStore
+    :return: tuple (errors after which a batch is worth retrying later,
+    errors of batches rejected by the database)
+    """
+    retry_errors, rejected_errors = (ConnectionError, TimeoutError,
+                                     ServerError), (ClientError,)
+    for cls in type(client).__mro__:
+        backend = BACKEND_ERRORS.get(cls.__module__.split('.')[0])
+        if backend is not None:
+            backend_retry, backend_rejected = backend()
+            return (retry_errors + backend_retry,
+                    rejected_errors + backend_rejected)
+    return retry_errors, rejected_errors
+
+
+class Spool:
+    """
+    Append-only file of unsent batches, one JSON encoded list of points per
+    line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, points):
+        line = json.dumps(points, separators=(',', ':')) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as spool_file:
+                spool_file.write(line)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+
+    def read(self):
+        """
+        :return: list of spooled batches, oldest first
+        """
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, 'r') as spool_file:
+                lines = spool_file.readlines()
+        batches = []
+        for line in lines:
+            try:
+                batches.append(json.loads(line))
+            except ValueError:
+                # torn last line after a power cut, the batch is lost
+                my_logger.error('skipping unreadable spool line')
+        return batches
+
+    def replace(self, batches):
+        """
+        Atomically replace the spool content with the given batches.
+        """
+        with self.lock:
+            if not batches:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as spool_file:
+                for points in batches:
+                    spool_file.write(json.dumps(points,
+                                                separators=(',', ':')) + '\n')
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+            os.replace(tmp_path, self.path)
+
+    def backlog(self):
+        """
+        :return: number of spooled batches
+        """
+        return len(self.read())
+
+
+def group_by_policy(points):
+    """
+    Split points by their optional 'retention_policy' key, e.g. rollups
+    kept longer than the raw data.
+
+    :return: list of (retention policy or None for the default, points)
+    """
+    groups = {}
+    for point in points:
+        groups.setdefault(point.get('retention_policy'), []).append(point)
+    return list(groups.items())
+
+
+class BatchWriter:
+    """
+    Accumulate points in memory and write them in batches from a background
+    thread, as soon as batch_size points are queued or the oldest queued
+    point is flush_interval seconds old. Batches that fail with a connection
+    or server error, or an unexpected error, are appended to the spool and
+    replayed after the next successful write. Spooled batches failing with
+    an unexpected error again are moved to the spool file with suffix
+    .failed, so they do not hold up the others.
+    """
+
+    def __init__(self, client, batch_size=500, flush_interval=60,
+                 spool_path=None):
+        """
+        :param client: InfluxDBClient instance
+        :param batch_size: number of points that triggers a flush
+        :param flush_interval: max. age in seconds of a queued point
+        :param spool_path: file for unsent batches, None to drop them
+        """
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = Spool(spool_path) if spool_path else None
+        self.failed = Spool(spool_path + '.failed') if spool_path else None
+        self.points = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.spool is not None:
+            metrics.SPOOL_BACKLOG.set(self.spool.backlog())
+        self.thread = threading.Thread(target=self.run, name='BatchWriter',
+                                       daemon=True)
+        self.thread.start()
+
+    def write(self, points):
+        """
+        Queue points for writing.
+
+        :param points: list of points in InfluxDBClient.write_points format
+        """
+        with self.lock:
+            if not self.points:
+                self.oldest = time.monotonic()
+            self.points.extend(points)
+            queued = len(self.points)
+        if queued >= self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                if self.oldest is None:
+                    timeout = self.flush_interval
+                else:
+                    timeout = self.oldest + self.flush_interval - time.monotonic()
+            if timeout > 0:
+                self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if not self.stopped.is_set():
+                try:
+                    self.flush()
+                except Exception:
+                    # keep writing the later points
+                    my_logger.exception('flushing points failed')
+
+    def flush(self):
+        """
+        Write all queued points, then replay spooled batches.
+
+        :return: True if the queued points were written
+        """
+        with self.flush_lock:
+            with self.lock:
+                points, self.points, self.oldest = self.points, [], None
+            if points and not self.try_send(points):
+                if self.spool is not None:
+                    self.spool.append(points)
+                    metrics.SPOOL_BACKLOG.inc()
+                    my_logger.warning('spooled {} points'.format(len(points)))
+                return False
+            if self.spool is not None:
+                self.replay()
+            return True
+
+    def try_send(self, points):
+        """
+        send() with unexpected errors logged.
+
+        :return: True if written or rejected, False if to be spooled
+        """
+        try:
+            return self.send(points)
+        except Exception:
+            my_logger.exception('writing {} points failed'.format(len(points)))
+            metrics.DB_WRITE_ERRORS.labels('error').inc()
+            return False
+
+    def send(self, points):
+        my_logger.info('writing {} points to database'.format(len(points)))
+        metrics.DB_BATCH_POINTS.observe(len(points))
+        retry_errors, rejected_errors = client_errors(self.client)
+        start = time.perf_counter()
+        try:
+            for policy, group in group_by_policy(points):
+                self.client.write_points(group, batch_size=self.batch_size,
+                                         retention_policy=policy)
+        except retry_errors as err:
+            my_logger.error('writing to database failed with '
+                            'error: \'{}\'.'.format(err))
+            metrics.DB_WRITE_ERRORS.labels('retry').inc()
+            return False
+        except rejected_errors as err:
+            # rejected by the database, retrying would not help
+            my_logger.error('database rejected {} points with '
+                            'error: \'{}\'.'.format(len(points), err))
+            metrics.DB_WRITE_ERRORS.labels('rejected').inc()
+            return True
+        finally:
+            metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - start)
+        my_logger.info('data written to database')
+        return True
+
+    def replay(self):
+        batches = self.spool.read()
+        if not batches:
+            return
+        my_logger.info('replaying {} spooled batches'.format(len(batches)))
+        for idx, points in enumerate(batches):
+            try:
+                written = self.send(points)
+            except Exception:
+                my_logger.exception('moving spooled batch of {} points to '
+                                    '{}'.format(len(points), self.failed.path))
+                metrics.DB_WRITE_ERRORS.labels('error').inc()
+                self.failed.append(points)
+                continue
+            if not written:
+                self.spool.replace(batches[idx:])
+                metrics.SPOOL_BACKLOG.set(len(batches) - idx)
+                return
+        self.spool.replace([])
+        metrics.SPOOL_BACKLOG.set(0)
+
+    def close(self):
+        """
+        Stop the background thread and write everything still queued.
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deadband filter between acquisition and the database: a point of a series,
+i.e. measurement and tags, is only written when one of its fields moved
+beyond its deadband since the last written point, or when the series has
+been silent for the heartbeat time. Slowly varying indoor values then cost
+a point per change instead of a point per sample.
+
+Written points always carry all their fields, so a consumer reconstructs
+the step series by holding each value until the next point, e.g. with
+fill(previous) in InfluxQL. The last written values are kept in a state
+file, so a restart, or the next cron run, compares against them instead of
+writing an extra point.
+"""
+
+import json
+import logging
+import os
+import threading
+
+import metrics
+
+my_logger = logging.getLogger('MyLogger.database')
+
+DEFAULT_HEARTBEAT = 900
+RULE_KEYS = ('absolute', 'relative')
+
+
+class Deadband:
+    """
+    Pass on the points with a field outside its deadband and drop the
+    others. Points of measurements without rules and rollup points are
+    passed on unchanged.
+
+    Can be used as output function of SensorScheduler, Aggregator or Rollups.
+    """
+
+    def __init__(self, output, rules, heartbeat=DEFAULT_HEARTBEAT,
+                 state_path=None):
+        """
+        :param output: function called with a list of points
+        :param rules: dictionary of rules per measurement and field, e.g.
+        {'DHT22': {'humidity': {'absolute': 0.5, 'relative': 0.02}}}. A
+        field leaves its deadband when it changed by more than absolute and
+        by more than relative times the last written value.
+        :param heartbeat: max. seconds between written points of a series
+        :param state_path: file keeping the last written points, None keeps
+        them in memory only
+        """
+        for measurement, fields in rules.items():
+            for field, rule in fields.items():
+                for key in rule:
+                    if key not in RULE_KEYS:
+                        raise ValueError('unknown deadband setting \'{}\' of '
+                                         '{}.{}, expected one of {}'.format(
+                                             key, measurement, field,
+                                             ', '.join(RULE_KEYS)))
+        self.output = output
+        self.rules = rules
+        self.heartbeat_ns = int(heartbeat * 10 ** 9)
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.last = self.load()  # series key: last written point
+
+    @staticmethod
+    def series_key(point):
+        return json.dumps([point['measurement'],
+                           sorted(point.get('tags', {}).items())])
+
+    def load(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as state_file:
+                return json.load(state_file)
+        except ValueError:
+            my_logger.error('ignoring unreadable deadband state {}'.format(
+                self.state_path))
+            return {}
+
+    def save(self):
+        if self.state_path is None:
+            return
+        with self.lock:
+            state = dict(self.last)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def moved(self, rules, fields, last_fields):
+        for field, rule in rules.items():
+            value = fields.get(field)
+            last = last_fields.get(field)
+            if value is None or value != value:
+                continue  # missing now, nothing to write
+            if last is None:
+                return True  # first value of the field
+            change = abs(value - last)
+            if change > rule.get('absolute', 0.0) \
+                    and change > rule.get('relative', 0.0) * abs(last):
+                return True
+        return False
+
+    def __call__(self, points):
+        passed = []
+        with self.lock:
+            for point in points:
+                rules = self.rules.get(point['measurement'])
+                if rules is None or 'retention_policy' in point:
+                    passed.append(point)
+                    continue
+                key = self.series_key(point)
+                last = self.last.get(key)
+                if last is None \
+                        or point['time'] - last['time'] >= self.heartbeat_ns \
+                        or self.moved(rules, point['fields'], last['fields']):
+                    self.last[key] = {'time': point['time'],
+                                      'fields': dict(point['fields'])}
+                    passed.append(point)
+                else:
+                    metrics.DEADBAND_SUPPRESSED.labels(
+                        point['measurement']).inc()
+        if passed:
+            self.output(passed)
+
+    def flush(self):
+        """ keep the last written points for the next start """
+        self.save()
+
+
+def deadband_rules(cfg):
+    """
+    :param cfg: configuration dictionary, section deadband with rules per
+    sensor section as in section cleaning
+    :return: dictionary of rules per measurement
+    """
+    return {cfg[section]['measurement']: rules
+            for section, rules in cfg.get('deadband', {}).items()
+            if section in cfg and isinstance(rules, dict)
+            and 'measurement' in cfg[section]}
+
+
+def make_deadband(output, cfg):
+    """ Deadband stage configured in section deadband """
+    deadband_cfg = cfg.get('deadband', {})
+    heartbeat = deadband_cfg.get('heartbeat', DEFAULT_HEARTBEAT)
+    if heartbeat <= 0:
+        raise ValueError('deadband heartbeat must be a positive number of '
+                         'seconds')
+    return Deadband(output, deadband_rules(cfg), heartbeat=heartbeat,
+                    state_path=deadband_cfg.get('state',
+                                                'airmonitor_deadband.json'))
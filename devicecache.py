@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of sensor metadata per serial device, e.g. device
+information and auto cleaning interval of a SPS30, so a restart does not
+have to ask the sensor again.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+my_logger = logging.getLogger('MyLogger.sensor')
+
+
+class DeviceCache:
+    """
+    JSON file of metadata values per device, each stored with the time it
+    was read from the sensor and valid for ttl seconds.
+    """
+
+    def __init__(self, path, ttl=86400, clock=time.time):
+        """
+        :param path: cache file, None keeps the cache in memory only
+        :param ttl: seconds a cached value is valid
+        :param clock: wall clock function, the cache outlives the process
+        """
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except ValueError:
+            my_logger.error('ignoring unreadable device cache {}'.format(
+                self.path))
+            return {}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, device, key):
+        """
+        :return: the cached value, None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(device, {}).get(key)
+        if entry is None or self.clock() - entry['time'] > self.ttl:
+            return None
+        my_logger.info('using cached {} of {}'.format(key, device))
+        return entry['value']
+
+    def set(self, device, key, value):
+        with self.lock:
+            self.entries.setdefault(device, {})[key] = {'value': value,
+                                                        'time': self.clock()}
+            self.save()
+
+    def invalidate(self, device, key=None):
+        """
+        :param key: the value to drop, all values of the device if None
+        """
+        with self.lock:
+            if key is None:
+                self.entries.pop(device, None)
+            else:
+                self.entries.get(device, {}).pop(key, None)
+            self.save()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+InfluxDB line protocol: an encoder for points with integer ns timestamps,
+a parser for backups, and a client writing gzip-compressed request bodies
+straight to the /write endpoint, or pushing them to collector.py.
+
+LineEncoder escapes the measurement name and tags of a series and the field
+names once and reuses them for every later point, so encoding a point costs
+little more than formatting its field values. Unlike InfluxDBClient, the
+client neither reparses timestamps nor imports the influxdb package, and
+with it pandas and requests.
+"""
+
+import collections
+import gzip
+import hashlib
+import http.client
+import logging
+import math
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+my_logger = logging.getLogger('MyLogger.database')
+
+COMPRESS_LEVEL = 5
+MEASUREMENT_SPECIALS = re.compile(r'([, \\])')
+KEY_SPECIALS = re.compile(r'([,= \\])')
+BATCH_HEADER = b'#airmonitor '
+MAX_DATAGRAM = 60000
+
+
+class WriteError(Exception):
+    """ the database answered a write request with an error """
+
+    def __init__(self, status, message):
+        super().__init__('HTTP {}: {}'.format(status, message))
+        self.status = status
+
+
+class ServerError(WriteError):
+    """ 5xx, the write is worth retrying later """
+
+
+class ClientError(WriteError):
+    """ 4xx, the points were rejected, retrying would not help """
+
+
+def escape_measurement(name):
+    return MEASUREMENT_SPECIALS.sub(r'\\\1', name)
+
+
+def escape_key(text):
+    """ escape a tag key, tag value or field key """
+    return KEY_SPECIALS.sub(r'\\\1', str(text))
+
+
+def format_field(value):
+    """
+    :return: the field value in line protocol, None for a missing value
+    """
+    if type(value) is float:  # the common case first
+        return repr(value) if math.isfinite(value) else None
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{:d}i'.format(value)
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+    if hasattr(value, 'item'):  # numpy scalar
+        return format_field(value.item())
+    return format_field(float(value))
+
+
+class LineEncoder:
+    """
+    Encode points in InfluxDBClient.write_points format with time in ns,
+    caching the escaped series keys and field names.
+    """
+
+    def __init__(self, default_tags=None):
+        """
+        :param default_tags: tags added to every point without these tags
+        """
+        self.default_tags = default_tags or {}
+        self.series = {}  # (measurement, tag items): escaped series key
+        self.field_keys = {}  # field: escaped field key and '='
+
+    def series_key(self, measurement, tags):
+        key = (measurement, tuple(tags.items()) if tags else ())
+        series = self.series.get(key)
+        if series is None:
+            series = escape_measurement(measurement) + ''.join(
+                ',{}={}'.format(escape_key(tag), escape_key(value))
+                for tag, value in sorted({**self.default_tags,
+                                          **dict(key[1])}.items()))
+            self.series[key] = series
+        return series
+
+    def line(self, measurement, tags, fields, timestamp):
+        """
+        :param timestamp: time in ns
+        :return: the point in line protocol, without newline, None without
+        field values
+        """
+        field_keys = self.field_keys
+        values = []
+        for field, value in fields.items():
+            value = format_field(value)
+            if value is None:
+                continue
+            field_key = field_keys.get(field)
+            if field_key is None:
+                field_key = field_keys[field] = escape_key(field) + '='
+            values.append(field_key + value)
+        if not values:
+            return None
+        return '{} {} {:d}'.format(self.series_key(measurement, tags),
+                                   ','.join(values), timestamp)
+
+    def encode(self, points):
+        """
+        :param points: points with time in ns
+        :return: the points in line protocol as bytes, one per line
+        """
+        lines = []
+        for point in points:
+            line = self.line(point['measurement'], point.get('tags'),
+                             point['fields'], point['time'])
+            if line is not None:
+                lines.append(line)
+        return '\n'.join(lines).encode('utf-8')
+
+
+def split_unescaped(text, separator, quotes=True):
+    """
+    Split at the separators that are neither escaped by a backslash nor,
+    with quotes, inside a double-quoted string.
+    """
+    parts, start, quoted, pos = [], 0, False, 0
+    while pos < len(text):
+        char = text[pos]
+        if char == '\\':
+            pos += 1
+        elif char == '"' and quotes:
+            quoted = not quoted
+        elif char == separator and not quoted:
+            parts.append(text[start:pos])
+            start = pos + 1
+        pos += 1
+    parts.append(text[start:])
+    return parts
+
+
+def unescape(text):
+    return re.sub(r'\\(.)', r'\1', text)
+
+
+def parse_field(text):
+    if text.startswith('"'):
+        return unescape(text[1:-1])
+    if text in ('t', 'T', 'true', 'True', 'TRUE'):
+        return True
+    if text in ('f', 'F', 'false', 'False', 'FALSE'):
+        return False
+    if text.endswith('i'):
+        return int(text[:-1])
+    return float(text)
+
+
+def parse_line(line):
+    """
+    :param line: point in line protocol with timestamp in ns
+    :return: the point as dictionary for write_points()
+    """
+    key, values, timestamp = split_unescaped(line.rstrip('\n'), ' ')
+    key = split_unescaped(key, ',', quotes=False)
+    tags = dict([unescape(part) for part in split_unescaped(pair, '=', False)]
+                for pair in key[1:])
+    fields = {}
+    for pair in split_unescaped(values, ','):
+        field, value = split_unescaped(pair, '=')
+        fields[unescape(field)] = parse_field(value)
+    point = {'measurement': unescape(key[0]), 'fields': fields,
+             'time': int(timestamp)}
+    if tags:
+        point['tags'] = tags
+    return point
+
+
+class LineProtocolClient:
+    """
+    Write points to the InfluxDB 1.x /write endpoint over a persistent HTTP
+    connection, with the InfluxDBClient.write_points interface used by
+    BatchWriter.
+    """
+
+    def __init__(self, host='localhost', port=8086, username=None,
+                 password=None, database=None, compress=True, timeout=10):
+        """
+        :param compress: send gzip-compressed request bodies
+        :param timeout: seconds to wait for the database
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.database = database
+        self.compress = compress
+        self.timeout = timeout
+        self.encoder = LineEncoder()
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def write_points(self, points, batch_size=None, retention_policy=None,
+                     **kwargs):
+        """
+        :param points: points with time in ns
+        :param batch_size: max. points per request, all in one if None
+        :param retention_policy: retention policy to write to, the default
+        policy if None
+        :raises ServerError, ClientError: if the database refused the write
+        :raises OSError: if the database could not be reached
+        """
+        batch_size = batch_size or len(points) or 1
+        for start in range(0, len(points), batch_size):
+            body = self.encoder.encode(points[start:start + batch_size])
+            if body:
+                self.write(body, retention_policy)
+        return True
+
+    def write(self, body, retention_policy=None):
+        """ send a request body of lines in line protocol """
+        params = {'db': self.database, 'precision': 'n'}
+        if retention_policy is not None:
+            params['rp'] = retention_policy
+        if self.username is not None:
+            params['u'] = self.username
+            params['p'] = self.password
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compress:
+            body = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+        self.post('/write?' + urllib.parse.urlencode(params), body, headers)
+
+    def post(self, url, body, headers):
+        """
+        :raises ServerError, ClientError: if the server refused the request
+        :raises ConnectionError: if the server could not be reached
+        """
+        with self.lock:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request('POST', url, body, headers)
+                response = self.connection.getresponse()
+                message = response.read()
+            except (OSError, http.client.HTTPException) as err:
+                self.close_connection()  # reconnect with the next write
+                raise ConnectionError(str(err)) from err
+        if response.status >= 500:
+            raise ServerError(response.status, message.decode(errors='replace'))
+        if response.status >= 300:
+            raise ClientError(response.status, message.decode(errors='replace'))
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        with self.lock:
+            self.close_connection()
+
+
+def frame_batch(body, node, session, seq, retention_policy=None):
+    """
+    Prefix a batch of lines with the header identifying it at the collector,
+    a comment line for InfluxDB.
+
+    :param body: lines in line protocol as bytes
+    :param node: name of the sending monitor
+    :param session: id of the sending process, seq restarts with it
+    :param seq: sequence number of the batch within the session
+    :param retention_policy: retention policy of the lines, default if None
+    """
+    params = {'node': node, 'session': session, 'seq': seq}
+    if retention_policy is not None:
+        params['rp'] = retention_policy
+    return BATCH_HEADER + urllib.parse.urlencode(params).encode() + b'\n' + body
+
+
+def parse_batch(payload):
+    """
+    :param payload: batch from frame_batch(), gzip-compressed or not
+    :return: (node, session, seq, retention policy or None, body)
+    :raises ValueError: if the payload is no valid batch
+    """
+    if payload[:2] == b'\x1f\x8b':
+        try:
+            payload = gzip.decompress(payload)
+        except (OSError, EOFError) as err:
+            raise ValueError('broken gzip data: {}'.format(err)) from err
+    header, _, body = payload.partition(b'\n')
+    if not header.startswith(BATCH_HEADER):
+        raise ValueError('batch header missing')
+    params = dict(urllib.parse.parse_qsl(
+        header[len(BATCH_HEADER):].decode('utf-8', errors='replace')))
+    try:
+        return (params['node'], params['session'], int(params['seq']),
+                params.get('rp'), body)
+    except (KeyError, ValueError) as err:
+        raise ValueError('invalid batch header {!r}'.format(header)) from err
+
+
+class CollectorClient(LineProtocolClient):
+    """
+    Push points to collector.py instead of the database, with the
+    InfluxDBClient.write_points interface used by BatchWriter. Every batch
+    carries the node name, a session id and a sequence number, so the
+    collector drops batches it already received. A batch that failed is
+    sent again with its former sequence number.
+
+    Over http, a failed push raises like LineProtocolClient.write. Over
+    udp, pushes are neither acknowledged nor repeated.
+    """
+
+    def __init__(self, host='localhost', port=8087, node=None,
+                 transport='http', compress=True, timeout=10, tag_node=True,
+                 max_datagram=MAX_DATAGRAM):
+        """
+        :param node: name of this monitor, the host name if None
+        :param transport: http or udp
+        :param tag_node: tag the points with the node name, so the series
+        of the monitors stay apart in the database
+        :param max_datagram: max. bytes of a compressed udp batch, larger
+        batches are split
+        """
+        if transport not in ('http', 'udp'):
+            raise ValueError('unknown collector transport \'{}\', expected '
+                             'http or udp'.format(transport))
+        super().__init__(host, port, compress=compress, timeout=timeout)
+        self.node = node or socket.gethostname()
+        self.transport = transport
+        self.max_datagram = max_datagram
+        if tag_node:
+            self.encoder = LineEncoder({'node': self.node})
+        self.session = str(time.time_ns())
+        self.seq = 0
+        self.unsent = collections.OrderedDict()  # batch digest: seq
+        self.socket = None
+
+    def write(self, body, retention_policy=None):
+        """ push a request body of lines in line protocol """
+        if self.transport == 'udp':
+            self.send_datagrams(body, retention_policy)
+            return
+        digest = hashlib.sha1(body + str(retention_policy).encode()).digest()
+        with self.lock:
+            seq = self.unsent.get(digest)
+            if seq is None:
+                self.seq += 1
+                seq = self.unsent[digest] = self.seq
+                while len(self.unsent) > 1024:
+                    self.unsent.popitem(last=False)
+        payload = frame_batch(body, self.node, self.session, seq,
+                              retention_policy)
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compress:
+            payload = gzip.compress(payload, compresslevel=COMPRESS_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+        self.post('/push', payload, headers)
+        with self.lock:
+            self.unsent.pop(digest, None)
+
+    def send_datagrams(self, body, retention_policy):
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+        payload = frame_batch(body, self.node, self.session, seq,
+                              retention_policy)
+        if self.compress:
+            payload = gzip.compress(payload, compresslevel=COMPRESS_LEVEL)
+        if len(payload) > self.max_datagram:
+            lines = body.split(b'\n')
+            if len(lines) < 2:
+                raise ClientError(413, 'line of {} bytes exceeds the max. '
+                                       'datagram size'.format(len(body)))
+            half = len(lines) // 2
+            self.send_datagrams(b'\n'.join(lines[:half]), retention_policy)
+            self.send_datagrams(b'\n'.join(lines[half:]), retention_policy)
+            return
+        with self.lock:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.socket.sendto(payload, (self.host, self.port))
+            except OSError as err:
+                raise ConnectionError(str(err)) from err
+
+    def close(self):
+        super().close()
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Embedded time-series store in SQLite, for nodes without an InfluxDB server.
+
+LocalStore accepts points the way InfluxDBClient.write_points and
+DataFrameClient.write_points do, so BatchWriter, the aggregation stages and
+cleaner.py can use it in place of the InfluxDB clients. pandas is only
+imported by the queries, writing points does not need it. Each measurement is
+a table with one column per field, keyed by time and tag set; writing a
+point with the same time and tags again updates it, as in InfluxDB.
+"""
+
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import threading
+
+my_logger = logging.getLogger('MyLogger.database')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+AGGREGATES = {'mean': 'avg', 'min': 'min', 'max': 'max', 'count': 'count'}
+
+
+def to_ns(timestamp):
+    """
+    :param timestamp: time in ns, datetime in UTC or string as written by
+    make_point(), e.g. '2019-11-08 21:16:45.118000'
+    :return: time in ns since the epoch
+    """
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp.rstrip('Z'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class LocalStore:
+    """
+    SQLite database in WAL mode, so the writer and readers like cleaner.py
+    do not block each other, with memory-mapped reads.
+    """
+
+    def __init__(self, path, mmap_size=256 * 1024 * 1024):
+        """
+        :param path: database file
+        :param mmap_size: bytes of the file read through a memory map
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+        self.lock = threading.Lock()
+        self.columns = {}  # table: set of field columns
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def table_name(measurement, retention_policy=None):
+        if retention_policy is None:
+            return measurement
+        return '{}.{}'.format(retention_policy, measurement)
+
+    def tables(self):
+        rows = self.connection.execute(
+            'SELECT name FROM sqlite_master WHERE type = \'table\'').fetchall()
+        return [row[0] for row in rows]
+
+    def table_columns(self, table):
+        """ :return: set of field columns, None if the table does not exist """
+        if table not in self.columns:
+            rows = self.connection.execute(
+                'PRAGMA table_info({})'.format(quote(table))).fetchall()
+            if not rows:
+                return None
+            self.columns[table] = {row[1] for row in rows} - {'time', 'tags'}
+        return self.columns[table]
+
+    def ensure_columns(self, table, fields):
+        columns = self.table_columns(table)
+        if columns is None:
+            self.connection.execute(
+                'CREATE TABLE {} (time INTEGER NOT NULL, tags TEXT NOT NULL, '
+                'PRIMARY KEY (time, tags)) WITHOUT ROWID'.format(quote(table)))
+            columns = self.columns[table] = set()
+        for field in fields:
+            if field not in columns:
+                self.connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    quote(table), quote(field)))
+                columns.add(field)
+
+    def write_points(self, points, measurement=None, batch_size=None,
+                     retention_policy=None, **kwargs):
+        """
+        Insert or update points in one transaction.
+
+        :param points: list of points in InfluxDBClient.write_points format,
+        or a DataFrame with a DatetimeIndex as for DataFrameClient
+        :param measurement: measurement name, if points is a DataFrame
+        :param tag_columns: columns of the DataFrame written as tags
+        :param batch_size: ignored, one transaction per call
+        :param retention_policy: written to table <policy>.<measurement>
+        """
+        pandas = sys.modules.get('pandas')  # no DataFrame without pandas
+        if pandas is not None and isinstance(points, pandas.DataFrame):
+            points = self.frame_to_points(points, measurement,
+                                          kwargs.get('tag_columns'))
+        groups = {}
+        for point in points:
+            table = self.table_name(point['measurement'], retention_policy)
+            fields = point['fields']
+            if not fields:
+                continue
+            key = (table, tuple(sorted(fields)))
+            tags = point.get('tags')
+            groups.setdefault(key, []).append(
+                [to_ns(point['time']), self.encode_tags(tags)]
+                + [fields[field] for field in key[1]])
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                for (table, fields), rows in groups.items():
+                    self.ensure_columns(table, fields)
+                    names = ', '.join(quote(field) for field in fields)
+                    updates = ', '.join('{0} = excluded.{0}'.format(quote(field))
+                                        for field in fields)
+                    self.connection.executemany(
+                        'INSERT INTO {} (time, tags, {}) VALUES ({}) '
+                        'ON CONFLICT (time, tags) DO UPDATE SET {}'.format(
+                            quote(table), names,
+                            ', '.join('?' * (len(fields) + 2)), updates),
+                        rows)
+        return True
+
+    @staticmethod
+    def frame_to_points(frame, measurement, tag_columns=None):
+        times = frame.index.tz_localize(None) if frame.index.tz is not None \
+            else frame.index
+        times = times.asi8
+        tag_columns = set(tag_columns or ())
+        records = frame.to_dict('records')
+        return [{'measurement': measurement, 'time': int(timestamp),
+                 'tags': {tag: str(record[tag]) for tag in sorted(tag_columns)
+                          if record[tag] == record[tag]},
+                 'fields': {field: value for field, value in record.items()
+                            if field not in tag_columns
+                            and value == value}}  # skip NaN
+                for timestamp, record in zip(times, records)]
+
+    @staticmethod
+    def encode_tags(tags):
+        return json.dumps(tags, sort_keys=True) if tags else ''
+
+    def select(self, table, where, params, order='ASC', limit=None,
+               tags=None):
+        import pandas as pd
+        if self.table_columns(table) is None:
+            return pd.DataFrame()
+        if tags is not None:  # one series
+            where += ' AND tags = ?'
+            params += (self.encode_tags(tags),)
+        sql = 'SELECT * FROM {} WHERE {} ORDER BY time {}'.format(
+            quote(table), where, order)
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        with self.lock:
+            frame = pd.read_sql_query(sql, self.connection, params=params)
+        return self.expand_tags(frame)
+
+    @staticmethod
+    def expand_tags(frame):
+        """ replace the tags column by one column per tag, as InfluxDB does """
+        import pandas as pd
+        if frame.empty or not frame['tags'].any():
+            return frame.drop(columns='tags')
+        tags = pd.DataFrame([json.loads(tags) if tags else {}
+                             for tags in frame['tags']], index=frame.index)
+        frame = frame.drop(columns='tags')
+        return pd.concat([frame, tags], axis=1)
+
+    def series(self, measurement):
+        """ :return: list of the tag dictionaries of the series """
+        if self.table_columns(measurement) is None:
+            return []
+        with self.lock:
+            rows = self.connection.execute('SELECT DISTINCT tags FROM {} '
+                                           'ORDER BY tags'.format(
+                                               quote(measurement))).fetchall()
+        return [json.loads(row[0]) if row[0] else {} for row in rows]
+
+    def query_range(self, measurement, start, end, tags=None):
+        """
+        all rows with start <= time < end, as DataFrame, of the series with
+        the tag dictionary tags or of all series
+        """
+        return self.select(measurement, 'time >= ? AND time < ?',
+                           (start, end), tags=tags)
+
+    def query_before(self, measurement, timestamp, limit=1, tags=None):
+        """ the last rows before timestamp, in ascending time order """
+        rows = self.select(measurement, 'time < ?', (timestamp,),
+                           order='DESC', limit=limit, tags=tags)
+        return rows.iloc[::-1].reset_index(drop=True)
+
+    def query_first(self, measurement, since=0, limit=1, tags=None):
+        """ the first rows at or after since """
+        return self.select(measurement, 'time >= ?', (since,), limit=limit,
+                           tags=tags)
+
+    def query_aggregate(self, measurement, start, end, interval,
+                        statistics=('mean', 'min', 'max')):
+        """
+        Aggregates per time bucket, computed in SQLite.
+
+        :param interval: bucket width in ns
+        :param statistics: subset of AGGREGATES
+        :return: DataFrame with column time (bucket start) and columns
+        <statistic>_<field>
+        """
+        import pandas as pd
+        columns = self.table_columns(measurement)
+        if columns is None:
+            return pd.DataFrame()
+        selects = ['{}({}) AS {}'.format(AGGREGATES[name], quote(field),
+                                         quote('{}_{}'.format(name, field)))
+                   for name in statistics for field in sorted(columns)]
+        sql = 'SELECT (time / {0:d}) * {0:d} AS time, {1} FROM {2} ' \
+              'WHERE time >= ? AND time < ? GROUP BY time / {0:d} ' \
+              'ORDER BY time'.format(interval, ', '.join(selects),
+                                     quote(measurement))
+        with self.lock:
+            return pd.read_sql_query(sql, self.connection, params=(start, end))
+
+    def delete_before(self, table, timestamp):
+        """ expire the rows older than timestamp (ns) """
+        if self.table_columns(table) is None:
+            return 0
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute(
+                    'DELETE FROM {} WHERE time < ?'.format(quote(table)),
+                    (timestamp,))
+        my_logger.info('expired {} rows of {}'.format(cursor.rowcount, table))
+        return cursor.rowcount
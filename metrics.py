@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Performance metrics of acquisition and database writes: counters, gauges
+and histograms, exposed in Prometheus text format on a local HTTP endpoint
+and optionally written to the database as a self-monitoring measurement.
+"""
+
+import bisect
+import logging
+import re
+import threading
+
+my_logger = logging.getLogger('MyLogger')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Metric:
+    """
+    Base class of the metric types. A metric with label names holds one
+    series per combination of label values, see labels().
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        """
+        :param name: metric name, e.g. pmmonitor_command_seconds
+        :param documentation: help text
+        :param labelnames: names of the labels telling the series apart
+        :param registry: Registry to add the metric to, REGISTRY if None
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        """
+        :param values: label values, in the order of labelnames
+        :return: the series for these label values
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(
+                self.name, ', '.join(self.labelnames)))
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.new_series()
+                self.series[values] = series
+        return series
+
+    def default(self):
+        """ the only series of a metric without labels """
+        return self.labels()
+
+    def new_series(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """
+        :return: list of (suffix, label values, label names, value) tuples
+        """
+        with self.lock:
+            items = sorted(self.series.items())
+        samples = []
+        for values, series in items:
+            for suffix, extra_names, extra_values, value in series.samples():
+                samples.append((suffix, values + extra_values,
+                                self.labelnames + extra_names, value))
+        return samples
+
+
+class CounterValue:
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [('_total', (), (), self.value)]
+
+
+class GaugeValue(CounterValue):
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        return [('', (), (), self.value)]
+
+
+class HistogramValue:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[pos] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            samples.append(('_bucket', ('le',), (le,), cumulative))
+        samples.append(('_sum', (), (), total))
+        samples.append(('_count', (), (), cumulative))
+        return samples
+
+
+class Counter(Metric):
+    """ monotonically increasing count, e.g. of errors """
+
+    kind = 'counter'
+
+    def new_series(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+
+class Gauge(Metric):
+    """ value that goes up and down, e.g. a backlog """
+
+    kind = 'gauge'
+
+    def new_series(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.default().set(value)
+
+    def inc(self, amount=1):
+        self.default().inc(amount)
+
+
+class Histogram(Metric):
+    """ distribution of observed values in cumulative buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, ascending
+        """
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_series(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default().observe(value)
+
+
+class Registry:
+    """ collection of metrics rendered together """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            name = metric.name
+            if metric.kind == 'counter' and name.endswith('_total'):
+                name = name[:-len('_total')]
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for suffix, values, labelnames, value in metric.samples():
+                labels = ','.join('{}="{}"'.format(label, escape(val))
+                                  for label, val in zip(labelnames, values))
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, '{' + labels + '}' if labels else '',
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def fields(self):
+        """
+        :return: dictionary of the counter and gauge values and histogram
+        sums and counts, one field per series, e.g. for a database point
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        fields = {}
+        for metric in metrics:
+            name = metric.name
+            if metric.kind == 'counter' and name.endswith('_total'):
+                name = name[:-len('_total')]
+            for suffix, values, labelnames, value in metric.samples():
+                if suffix == '_bucket':
+                    continue
+                key = '_'.join((name + suffix,) + values)
+                fields[re.sub(r'[^A-Za-z0-9_]', '_', key)] = float(value)
+        return fields
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = Histogram(
+    'pmmonitor_command_seconds', 'SHDLC command round trip time in seconds',
+    ['command'])
+FRAME_ERRORS = Counter(
+    'pmmonitor_frame_errors_total', 'Broken or missing SHDLC response frames',
+    ['command'])
+STATE_ERRORS = Counter(
+    'pmmonitor_state_errors_total', 'Error states reported by the SPS30',
+    ['command', 'code'])
+SAMPLE_SECONDS = Histogram(
+    'pmmonitor_sample_seconds', 'Duration of a sensor reading in seconds',
+    ['sensor'])
+SAMPLE_FAILURES = Counter(
+    'pmmonitor_sample_failures_total', 'Sensor readings without valid values',
+    ['sensor'])
+SAMPLE_REJECTED = Counter(
+    'pmmonitor_sample_rejected_total',
+    'Sensor readings with values outside the sensor range', ['sensor'])
+SAMPLE_STALE = Counter(
+    'pmmonitor_sample_stale_total',
+    'Samples served from the last valid reading', ['sensor'])
+DB_WRITE_SECONDS = Histogram(
+    'pmmonitor_db_write_seconds', 'Duration of a database write in seconds')
+DB_BATCH_POINTS = Histogram(
+    'pmmonitor_db_batch_points', 'Points per database write',
+    buckets=SIZE_BUCKETS)
+DB_WRITE_ERRORS = Counter(
+    'pmmonitor_db_write_errors_total', 'Failed database writes', ['kind'])
+SPOOL_BACKLOG = Gauge(
+    'pmmonitor_spool_batches', 'Batches waiting in the spool')
+DEADBAND_SUPPRESSED = Counter(
+    'pmmonitor_deadband_suppressed_total',
+    'Points not written as no field left its deadband', ['measurement'])
+COLLECTOR_BATCHES = Counter(
+    'pmmonitor_collector_batches_total',
+    'Batches pushed to the collector, by result', ['result'])
+COLLECTOR_BACKLOG = Gauge(
+    'pmmonitor_collector_backlog_lines',
+    'Lines queued in the collector for the database')
+SAMPLING_INTERVAL = Gauge(
+    'pmmonitor_sampling_interval_seconds',
+    'Seconds between samples chosen by adaptive sampling', ['sensor'])
+SAMPLING_MODE_CHANGES = Counter(
+    'pmmonitor_sampling_mode_changes_total',
+    'Switches of adaptive sampling to a mode', ['sensor', 'mode'])
+SENSOR_MEASURING = Gauge(
+    'pmmonitor_sensor_measuring',
+    '1 while an adaptive sensor measures, 0 while stopped between samples',
+    ['sensor'])
+
+
+def make_handler(registry):
+    """
+    :return: request handler class serving the registry, defined on use as
+    http.server is only imported with the server
+    """
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; '
+                                             'charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes are not worth a log line each
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    """ serve the registry on http://<address>:<port>/metrics """
+
+    def __init__(self, address='127.0.0.1', port=9108, registry=REGISTRY):
+        import http.server
+        self.server = http.server.ThreadingHTTPServer((address, port),
+                                                      make_handler(registry))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='MetricsServer', daemon=True)
+        self.thread.start()
+        my_logger.info('serving metrics on port {}'.format(self.port))
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
@@ -3,32 +3,85 @@
 
 
 import argparse
-import yaml
+import atexit
+import collections
+import concurrent.futures
+import functools
+import signal
+import threading
 import platform
 import time
-import serial
 import logging.handlers
+import queue
 import struct
-import requests
-from influxdb import InfluxDBClient
-import datetime
-import Adafruit_DHT
+
+import metrics
+from devicecache import DeviceCache
+from sensors import SensorDriver, SensorScheduler
+
+# The serial port, sensor libraries, database backends and output stages are
+# imported where they are used, so a run imports only what it needs and
+# importing this module has no side effects, see tests/test_imports.py.
+
+
+# subsystem loggers, levels configurable in section logging of the
+# configuration file
+transport_logger = logging.getLogger('MyLogger.transport')
+sensor_logger = logging.getLogger('MyLogger.sensor')
+database_logger = logging.getLogger('MyLogger.database')
+# raw SHDLC frames in hex, opt-in with logging.trace
+trace_logger = logging.getLogger('MyLogger.trace')
+LOG_SUBSYSTEMS = ('transport', 'sensor', 'database', 'trace')
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler leaving the formatting of records to the listener thread,
+    so logging costs the sampling threads little more than a queue put.
+    Records are passed within the process, the message arguments need not
+    be pickled or merged beforehand.
+    """
+
+    def prepare(self, record):
+        return record
 
 
 # noinspection SpellCheckingInspection
 def set_up_logging():
-    # set up logging, rotating log file, max. file size 100 MBytes
+    # set up logging, rotating log file, max. file size 100 MBytes, written by
+    # a background thread
     my_logger = logging.getLogger('MyLogger')
     my_logger.setLevel(logging.DEBUG)
+    trace_logger.setLevel(logging.WARNING)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s')
     handler = logging.handlers.RotatingFileHandler('airmonitor.log',
                                                    maxBytes=104857600,
                                                    backupCount=1)
     handler.setFormatter(formatter)
-    my_logger.addHandler(handler)
+    log_queue = queue.Queue()
+    my_logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # write the queued records on exit
     return my_logger
 
 
+def configure_logging(cfg):
+    """
+    Set the log levels from section logging of the configuration file.
+
+    :param cfg: configuration dictionary
+    """
+    log_cfg = cfg.get('logging', {})
+    my_logger.setLevel(log_cfg.get('level', 'DEBUG').upper())
+    for subsystem in LOG_SUBSYSTEMS:
+        level = log_cfg.get(subsystem)
+        if subsystem == 'trace' and isinstance(level, bool):
+            level = 'DEBUG' if level else 'WARNING'
+        if level is not None:
+            logging.getLogger('MyLogger.' + subsystem).setLevel(level.upper())
+
+
 class MISOFrameError(Exception):
     pass
 
@@ -37,85 +90,330 @@ class StateValidationError(Exception):
     pass
 
 
+# SHDLC frame layer constants, see "Datasheet SPS30 Particulate Matter Sensor
+# for Air Quality Monitoring and Control", section "4.1 SHDLC Frame Layer"
+FRAME_BOUNDARY = 0x7e
+FRAME_ESCAPE = 0x7d
+FRAME_MIN_LENGTH = 7  # start, address, command, state, length, check, stop
+# longest possible frame: 255 data bytes, every content byte stuffed
+FRAME_MAX_LENGTH = 2 + 2 * (4 + 255 + 1)
+# serial read timeout, bounds how far a frame read overshoots its deadline
+READ_POLL_TIMEOUT = 0.05
+VALID_STATES = (0x00, 0x01, 0x02, 0x03, 0x04, 0x28, 0x43)
+STATE_ERRORS = {
+    0x01: 'Wrong data length for this command(too much or little data)',
+    0x02: 'Unknown command',
+    0x03: 'No access right for command',
+    0x04: 'Illegal command parameter or parameter out of allowed range',
+    0x28: 'Internal function argument out of range',
+    0x43: 'Command not allowed in current state',
+}
+# Byte-stuffing table. The escape byte 0x7d must be replaced first, otherwise
+# the escape bytes inserted for the other characters would be stuffed again.
+STUFFING_TABLE = (
+    (b'\x7d', b'\x7d\x5d'),
+    (b'\x7e', b'\x7d\x5e'),
+    (b'\x11', b'\x7d\x31'),
+    (b'\x13', b'\x7d\x33'),
+)
+STUFFED_BYTES = b''.join(byte for byte, _ in STUFFING_TABLE)
+UNSTUFFING_TABLE = {seq[1]: byte[0] for byte, seq in STUFFING_TABLE}
+
+
+class FrameReader:
+    """
+    Incremental SHDLC frame assembly from a serial stream.
+
+    Bytes are read as they arrive and a frame is returned as soon as its
+    closing 0x7e has been received, instead of waiting for a fixed number of
+    bytes or the serial timeout. Bytes received after the end of a frame stay
+    in the buffer for the next frame. Garbage before a frame start is dropped.
+    """
+
+    def __init__(self, port, timeout=1.5, max_frame_length=FRAME_MAX_LENGTH):
+        self.port = port
+        self.timeout = timeout
+        self.max_frame_length = max_frame_length
+        self.buffer = bytearray()
+
+    def read_frame(self, timeout=None):
+        """
+        Read the next complete frame from the serial stream.
+
+        :param timeout: seconds to wait for the frame, defaults to the
+        reader timeout
+        :return: the frame as bytes, including start and stop byte
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        if self.port.timeout != READ_POLL_TIMEOUT:
+            # once, every change reconfigures the serial port
+            self.port.timeout = READ_POLL_TIMEOUT
+        while True:
+            frame = self.extract_frame()
+            if frame is not None:
+                return frame
+            if time.monotonic() >= deadline:
+                err_msg = 'MISO frame incomplete after {} s. ' \
+                          'Received: \'{}\''.format(timeout,
+                                                   self.buffer.hex())
+                self.buffer.clear()
+                raise MISOFrameError(err_msg)
+            # read whatever is waiting, or block for one byte for at most
+            # the poll timeout and check the deadline again
+            chunk = self.port.read(max(1, self.port.in_waiting))
+            self.buffer += chunk
+
+    def extract_frame(self):
+        """
+        Take the first complete frame out of the buffer.
+
+        :return: the frame as bytes or None if no complete frame is buffered
+        """
+        buffer = self.buffer
+        start = buffer.find(b'\x7e')
+        if start < 0:
+            buffer.clear()  # no frame start, nothing worth keeping
+            return None
+        del buffer[:start]
+        while True:
+            end = buffer.find(b'\x7e', 1)
+            if end < 0:
+                if len(buffer) > self.max_frame_length:
+                    transport_logger.warning('dropping %d bytes without frame '
+                                             'end', len(buffer))
+                    buffer.clear()
+                return None
+            if end == 1:
+                # stop byte of a frame we missed followed by a start byte
+                del buffer[:1]
+                continue
+            frame = bytes(buffer[:end + 1])
+            del buffer[:end + 1]
+            return frame
+
+    def reset(self):
+        self.buffer.clear()
+
+
 class SHDLC:
-    def __init__(self):
-        self.valid_states = ['0x0', '0x1', '0x2', '0x3', '0x4', '0x28', '0x43']
+    def __init__(self, port=None, device='/dev/serial0'):
+        """
+        :param port: an open serial port or serial-like object to use instead
+        of opening the sensor port, e.g. for tests
+        :param device: the serial device the sensor is connected to
+        """
+        self.valid_states = [hex(state) for state in VALID_STATES]
         self.last_cmd = None
-        self.buffer_size = 64
-        self.port = None
-        if platform.system() == 'Linux':
+        self.timeout = 1.5
+        self.device = device
+        self.port = port
+        self.reader = FrameReader(port, timeout=self.timeout)
+        if port is None and platform.system() == 'Linux':
             self.open_serial_port()
 
     def open_serial_port(self):
-        self.port = serial.Serial('/dev/serial0',
+        import serial
+        self.port = serial.Serial(self.device,
                                   baudrate=115200,
                                   parity=serial.PARITY_NONE,
                                   stopbits=serial.STOPBITS_ONE,
                                   bytesize=serial.EIGHTBITS,
-                                  timeout=1.5)
+                                  timeout=self.timeout)
         if self.port.isOpen():
             self.port.close()
         self.port.open()
+        self.reader.port = self.port
+        self.reader.reset()
 
     def close_serial_port(self):
         self.port.close()
 
-    def send_command(self, cmd, data):
-        mosi_frame = build_mosi_frame(cmd, data)
-        my_logger.info('sending MOSI frame: {}'.format(mosi_frame))
-        mosi_frame = ''.join(['{:02x}'.format(int(byte, 0))
-                              for byte in mosi_frame])
-        mosi_frame = bytes.fromhex(mosi_frame)
+    def flush_input(self):
+        """ drop partial and late frames, e.g. before repeating a command """
+        self.reader.reset()
+        if hasattr(self.port, 'reset_input_buffer'):
+            self.port.reset_input_buffer()
+
+    def send_command(self, cmd, data=b''):
+        mosi_frame = encode_mosi_frame(cmd, data)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug('sending MOSI frame to %s: %s', self.device,
+                               mosi_frame.hex())
         self.port.write(mosi_frame)
         self.last_cmd = cmd
 
-    def get_response(self):
-        data = self.port.read(self.buffer_size)
-        miso_frame = [hex(data[pos]) for pos in range(len(data))]
-        my_logger.info('received MISO frame: {}'.format(miso_frame))
-        self.validate_miso_frame(miso_frame)
-        check_state(miso_frame)
-        payload = miso_frame[5:-2]
+    def get_response(self, timeout=None):
+        data = self.reader.read_frame(timeout)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug('received MISO frame from %s: %s', self.device,
+                               data.hex())
+        state, payload = decode_miso_frame(data, self.last_cmd)
+        check_state_code(state)
         return payload
 
     def validate_miso_frame(self, miso_frame):
-        miso_frame = byte_unstuffing(miso_frame)
-        miso_frame_int = [int(byte, 16) for byte in miso_frame]
-        chk = calculate_checksum(miso_frame_int[1:-2])
-        if not miso_frame[0] == '0x7e':  # start
-            err_msg = 'MISO frame start byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(0, '0x7e', miso_frame[0])
-            raise MISOFrameError(err_msg)
-        elif not miso_frame[1] == '0x0':  # address
-            err_msg = 'MISO frame address byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(1, '0x0', miso_frame[1])
-            raise MISOFrameError(err_msg)
-        elif not miso_frame[2] == self.last_cmd:  # command
-            err_msg = 'MISO frame command byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(2, self.last_cmd, miso_frame[2])
-            raise MISOFrameError(err_msg)
-        elif not miso_frame[3] in self.valid_states:  # state
-            txt = ', '.join(self.valid_states)
-            err_msg = 'MISO frame state byte {} invalid. Expected one of: \'[{}]\'. ' \
-                      'Received: \'{}\''.format(3, txt, miso_frame[3])
-            raise MISOFrameError(err_msg)
-        elif not int(miso_frame[4], 16) == len(miso_frame[5:-2]):  # length
-            err_msg = 'MISO frame length byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(4, len(miso_frame[5:-2]),
-                                                miso_frame_int[4])
-            raise MISOFrameError(err_msg)
-        elif not miso_frame_int[-2] == chk:  # checksum
-            err_msg = 'MISO frame checksum byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(len(miso_frame) - 2,
-                                                hex(chk),
-                                                hex(miso_frame_int[-2]))
-            raise MISOFrameError(err_msg)
-        elif not miso_frame[-1] == '0x7e':  # end
-            err_msg = 'MISO frame stop byte {} invalid. Expected: \'{}\'. ' \
-                      'Received: \'{}\''.format(len(miso_frame) - 1, '0x7e',
-                                                miso_frame[-1])
-            raise MISOFrameError(err_msg)
-        return
+        """
+        Validate a MISO frame given as list of hex values in string format.
+
+        Compatibility wrapper around decode_miso_frame().
+
+        :param miso_frame: the frame a list of hex values in string format
+        """
+        decode_miso_frame(hex_list_to_bytes(miso_frame), self.last_cmd)
+
+
+def hex_list_to_bytes(frame):
+    """
+    Convert a frame given as list of hex values in string format to bytes.
+
+    :param frame: the frame a list of hex values in string format, e.g.
+    ['0x7e', '0x0', ...]
+    :return: the frame as bytes
+    """
+    return bytes([int(byte, 16) for byte in frame])
+
+
+def bytes_to_hex_list(frame):
+    """
+    Convert a frame given as bytes to a list of hex values in string format.
+
+    :param frame: the frame as bytes, bytearray or memoryview
+    :return: the frame a list of hex values in string format, e.g.
+    ['0x7e', '0x0', ...]
+    """
+    return [hex(byte) for byte in frame]
+
+
+def command_to_int(command):
+    """
+    Return the command byte as int. Commands may be given as int or in the
+    legacy hex string notation, e.g. '0x80'.
+    """
+    if isinstance(command, str):
+        return int(command, 16)
+    return command
+
+
+def encode_mosi_frame(command, data=b''):
+    """
+    Build the byte-stuffed MOSI frame according to specification "Datasheet
+    SPS30 Particulate Matter Sensor for Air Quality Monitoring and Control",
+    section "4.1 SHDLC Frame Layer"
+
+    :param command: the UART / SHDLC command byte as int
+    :param data: the command data as bytes-like object
+    :return: the MOSI frame as bytes
+    """
+    content = bytearray((0x00, command_to_int(command), len(data)))
+    content += data
+    content.append(calculate_checksum(content))
+    return b'\x7e' + stuff_bytes(content) + b'\x7e'
+
+
+def encode_miso_frame(command, state=0x00, payload=b''):
+    """
+    Build the byte-stuffed MISO frame the sensor answers a command with, the
+    counterpart of decode_miso_frame(), e.g. for simulating the sensor.
+
+    :param command: the command byte the frame is a response to
+    :param state: the state byte as int
+    :param payload: the response data as bytes-like object
+    :return: the MISO frame as bytes
+    """
+    content = bytearray((0x00, command_to_int(command), state, len(payload)))
+    content += payload
+    content.append(calculate_checksum(content))
+    return b'\x7e' + stuff_bytes(content) + b'\x7e'
+
+
+def decode_miso_frame(frame, command):
+    """
+    Reverse byte-stuffing and validate a MISO frame.
+
+    :param frame: the received frame as bytes-like object, including start
+    and stop byte
+    :param command: the command byte the frame is a response to
+    :return: tuple (state, payload), state as int and payload as bytes
+    """
+    frame = unstuff_bytes(frame)
+    if len(frame) < FRAME_MIN_LENGTH:
+        err_msg = 'MISO frame too short. Expected at least {} bytes. ' \
+                  'Received: \'{}\''.format(FRAME_MIN_LENGTH, frame.hex())
+        raise MISOFrameError(err_msg)
+    command = command_to_int(command)
+    chk = calculate_checksum(memoryview(frame)[1:-2])
+    if not frame[0] == FRAME_BOUNDARY:  # start
+        err_msg = 'MISO frame start byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(0, '0x7e', hex(frame[0]))
+        raise MISOFrameError(err_msg)
+    elif not frame[1] == 0x00:  # address
+        err_msg = 'MISO frame address byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(1, '0x0', hex(frame[1]))
+        raise MISOFrameError(err_msg)
+    elif not frame[2] == command:  # command
+        err_msg = 'MISO frame command byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(2, hex(command), hex(frame[2]))
+        raise MISOFrameError(err_msg)
+    elif not frame[3] in VALID_STATES:  # state
+        txt = ', '.join([hex(state) for state in VALID_STATES])
+        err_msg = 'MISO frame state byte {} invalid. Expected one of: \'[{}]\'. ' \
+                  'Received: \'{}\''.format(3, txt, hex(frame[3]))
+        raise MISOFrameError(err_msg)
+    elif not frame[4] == len(frame) - FRAME_MIN_LENGTH:  # length
+        err_msg = 'MISO frame length byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(4, len(frame) - FRAME_MIN_LENGTH,
+                                            frame[4])
+        raise MISOFrameError(err_msg)
+    elif not frame[-2] == chk:  # checksum
+        err_msg = 'MISO frame checksum byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(len(frame) - 2, hex(chk),
+                                            hex(frame[-2]))
+        raise MISOFrameError(err_msg)
+    elif not frame[-1] == FRAME_BOUNDARY:  # end
+        err_msg = 'MISO frame stop byte {} invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(len(frame) - 1, '0x7e',
+                                            hex(frame[-1]))
+        raise MISOFrameError(err_msg)
+    return frame[3], frame[5:-2]
+
+
+def stuff_bytes(content):
+    """
+    Do byte-stuffing on the frame content (without start and stop byte).
+
+    :param content: the frame content as bytes-like object
+    :return: the 'byte stuffed' content as bytes
+    """
+    content = bytes(content)
+    if len(content.translate(None, STUFFED_BYTES)) == len(content):
+        return content  # nothing to stuff, the common case
+    for byte, seq in STUFFING_TABLE:
+        content = content.replace(byte, seq)
+    return content
+
+
+def unstuff_bytes(frame):
+    """
+    Reverse byte-stuffing in a received frame in a single pass.
+
+    :param frame: the frame as bytes-like object
+    :return: the 'unstuffed' frame as bytes
+    """
+    frame = bytes(frame)
+    if FRAME_ESCAPE not in frame:
+        return frame  # nothing to unstuff, the common case
+    parts = frame.split(b'\x7d')
+    unstuffed = bytearray(parts[0])
+    for part in parts[1:]:
+        if part and part[0] in UNSTUFFING_TABLE:
+            unstuffed.append(UNSTUFFING_TABLE[part[0]])
+            unstuffed += memoryview(part)[1:]
+        else:  # not an escape sequence, keep the byte as received
+            unstuffed.append(FRAME_ESCAPE)
+            unstuffed += part
+    return bytes(unstuffed)
 
 
 def build_mosi_frame(command, data=''):
@@ -124,40 +422,28 @@ def build_mosi_frame(command, data=''):
     Particulate Matter Sensor for Air Quality Monitoring and Control",
     section "4.1 SHDLC Frame Layer"
 
+    Compatibility wrapper around encode_mosi_frame().
+
     :param command: the UART / SHDLC command. See also "Datasheet SPS30
     Particulate Matter Sensor for Air Quality Monitoring and Control",
     section "4.2 UART / SHDLC Commands"
     :param data: the command data
     :return: the MOSI frame as string of bytes in hex notation
     """
-    frame = ['0x7e', '0x0', command, '0x{:x}'.format(len(data))]
-    frame.extend(data)  # TX data
-    check = calculate_checksum([int(frame[1], 16), int(frame[2], 16),
-                                int(frame[3], 16)] + [int(byte, 16)
-                                                      for byte in data])
-    check = '0x{:x}'.format(check)
-    frame.append(check)  # check
-    frame.append('0x7e')  # stop
-    frame = [byte for byte in frame]
-    frame = byte_stuffing(frame)
-    return frame
+    return bytes_to_hex_list(encode_mosi_frame(command,
+                                               hex_list_to_bytes(data)))
 
 
 def calculate_checksum(data):
     """
     Calculate frame checksum.
 
-    :param data: list of frame content bytes in int format
+    :param data: frame content bytes as bytes-like object or list of int
     :return: checksum as int
     """
-
-    # Sum all bytes between start and stop (without start and stop bytes).
-    checksum = sum(data)
-    # Take the LSB of the result ...
-    checksum = checksum & 0xFF
-    # ... and invert it. This will be the checksum.
-    checksum = ~checksum & 0xFF
-    return checksum
+    # Sum all bytes between start and stop (without start and stop bytes),
+    # take the LSB of the result and invert it.
+    return ~sum(data) & 0xFF
 
 
 def byte_stuffing(frame):
@@ -169,23 +455,13 @@ def byte_stuffing(frame):
     the frame, it must be replaced by two other bytes (byte-stuffing).
     This also applies to the characters 0x7D, 0x11 and 0x13.
 
+    Compatibility wrapper around stuff_bytes().
+
     :param frame: the frame a list of hex values in string format
     :return: new 'byte stuffed' frame
     """
-    stuffing = {
-        '0x7e': ['0x7d', '0x5e'],
-        '0x7d': ['0x7d', '0x5d'],
-        '0x11': ['0x7d', '0x31'],
-        '0x13': ['0x7d', '0x33'],
-    }
-    new_frame = [frame[0]]
-    for index, byte in enumerate(frame[1:-1]):
-        if byte in stuffing.keys():
-            new_frame.extend(stuffing[byte])
-        else:
-            new_frame.append(byte)
-    new_frame.append(frame[-1])  # add end frame
-    return new_frame
+    content = stuff_bytes(hex_list_to_bytes(frame[1:-1]))
+    return [frame[0]] + bytes_to_hex_list(content) + [frame[-1]]
 
 
 def byte_unstuffing(frame):
@@ -197,169 +473,788 @@ def byte_unstuffing(frame):
     the frame, it must be replaced by two other bytes (byte-stuffing).
     This also applies to the characters 0x7D, 0x11 and 0x13.
 
+    Compatibility wrapper around unstuff_bytes().
+
     :param frame: the frame a list of hex values in string format
     :return: new 'byte stuffed' frame
     """
-    unstuffing = {
-        ('0x7d', '0x5e'): '0x7e',
-        ('0x7d', '0x5d'): '0x7d',
-        ('0x7d', '0x31'): '0x11',
-        ('0x7d', '0x33'): '0x13',
-    }
-    ptr = 0
-    key_len = len(list(unstuffing.keys())[0])
-    while ptr < len(frame):
-        seq = tuple(frame[ptr:ptr + key_len])
-        if seq in unstuffing.keys():
-            frame[ptr:ptr + key_len] = [unstuffing[seq]]
-        ptr += 1
-    return frame
+    return bytes_to_hex_list(unstuff_bytes(hex_list_to_bytes(frame)))
 
 
 def check_state(miso_frame):
-    state_errors = {
-        '0x1': 'Wrong data length for this command(too much or little data)',
-        '0x2': 'Unknown command',
-        '0x3': 'No access right for command',
-        '0x4': 'Illegal command parameter or parameter out of allowed range',
-        '0x28': 'Internal function argument out of range',
-        '0x43': 'Command not allowed in current state',
-    }
-    if miso_frame[3] in state_errors.keys():
-        raise StateValidationError(state_errors[miso_frame[3]], int(miso_frame[3], 0))
-    pass
+    """
+    Compatibility wrapper around check_state_code().
+
+    :param miso_frame: the frame a list of hex values in string format
+    """
+    check_state_code(int(miso_frame[3], 16))
+
+
+def check_state_code(state):
+    if state in STATE_ERRORS:
+        raise StateValidationError(STATE_ERRORS[state], state)
+
+
+# Read Measured Values payload, see "Datasheet SPS30 Particulate Matter
+# Sensor for Air Quality Monitoring and Control", section "4.3.3 Read
+# Measured Values"
+MEASURED_VALUES_FIELDS = (
+    'mass_concentration_PM1_0',
+    'mass_concentration_PM2_5',
+    'mass_concentration_PM4_0',
+    'mass_concentration_PM10',
+    'number_concentration_PM0_5',
+    'number_concentration_PM1_0',
+    'number_concentration_PM2_5',
+    'number_concentration_PM4_0',
+    'number_concentration_PM10',
+    'typical_particle_size',
+)
+MeasuredValues = collections.namedtuple('MeasuredValues',
+                                        MEASURED_VALUES_FIELDS)
+OUTPUT_FORMAT_FLOAT = 0x03  # big-endian IEEE754 float values
+OUTPUT_FORMAT_INTEGER = 0x05  # big-endian unsigned 16-bit integer values
+OUTPUT_FORMATS = {
+    'float': OUTPUT_FORMAT_FLOAT,
+    'integer': OUTPUT_FORMAT_INTEGER,
+}
+MEASURED_VALUES_STRUCTS = {
+    OUTPUT_FORMAT_FLOAT: struct.Struct('>10f'),
+    OUTPUT_FORMAT_INTEGER: struct.Struct('>10H'),
+}
+
+
+def decode_measured_values(payload, output_format=OUTPUT_FORMAT_FLOAT):
+    """
+    Decode the Read Measured Values payload in a single unpack call.
+
+    In integer format the typical particle size is sent in nm. It is
+    converted to um, the unit of the float format, so both formats can be
+    written to the same database fields.
+
+    :param payload: the response payload as bytes-like object
+    :param output_format: OUTPUT_FORMAT_FLOAT or OUTPUT_FORMAT_INTEGER, as
+    sent with the start measurement command
+    :return: MeasuredValues record
+    """
+    values_struct = MEASURED_VALUES_STRUCTS[output_format]
+    if len(payload) != values_struct.size:
+        err_msg = 'measured values payload length invalid. Expected: \'{}\'. ' \
+                  'Received: \'{}\''.format(values_struct.size, len(payload))
+        raise MISOFrameError(err_msg)
+    values = values_struct.unpack(payload)
+    if output_format == OUTPUT_FORMAT_INTEGER:
+        values = values[:-1] + (values[-1] / 1000,)
+    return MeasuredValues._make(values)
 
 
 class Commands:
     def __init__(self):
-        self.start_measurement = '0x0'
-        self.stop_measurement = '0x1'
-        self.read_measured_values = '0x3'
-        self.read_auto_cleaning_interval = '0x80'
-        self.write_auto_cleaning_interval = '0x80'
-        self.start_fan_cleaning = '0x56'
-        self.device_information = '0xd0'
-        self.device_reset = '0xd3'
+        self.start_measurement = 0x00
+        self.stop_measurement = 0x01
+        self.read_measured_values = 0x03
+        self.read_auto_cleaning_interval = 0x80
+        self.write_auto_cleaning_interval = 0x80
+        self.start_fan_cleaning = 0x56
+        self.device_information = 0xd0
+        self.device_reset = 0xd3
+
+
+# Seconds to wait for the response per command, well above the response
+# times of the sensor. A lost frame costs this much before it is repeated.
+COMMAND_TIMEOUTS = {
+    0x00: 0.5,
+    0x01: 0.5,
+    0x03: 0.5,
+    0x56: 0.5,
+    0x80: 0.5,
+    0xd0: 0.5,
+    0xd3: 1.5,
+}
 
 
 class SensirionSPS30:
-    def __init__(self):
-        self.shdlc = SHDLC()
+    def __init__(self, shdlc=None, output_format=OUTPUT_FORMAT_FLOAT,
+                 cache=None, retries=3, backoff=0.05, reset_delay=0.1,
+                 timeouts=COMMAND_TIMEOUTS):
+        """
+        :param shdlc: SHDLC transport, opens the sensor port if None
+        :param output_format: OUTPUT_FORMAT_FLOAT or OUTPUT_FORMAT_INTEGER
+        :param cache: DeviceCache for device information and auto cleaning
+        interval, always asks the sensor if None
+        :param retries: max. repetitions of a command after a broken or
+        missing response frame
+        :param backoff: seconds before the first repetition, doubled for
+        every further one
+        :param reset_delay: seconds the sensor needs after a device reset
+        :param timeouts: response timeout per command, commands not listed
+        use the SHDLC timeout
+        """
+        self.shdlc = shdlc if shdlc is not None else SHDLC()
         self.cmd = Commands()
+        self.output_format = output_format
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.reset_delay = reset_delay
+        self.timeouts = timeouts
+        self.lock = threading.Lock()
+        self.executor_lock = threading.Lock()  # not held during commands
+        self.executor = None
 
     def start_measurement(self):
-        data = ['0x1', '0x3']  # as per Sensirion SPS30 datasheet
-        my_logger.info('start measurement ...')
+        data = bytes((0x01, self.output_format))  # as per Sensirion SPS30 datasheet
+        sensor_logger.info('start measurement ...')
         rsp = self.send_receive(self.cmd.start_measurement, data)
         return rsp
 
     def stop_measurement(self):
-        data = []
-        my_logger.info('stop measurement ...')
+        data = b''
+        sensor_logger.info('stop measurement ...')
         rsp = self.send_receive(self.cmd.stop_measurement, data)
         return rsp
 
-    def read_measured_values(self):
-        data = []
-        my_logger.info('read measured values ...')
+    def read_measured_record(self):
+        """
+        :return: MeasuredValues record or None if no values are available
+        """
+        data = b''
+        sensor_logger.info('read measured values ...')
         rsp = self.send_receive(self.cmd.read_measured_values, data)
-        if rsp is not False and rsp != []:
-            hexstr = ['{:02x}'.format(int(byte[2:], 16)) for byte in rsp]
-            mvals = {
-                'mass_concentration_PM1_0': bytes_to_float(hexstr[0:4]),
-                'mass_concentration_PM2_5': bytes_to_float(hexstr[4:8]),
-                'mass_concentration_PM4_0': bytes_to_float(hexstr[8:12]),
-                'mass_concentration_PM10': bytes_to_float(hexstr[12:16]),
-                'number_concentration_PM0_5': bytes_to_float(hexstr[16:20]),
-                'number_concentration_PM1_0': bytes_to_float(hexstr[20:24]),
-                'number_concentration_PM2_5': bytes_to_float(hexstr[24:28]),
-                'number_concentration_PM4_0': bytes_to_float(hexstr[28:32]),
-                'number_concentration_PM10': bytes_to_float(hexstr[32:36]),
-                'typical_particle_size': bytes_to_float(hexstr[36:40]),
-                }
-        else:
-            mvals = {}
-        return mvals
+        if not rsp:
+            return None
+        return decode_measured_values(rsp, self.output_format)
+
+    def read_measured_values(self):
+        record = self.read_measured_record()
+        if record is None:
+            return {}
+        return record._asdict()
 
     def read_auto_cleaning_interval(self):
-        data = ['0x0']  # subcommand, must be '0x0'
-        my_logger.info('read auto cleaning interval ...')
+        """
+        :return: interval in seconds or None if the sensor reported an error
+        """
+        interval = self.cached('auto_cleaning_interval')
+        if interval is not None:
+            return interval
+        data = b'\x00'  # subcommand, must be 0x00
+        sensor_logger.info('read auto cleaning interval ...')
         rsp = self.send_receive(self.cmd.read_auto_cleaning_interval, data)
-        interval = int(''.join([byte[2:] for byte in rsp]), 16)
+        if not rsp:
+            return None
+        interval = int.from_bytes(rsp, 'big')
+        self.store('auto_cleaning_interval', interval)
         return interval
 
     def write_auto_cleaning_interval(self, interval):
-        data_hex = '{:08x}'.format(interval)
-        data = ['0x0']  # subcommand, must be '0x0'
-        data.extend(['0x' + data_hex[pos:pos + 2] for pos in range(0, len(data_hex), 2)])
-        my_logger.info('write auto cleaning interval ...')
+        data = b'\x00' + interval.to_bytes(4, 'big')  # subcommand 0x00 + interval
+        sensor_logger.info('write auto cleaning interval ...')
+        self.invalidate('auto_cleaning_interval')
         rsp = self.send_receive(self.cmd.write_auto_cleaning_interval, data)
         return rsp
 
     def start_fan_cleaning(self):
-        data = []
-        my_logger.info('start fan cleaning ...')
+        data = b''
+        sensor_logger.info('start fan cleaning ...')
         rsp = self.send_receive(self.cmd.start_fan_cleaning, data)
         return rsp
 
     def get_device_information(self):
+        dev_info_txt = self.cached('device_information')
+        if dev_info_txt is not None:
+            return dev_info_txt
         dev_info = {
-            'product_name': ['0x1'],
-            'article_code': ['0x2'],
-            'serial_number': ['0x3'],
+            'product_name': b'\x01',
+            'article_code': b'\x02',
+            'serial_number': b'\x03',
             }
         dev_info_txt = {}
         for info in dev_info:
-            my_logger.info('get device information for {} ...'.format(info))
+            sensor_logger.info('get device information for {} ...'.format(info))
             rsp = self.send_receive(self.cmd.device_information, dev_info[info])
-            dev_info_txt[info] = ''.join([chr(int(char, 0)) for char in rsp[:-1]])               
+            if rsp is False:
+                continue
+            dev_info_txt[info] = rsp[:-1].decode('ascii')
+        if len(dev_info_txt) == len(dev_info):
+            self.store('device_information', dev_info_txt)
         return dev_info_txt
 
     def device_reset(self):
-        data = []
-        my_logger.info('do device reset ...')
+        data = b''
+        sensor_logger.info('do device reset ...')
+        self.invalidate()
         rsp = self.send_receive(self.cmd.device_reset, data)
         return rsp
+
+    def cached(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.shdlc.device, key)
+
+    def store(self, key, value):
+        if self.cache is not None:
+            self.cache.set(self.shdlc.device, key, value)
+
+    def invalidate(self, key=None):
+        if self.cache is not None:
+            self.cache.invalidate(self.shdlc.device, key)
     
     def send_receive(self, cmd, data):
-        my_logger.info('sending command {} ...'.format(cmd))
+        """
+        Execute a command. Broken or missing response frames are retried,
+        state 0x43 "Command not allowed in current state" is recovered from
+        by restarting the measurement and, if that does not help, by a
+        device reset.
+
+        :return: the response payload as bytes or False if the sensor
+        reported an error
+        :raises MISOFrameError: if no valid response frame was received
+        after all retries
+        """
+        sensor_logger.info('sending command %#x ...', cmd)
+        with self.lock:
+            for recover in (None, self.recover_restart, self.recover_reset):
+                if recover is not None and not recover(cmd):
+                    break
+                try:
+                    rsp = self.transfer(cmd, data)
+                except StateValidationError as excinfo:
+                    err_msg, err_code = excinfo.args
+                    sensor_logger.error('command failed with error: '
+                                        '{}'.format(err_msg))
+                    if err_code != 0x43:
+                        break
+                else:
+                    sensor_logger.info('command completed successful')
+                    return rsp
+        return False
+
+    def transfer(self, cmd, data):
+        """ send a command and receive the response, retry broken frames """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.round_trip(cmd, data)
+            except MISOFrameError as excinfo:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                sensor_logger.warning('{}, retry {} of {} in {} s'.format(
+                    excinfo, attempt + 1, self.retries, delay))
+                time.sleep(delay)
+                self.shdlc.flush_input()
+
+    def round_trip(self, cmd, data):
+        """ send a command and receive the response, once """
+        label = '{:#04x}'.format(cmd)
+        start = time.perf_counter()
         self.shdlc.send_command(cmd, data)
         try:
-            rsp = self.shdlc.get_response()
+            return self.shdlc.get_response(self.timeouts.get(cmd))
         except StateValidationError as excinfo:
-            err_msg, err_code = excinfo.args
-            my_logger.error('command failed with error: {}'.format(err_msg))
-            rsp = False
-        else:
-            my_logger.info('command completed successful')
-        return rsp
+            metrics.STATE_ERRORS.labels(label, '{:#04x}'.format(
+                excinfo.args[1])).inc()
+            raise
+        except MISOFrameError:
+            metrics.FRAME_ERRORS.labels(label).inc()
+            raise
+        finally:
+            metrics.COMMAND_SECONDS.labels(label).observe(
+                time.perf_counter() - start)
+
+    def needs_measurement(self, cmd):
+        return cmd in (self.cmd.read_measured_values,
+                       self.cmd.start_fan_cleaning)
+
+    def recover_restart(self, cmd):
+        """
+        Bring the sensor into the state the command needs: stop a
+        measurement left running, e.g. by a previous run, before starting
+        it again, start it before reading values.
+
+        :return: True if the command is worth repeating
+        """
+        if cmd == self.cmd.start_measurement:
+            sensor_logger.info('recover by stopping the running measurement')
+            self.transfer_ignoring_state(self.cmd.stop_measurement, b'')
+            return True
+        if self.needs_measurement(cmd):
+            sensor_logger.info('recover by starting the measurement')
+            self.transfer_ignoring_state(self.cmd.start_measurement,
+                                         bytes((0x01, self.output_format)))
+            return True
+        return False
 
+    def recover_reset(self, cmd):
+        """
+        Reset the sensor after a persistent state error and start the
+        measurement again if the command needs it.
 
-def bytes_to_float(hex_bytes):
-    hexstr = ''.join(hex_bytes)
-    return struct.unpack('>f', bytes.fromhex(hexstr))[0]
+        :return: True if the command is worth repeating
+        """
+        if cmd != self.cmd.start_measurement and not self.needs_measurement(cmd):
+            return False
+        sensor_logger.warning('recover by device reset')
+        self.invalidate()
+        self.transfer_ignoring_state(self.cmd.device_reset, b'')
+        time.sleep(self.reset_delay)
+        if self.needs_measurement(cmd):
+            self.transfer_ignoring_state(self.cmd.start_measurement,
+                                         bytes((0x01, self.output_format)))
+        return True
+
+    def transfer_ignoring_state(self, cmd, data):
+        try:
+            self.transfer(cmd, data)
+        except StateValidationError as excinfo:
+            sensor_logger.error('recovery command failed with error: {}'.format(
+                excinfo.args[0]))
+
+    def submit(self, function, *args):
+        """
+        Queue a call for execution in the background, e.g.
+        submit(pm_sensor.read_measured_record). Calls are executed one after
+        the other in submission order, as the sensor answers one command at
+        a time.
+
+        :return: concurrent.futures.Future of the result
+        """
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='SPS30')
+        return self.executor.submit(function, *args)
+
+    def close(self):
+        """ finish queued calls and close the serial port """
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.shdlc.close_serial_port()
 
 
 class Database:
 
-    def __init__(self, host, port, dbuser, dbuser_password, dbname):
-        self.client = InfluxDBClient(host, port,
-                                     dbuser, dbuser_password,
-                                     dbname)
-        my_logger.info('database configuration: host: {}:{}, '
-                       'user: {}, database: {}'.format(host, port,
-                                                       dbuser, dbname))
+    def __init__(self, host, port, dbuser, dbuser_password, dbname,
+                 batch_size=500, flush_interval=60, spool_path=None,
+                 client=None, compress=True):
+        """
+        :param client: client with InfluxDBClient.write_points interface,
+        e.g. LocalStore, writes line protocol to the InfluxDB server if None
+        :param compress: send gzip-compressed requests to the InfluxDB server
+        """
+        from dbwriter import BatchWriter
+        if client is None:
+            from lineprotocol import LineProtocolClient
+            client = LineProtocolClient(host, port, dbuser, dbuser_password,
+                                        dbname, compress=compress)
+            database_logger.info('database configuration: host: {}:{}, '
+                                 'user: {}, database: {}'.format(host, port,
+                                                                 dbuser, dbname))
+        self.client = client
+        self.writer = BatchWriter(self.client, batch_size=batch_size,
+                                  flush_interval=flush_interval,
+                                  spool_path=spool_path)
+        self.writer.start()
 
     def write(self, data):
-        my_logger.info('writing {} attributes for measurement \'{}\' to '
-                       'database'.format(len(data[0]['fields'].keys()), data[0]['measurement']))
+        database_logger.info('queueing %d attributes for measurement \'%s\' '
+                             'for database', len(data[0]['fields']),
+                             data[0]['measurement'])
+        self.writer.write(data)
+
+    def flush(self):
+        return self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+def read_configuration(args):
+    """
+    Read the configuration file.
+
+    :param args: command line arguments submitted with the start of the script
+    :return: configuration dictionary
+    """
+    import yaml
+    with open(args.config, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    return cfg
+
+
+def open_database(cfg):
+    client = None
+    backend = cfg['database'].get('backend', 'influxdb')
+    if backend == 'sqlite':
+        from localstore import LocalStore
+        client = LocalStore(cfg['database'].get('path', 'airmonitor.sqlite'))
+    elif backend == 'collector':
+        from lineprotocol import CollectorClient
+        client = CollectorClient(cfg['database'].get('host', 'localhost'),
+                                 cfg['database'].get('port', 8087),
+                                 node=cfg['database'].get('node'),
+                                 transport=cfg['database'].get('transport',
+                                                               'http'),
+                                 compress=cfg['database'].get('gzip', True))
+    return Database(host=cfg['database'].get('host'),
+                    port=cfg['database'].get('port'),
+                    dbuser=cfg['database'].get('user'),
+                    dbuser_password=cfg['database'].get('password'),
+                    dbname=cfg['database'].get('name'),
+                    batch_size=cfg['database'].get('batch_size', 500),
+                    flush_interval=cfg['database'].get('flush_interval', 60),
+                    spool_path=cfg['database'].get('spool',
+                                                   'airmonitor_spool.jsonl'),
+                    client=client,
+                    compress=cfg['database'].get('gzip', True))
+
+
+class SPS30Driver(SensorDriver):
+    """ Sensirion SPS30 particulate matter sensor """
+
+    name = 'SensirionSPS30'
+    warm_up = 10  # let the sensor fan run for a few seconds before measurements
+
+    def __init__(self, measurement, interval=60, samples=1, delay=1,
+                 pm_sensor=None, output_format=OUTPUT_FORMAT_FLOAT,
+                 device='/dev/serial0', cache=None):
+        """
+        :param samples: number of readings averaged per sample
+        :param delay: seconds between averaged readings
+        :param pm_sensor: SensirionSPS30 instance, opened on start() if None
+        :param output_format: OUTPUT_FORMAT_FLOAT or OUTPUT_FORMAT_INTEGER
+        :param device: serial device of the sensor, if pm_sensor is None
+        :param cache: DeviceCache shared by the sensors, if pm_sensor is None
+        """
+        super().__init__(measurement, interval)
+        self.samples = samples
+        self.delay = delay
+        self.pm_sensor = pm_sensor
+        self.output_format = output_format
+        self.device = device
+        self.cache = cache
+        if pm_sensor is None:
+            self.name = '{} {}'.format(self.name, device)
+
+    def start(self):
+        if self.pm_sensor is None:
+            self.pm_sensor = SensirionSPS30(SHDLC(device=self.device),
+                                            output_format=self.output_format,
+                                            cache=self.cache)
+        if 'serial_number' not in self.tags:
+            serial_number = self.pm_sensor.get_device_information().get(
+                'serial_number')
+            if serial_number:
+                self.tags['serial_number'] = serial_number
+        self.pm_sensor.start_measurement()
+
+    def read(self):
+        measurements = []
+        for idx in range(self.samples):
+            sensor_logger.info('take measurement %d', idx + 1)
+            record = self.pm_sensor.read_measured_record()
+            if record is not None:
+                measurements.append(record)
+            if idx < self.samples - 1:
+                time.sleep(self.delay)
+        if not measurements:
+            return {}
+        sensor_logger.info('calculate averages for measurement values')
+        count = len(measurements)
+        return dict(zip(MEASURED_VALUES_FIELDS,
+                        [sum(values) / count for values in zip(*measurements)]))
+
+    def stop(self):
+        self.pm_sensor.stop_measurement()
+
+    def close(self):
+        if self.pm_sensor is not None:
+            self.pm_sensor.close()
+
+
+class DHT22Driver(SensorDriver):
+    """
+    DHT22 humidity and temperature sensor. Single reads run on a worker
+    thread within a time budget per sample, at most one every min_interval
+    seconds as the sensor needs. Readings outside the range of the sensor
+    are rejected. If no valid reading arrives within the budget, the last
+    valid one is returned with its age in seconds as field age, as long as
+    it is at most max_age seconds old.
+    """
+
+    name = 'DHT22'
+    min_interval = 2.0  # the sensor answers at most every 2 seconds
+    humidity_range = (0.0, 100.0)
+    temperature_range = (-40.0, 80.0)
+
+    def __init__(self, measurement, interval=60, pin=4, budget=5.0,
+                 max_age=300, read_function=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        :param pin: GPIO pin of the sensor
+        :param budget: max. seconds per sample
+        :param max_age: max. seconds the last valid reading is served for
+        :param read_function: function taking one reading and returning
+        (humidity, temperature), Adafruit_DHT.read of the pin if None
+        :param clock: monotonic clock function
+        :param sleep: function waiting for the given seconds
+        """
+        super().__init__(measurement, interval)
+        self.pin = pin
+        self.budget = budget
+        self.max_age = max_age
+        self.read_function = read_function
+        self.executor = None
+        self.clock = clock
+        self.sleep = sleep
+        self.pending = None  # read still running after its budget
+        self.last_read_end = None  # clock when the last read returned
+        self.last_good = None  # (monotonic time, fields)
+
+    def start(self):
+        if self.read_function is None:
+            import Adafruit_DHT
+            self.read_function = functools.partial(
+                Adafruit_DHT.read, Adafruit_DHT.DHT22, self.pin)
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='DHT22')
+
+    def valid(self, humidity, temperature):
+        if humidity is None or temperature is None:
+            return False
+        if not self.humidity_range[0] <= humidity <= self.humidity_range[1] \
+                or not self.temperature_range[0] <= temperature \
+                <= self.temperature_range[1]:
+            sensor_logger.warning('rejecting impossible DHT22 reading, '
+                                  'humidity {} temperature {}'.format(
+                                      humidity, temperature))
+            metrics.SAMPLE_REJECTED.labels(self.name).inc()
+            return False
+        return True
+
+    def read_sensor(self):
+        """
+        Take one reading, on the worker thread, at least min_interval
+        seconds after the previous reading returned.
+        """
+        if self.last_read_end is not None:
+            delay = self.last_read_end + self.min_interval - self.clock()
+            while delay > 0:
+                self.sleep(delay)
+                delay = self.last_read_end + self.min_interval - self.clock()
         try:
-            self.client.write_points(data)
-        except requests.exceptions.ConnectionError as err:
-            my_logger.error('writing to database failed with '
-                            'error: \'{}\'.'.format(err))
-        else:
-            my_logger.info('data written to database')
+            return self.read_function()
+        finally:
+            self.last_read_end = self.clock()
+
+    def attempt(self, deadline):
+        """
+        Take one reading on the worker thread, unless the min. interval
+        since the last reading ends after the deadline.
+
+        :return: (humidity, temperature), None if the deadline passed
+        """
+        if self.pending is None:
+            if self.last_read_end is not None and \
+                    self.last_read_end + self.min_interval > deadline:
+                return None
+            self.pending = self.executor.submit(self.read_sensor)
+        try:
+            result = self.pending.result(
+                timeout=max(deadline - self.clock(), 0))
+        except concurrent.futures.TimeoutError:
+            return None
+        except Exception:
+            sensor_logger.exception('DHT22 read failed')
+            result = (None, None)
+        self.pending = None
+        return result
+
+    def read(self):
+        if self.executor is None:
+            self.start()
+        sensor_logger.info('take humidity and temperature measurement from DHT22 sensor')
+        deadline = self.clock() + self.budget
+        while self.clock() < deadline:
+            result = self.attempt(deadline)
+            if result is None:
+                break
+            if self.valid(*result):
+                humidity, temperature = result
+                self.last_good = (self.clock(), {
+                    'humidity': humidity,
+                    'temperature': temperature,
+                    })
+                return dict(self.last_good[1])
+        if self.last_good is not None:
+            age = self.clock() - self.last_good[0]
+            if age <= self.max_age:
+                sensor_logger.warning('no DHT22 reading within {} seconds, '
+                                      'using the last one of {:.0f} seconds '
+                                      'ago'.format(self.budget, age))
+                metrics.SAMPLE_STALE.labels(self.name).inc()
+                return dict(self.last_good[1], age=age)
+        return {}
+
+    def close(self):
+        if self.executor is not None:
+            # a hanging read must not hold up the shutdown
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class MetricsDriver(SensorDriver):
+    """
+    Self-monitoring as a sensor: every reading is a snapshot of the metrics
+    registry, written to the database like the other measurements.
+    """
+
+    name = 'metrics'
+
+    def __init__(self, measurement='pmmonitor', interval=60,
+                 registry=metrics.REGISTRY):
+        super().__init__(measurement, interval)
+        self.registry = registry
+
+    def read(self):
+        return self.registry.fields()
+
+
+def bypass_output(output, direct, measurement):
+    """
+    :param output: function called with the points of the other measurements
+    :param direct: function called with the points of measurement
+    :return: output function passing the points of measurement to direct,
+    e.g. the metrics snapshots, whose fields vary, past the aggregation,
+    rollup and deadband stages
+    """
+    def route(points):
+        bypassed = [point for point in points
+                    if point['measurement'] == measurement]
+        if bypassed:
+            direct(bypassed)
+        if len(bypassed) < len(points):
+            output([point for point in points
+                    if point['measurement'] != measurement])
+    return route
+
+
+def make_drivers(cfg, interval=None, samples=1):
+    """
+    Create the sensor drivers from the configuration, one SPS30 driver per
+    configured serial device.
+
+    :param cfg: configuration dictionary
+    :param interval: seconds between samples for sensors without their own
+    interval setting
+    :param samples: number of SPS30 readings averaged per sample
+    """
+    if interval is None:
+        interval = cfg.get('daemon', {}).get('interval', 60)
+    sps30_cfg = cfg['SensirionSPS30']
+    devices = sps30_cfg.get('devices', [sps30_cfg.get('device', '/dev/serial0')])
+    cache = DeviceCache(sps30_cfg.get('cache', 'airmonitor_devices.json'),
+                        ttl=sps30_cfg.get('cache_ttl', 86400))
+    drivers = [SPS30Driver(sps30_cfg['measurement'],
+                           interval=sps30_cfg.get('interval', interval),
+                           samples=samples,
+                           output_format=OUTPUT_FORMATS[
+                               sps30_cfg.get('output_format', 'float')],
+                           device=device,
+                           cache=cache)
+               for device in devices]
+    if 'adaptive' in sps30_cfg:
+        from adaptive import make_adaptive
+        drivers = [make_adaptive(driver, sps30_cfg['adaptive'])
+                   for driver in drivers]
+    drivers.append(DHT22Driver(cfg['DHT22']['measurement'],
+                               interval=cfg['DHT22'].get('interval', interval),
+                               pin=cfg['DHT22'].get('pin', 4),
+                               budget=cfg['DHT22'].get('budget', 5.0),
+                               max_age=cfg['DHT22'].get('max_age', 300)))
+    return drivers
+
+
+def run_once(cfg):
+    """ take a single set of measurements, e.g. when started by cron """
+    if 'rollups' in cfg and cfg['rollups'].get('mode', 'local') == 'local':
+        # the raw data expires without ever being rolled up
+        my_logger.warning('rollups mode local needs pmmonitor.py --daemon, '
+                          'no rollups are computed, use mode influxdb for '
+                          'measurements started by cron')
+    database = open_database(cfg)
+    drivers = make_drivers(cfg, samples=3)
+    output = database.write
+    if 'deadband' in cfg:
+        from deadband import make_deadband
+        output = make_deadband(output, cfg)
+    try:
+        SensorScheduler(drivers, output).run_once()
+    finally:
+        for driver in drivers:
+            driver.close()
+        if 'deadband' in cfg:
+            output.flush()
+        database.close()
+
+
+def run_daemon(cfg, interval, stop_event):
+    """
+    Keep the sensors measuring and the serial port and database client open,
+    and poll every sensor on its own interval until stop_event is set.
+
+    :param cfg: configuration dictionary
+    :param interval: seconds between samples for sensors without their own
+    interval setting
+    :param stop_event: threading.Event, stops the daemon when set
+    """
+    from aggregator import Aggregator
+    from deadband import make_deadband
+    from rollups import Rollups, rollup_settings
+    database = open_database(cfg)
+    drivers = make_drivers(cfg, interval)
+    stages = []  # output stages holding points back, flushed in order
+    output = database.write
+    if 'deadband' in cfg:
+        output = make_deadband(output, cfg)
+        stages.insert(0, output)
+    if 'rollups' in cfg and cfg['rollups'].get('mode', 'local') == 'local':
+        measurements, intervals, statistics = rollup_settings(cfg)
+        output = Rollups(output, measurements, intervals, statistics,
+                         capacity=cfg['rollups'].get('capacity', 3600),
+                         state_path=cfg['rollups'].get(
+                             'state', 'airmonitor_rollups.json'))
+        stages.insert(0, output)
+    if 'aggregation' in cfg:
+        output = Aggregator(output,
+                            window=cfg['aggregation'].get('window', 60),
+                            statistics=cfg['aggregation'].get('statistics',
+                                                              ['mean']),
+                            primary=cfg['aggregation'].get('primary', 'mean'),
+                            capacity=cfg['aggregation'].get('capacity', 3600))
+        stages.insert(0, output)
+    server = None
+    if 'metrics' in cfg:
+        server = metrics.MetricsServer(
+            address=cfg['metrics'].get('address', '127.0.0.1'),
+            port=cfg['metrics'].get('port', 9108)).start()
+        if cfg['metrics'].get('measurement'):
+            drivers.append(MetricsDriver(
+                cfg['metrics']['measurement'],
+                interval=cfg['metrics'].get('interval', 60)))
+            output = bypass_output(output, database.write,
+                                   cfg['metrics']['measurement'])
+    try:
+        SensorScheduler(drivers, output, stop_event).run()
+    finally:
+        for driver in drivers:
+            driver.close()
+        for stage in stages:
+            stage.flush()
+        database.close()
+        if server is not None:
+            server.close()
 
 
 def parse_args():
@@ -368,69 +1263,28 @@ def parse_args():
     parser.add_argument('-c', '--config', type=str,
                         default='airmonitor_config.yml',
                         help='configuration file')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='keep running and sample on a fixed schedule')
+    parser.add_argument('-i', '--interval', type=float, default=None,
+                        help='seconds between samples in daemon mode, '
+                             'overrides the configuration file')
     return parser.parse_args()
 
 
-my_logger = set_up_logging()
+my_logger = logging.getLogger('MyLogger')
 
 
 if __name__ == '__main__':
+    set_up_logging()
     my_logger.info('---------- script started ----------')
     my_logger.info('reading configuration file')
     args = parse_args()
-    with open(args.config, 'r') as ymlfile:
-        cfg = yaml.load(ymlfile)
-    database = Database(host=cfg['database']['host'],
-                        port=cfg['database']['port'],
-                        dbuser=cfg['database']['user'],
-                        dbuser_password=cfg['database']['password'],
-                        dbname=cfg['database']['name'])
-
-    #  Sensirion SPS30 particulate matter sensor
-
-    shdlc = SHDLC()
-    pm_sensor = SensirionSPS30()
-    my_logger.info('start Sensirion SPS30 particulate matter sensor')
-    pm_sensor.start_measurement()
-    my_logger.info('wait 10 seconds for sensor fan to spin up')
-    time.sleep(10)  # let the sensor fan run for a few seconds before measurements
-    measurements = []
-    values = None
-    for idx in range(3):
-        my_logger.info('take measurement {}'.format(idx + 1))
-        values = pm_sensor.read_measured_values()
-        measurements.append(values)
-        time.sleep(1)
-    measurement_avgs = {}
-    my_logger.info('calculate averages for measurement values')
-    for key in values:
-        measurement_avgs[key] = sum([measurement[key] for measurement in measurements]) / len(measurements)
-    data_json = [{
-        'measurement': cfg['SensirionSPS30']['measurement'],
-        'time': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
-        'fields': measurement_avgs
-        }]
-    my_logger.info('write {} measurement values to database'.format(len(measurement_avgs)))
-    database.write(data_json)
-    my_logger.info('stop Sesirion SPS30 particulate matter sensor')
-    pm_sensor.stop_measurement()
-
-    #  DHT22 humidity and temperature sensor
-
-    my_logger.info('take humidity and temperature measurement from DHT22 sensor')
-    sensor = Adafruit_DHT.DHT22
-    pin = 4
-    humidity, temperature = Adafruit_DHT.read_retry(sensor, pin)
-    measurement = {
-        'humidity': humidity,
-        'temperature': temperature,
-        }
-    data_json = [{
-        'measurement': cfg['DHT22']['measurement'],
-        'time': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
-        'fields': measurement
-        }]
-    my_logger.info('write {} measurement values to database'.format(len(measurement)))
-    database.write(data_json)
-
+    cfg = read_configuration(args)
+    configure_logging(cfg)
+    if args.daemon:
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        run_daemon(cfg, args.interval, stop)
+    else:
+        run_once(cfg)
     my_logger.info('---------- script stopped ----------')
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Downsampled rollups of the sensor measurements for long-term storage, e.g.
+1 minute, 1 hour and 1 day aggregates, each kept in its own retention
+policy while the raw data expires.
+
+The rollups are either computed locally by pmmonitor.py --daemon and
+written alongside the raw data (mode local), or by InfluxDB continuous
+queries (mode influxdb). Single measurements started by cron compute no
+rollups, so they need mode influxdb. In both modes the retention policies and, for mode
+influxdb, the continuous queries are created from the configuration with
+
+    python rollups.py -c airmonitor_config.yml
+
+With the sqlite backend the same call deletes the expired rows instead.
+
+Rollup fields are named <function>_<field> as InfluxDB names the results of
+a wildcard continuous query, e.g. mean_humidity or percentile_humidity.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import warnings
+
+import numpy as np
+
+from sensors import make_point
+
+my_logger = logging.getLogger('MyLogger.database')
+
+# statistic: (InfluxQL function, field prefix)
+ROLLUP_STATISTICS = {
+    'mean': ('mean(*)', 'mean'),
+    'min': ('min(*)', 'min'),
+    'max': ('max(*)', 'max'),
+    'p95': ('percentile(*, 95)', 'percentile'),
+}
+DEFAULT_INTERVALS = {'1m': '90d', '1h': '730d', '1d': 'INF'}
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Create the retention '
+                                                 'policies and continuous '
+                                                 'queries for the rollups.')
+    parser.add_argument('-c', '--config', type=str,
+                        default='airmonitor_config.yml',
+                        help='configuration file')
+    return parser.parse_args()
+
+
+def read_configuration(args):
+    """
+    Read the configuration file.
+
+    :param args: command line arguments submitted with the start of the script
+    :return: configuration dictionary
+    """
+    import yaml
+    with open(args.config, 'r') as ymlfile:
+        cfg = yaml.safe_load(ymlfile)
+    return cfg
+
+
+def to_seconds(interval):
+    """
+    :param interval: InfluxQL duration literal, e.g. '1m' or '90d'
+    :return: the duration in seconds
+    """
+    match = re.fullmatch(r'(\d+)([smhdw])', interval)
+    if match is None:
+        raise ValueError('invalid interval \'{}\', expected e.g. 1m, 1h, '
+                         '1d'.format(interval))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def policy_name(interval):
+    return 'rollup_{}'.format(interval)
+
+
+def rollup_settings(cfg):
+    """
+    :param cfg: configuration dictionary
+    :return: tuple (measurements, intervals as {interval: retention}, statistics)
+    """
+    rollup_cfg = cfg.get('rollups', {})
+    measurements = rollup_cfg.get('measurements',
+                                  [cfg['SensirionSPS30']['measurement'],
+                                   cfg['DHT22']['measurement']])
+    intervals = rollup_cfg.get('intervals', DEFAULT_INTERVALS)
+    statistics = rollup_cfg.get('statistics', list(ROLLUP_STATISTICS))
+    for name in statistics:
+        if name not in ROLLUP_STATISTICS:
+            raise ValueError('unknown statistic \'{}\', expected one of '
+                             '{}'.format(name, ', '.join(ROLLUP_STATISTICS)))
+    for interval in intervals:
+        to_seconds(interval)
+    return measurements, intervals, statistics
+
+
+class BucketStatistics:
+    """
+    Statistics of the samples of a bucket, one column per field. Count,
+    sum, min and max are kept running, so they cover every sample of the
+    bucket. The 95th percentile is computed over at most capacity samples
+    spread evenly over the bucket: when the buffer is full, every other
+    sample is dropped and from then on only every other sample is kept.
+    Missing values are stored as NaN and ignored by all statistics.
+    """
+
+    def __init__(self, fields, capacity):
+        """
+        :param fields: field names, in column order
+        :param capacity: max. number of samples kept for the percentile
+        """
+        self.fields = tuple(fields)
+        self.columns = {field: col for col, field in enumerate(self.fields)}
+        self.capacity = capacity
+        self.clear()
+
+    def clear(self):
+        self.counts = np.zeros(len(self.fields))
+        self.sums = np.zeros(len(self.fields))
+        self.mins = np.full(len(self.fields), np.inf)
+        self.maxs = np.full(len(self.fields), -np.inf)
+        self.samples = []
+        self.stride = 1
+        self.appends = 0
+
+    def __len__(self):
+        return self.appends
+
+    def append(self, sample):
+        """
+        :param sample: dictionary of field values, missing fields or None
+        values count as missing
+        """
+        row = np.full(len(self.fields), np.nan)
+        for field, value in sample.items():
+            col = self.columns.get(field)
+            if col is not None and value is not None:
+                row[col] = value
+        valid = ~np.isnan(row)
+        self.counts += valid
+        self.sums += np.where(valid, row, 0.0)
+        self.mins = np.fmin(self.mins, row)
+        self.maxs = np.fmax(self.maxs, row)
+        if self.appends % self.stride == 0:
+            self.samples.append(row)
+            if len(self.samples) > self.capacity:
+                self.samples = self.samples[::2]
+                self.stride *= 2
+        self.appends += 1
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts
+
+    def min(self):
+        return np.where(self.counts > 0, self.mins, np.nan)
+
+    def max(self):
+        return np.where(self.counts > 0, self.maxs, np.nan)
+
+    def p95(self):
+        """ 95th percentile """
+        if not self.samples:
+            return np.full(len(self.fields), np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN fields
+            return np.nanpercentile(np.array(self.samples), 95, axis=0)
+
+    def statistic(self, name):
+        return getattr(self, name)()
+
+    def state(self):
+        """ :return: the statistics as JSON serializable dictionary """
+        return {'fields': list(self.fields), 'counts': self.counts.tolist(),
+                'sums': self.sums.tolist(), 'mins': self.mins.tolist(),
+                'maxs': self.maxs.tolist(),
+                'samples': [row.tolist() for row in self.samples],
+                'stride': self.stride, 'appends': self.appends}
+
+    @classmethod
+    def from_state(cls, state, capacity):
+        statistics = cls(state['fields'], capacity)
+        for name in ('counts', 'sums', 'mins', 'maxs'):
+            setattr(statistics, name, np.array(state[name], dtype=float))
+        statistics.samples = [np.array(row, dtype=float)
+                              for row in state['samples']]
+        statistics.stride = state['stride']
+        statistics.appends = state['appends']
+        return statistics
+
+
+class Rollups:
+    """
+    Pass points on to the output function and compute rollups of them in
+    wall-clock aligned buckets per series, i.e. measurement and tags, and
+    interval. A rollup point is written to the retention policy of its
+    interval when the first point of the next bucket arrives, stamped with
+    the bucket start.
+
+    Buckets still open on shutdown are kept in a state file and continued
+    after the restart, rather than written as partial rollups that the
+    rollup of the completed bucket would overwrite.
+
+    Can be used as output function of SensorScheduler or Aggregator.
+    """
+
+    def __init__(self, output, measurements, intervals=DEFAULT_INTERVALS,
+                 statistics=tuple(ROLLUP_STATISTICS), capacity=3600,
+                 clock=time.time, state_path=None):
+        """
+        :param output: function called with a list of points
+        :param measurements: names of the measurements to roll up
+        :param intervals: rollup intervals, e.g. ['1m', '1h', '1d']
+        :param statistics: statistics per field, see ROLLUP_STATISTICS
+        :param capacity: max. samples per bucket kept for the percentile,
+        see BucketStatistics
+        :param clock: wall clock function
+        :param state_path: file keeping the open buckets over restarts,
+        None drops them on shutdown
+        """
+        self.output = output
+        self.measurements = set(measurements)
+        self.intervals = [(interval, to_seconds(interval))
+                          for interval in intervals]
+        self.statistics = tuple(statistics)
+        self.capacity = capacity
+        self.clock = clock
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        # (interval, series): [bucket number, BucketStatistics]
+        self.buckets = self.load()
+
+    def load(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as state_file:
+                state = json.load(state_file)
+            intervals = dict(self.intervals)
+            buckets = {}
+            for interval, measurement, tags, number, statistics in state:
+                if interval in intervals and measurement in self.measurements:
+                    series = (measurement, tuple(tuple(tag) for tag in tags))
+                    buckets[(interval, series)] = [
+                        number, BucketStatistics.from_state(statistics,
+                                                            self.capacity)]
+            return buckets
+        except (ValueError, KeyError, TypeError):
+            my_logger.error('ignoring unreadable rollup state {}'.format(
+                self.state_path))
+            return {}
+
+    def save(self):
+        with self.lock:
+            state = [[interval, measurement, tags, number, statistics.state()]
+                     for (interval, (measurement, tags)), (number, statistics)
+                     in self.buckets.items() if len(statistics)]
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def __call__(self, points):
+        self.output(points)
+        rollups = []
+        with self.lock:
+            now = self.clock()
+            for point in points:
+                if point['measurement'] not in self.measurements:
+                    continue
+                series = (point['measurement'],
+                          tuple(sorted(point.get('tags', {}).items())))
+                for interval, seconds in self.intervals:
+                    number = int(now // seconds)
+                    bucket = self.buckets.get((interval, series))
+                    if bucket is None:
+                        bucket = [number, BucketStatistics(
+                            sorted(point['fields']), self.capacity)]
+                        self.buckets[(interval, series)] = bucket
+                    elif bucket[0] != number:
+                        rollups.append(self.rollup(interval, series, bucket))
+                        bucket[0] = number
+                    bucket[1].append(point['fields'])
+        rollups = [point for point in rollups if point is not None]
+        if rollups:
+            self.output(rollups)
+
+    def rollup(self, interval, series, bucket):
+        """ build the rollup point of a bucket and empty it """
+        number, statistics = bucket
+        if not len(statistics):
+            return None
+        measurement, tags = series
+        fields = {}
+        for name in self.statistics:
+            prefix = ROLLUP_STATISTICS[name][1]
+            for field, value in zip(statistics.fields,
+                                    statistics.statistic(name)):
+                if value == value:  # not NaN
+                    fields['{}_{}'.format(prefix, field)] = float(value)
+        statistics.clear()
+        if not fields:
+            return None
+        start = number * to_seconds(interval)
+        point = make_point(measurement, fields, timestamp=start * 10 ** 9,
+                           tags=dict(tags))
+        point['retention_policy'] = policy_name(interval)
+        return point
+
+    def flush(self):
+        """
+        Write the rollups of the completed buckets and keep the open ones
+        for the next start, e.g. on shutdown.
+        """
+        with self.lock:
+            number = {interval: int(self.clock() // seconds)
+                      for interval, seconds in self.intervals}
+            rollups = [self.rollup(interval, series, bucket)
+                       for (interval, series), bucket in self.buckets.items()
+                       if bucket[0] != number[interval]]
+        rollups = [point for point in rollups if point is not None]
+        if rollups:
+            self.output(rollups)
+        if self.state_path is not None:
+            self.save()
+
+
+def set_up_retention(client, database, cfg):
+    """
+    Create or alter the retention policies of the raw data and the rollups.
+
+    :param client: InfluxDBClient instance
+    :param database: database name
+    :param cfg: configuration dictionary
+    """
+    measurements, intervals, statistics = rollup_settings(cfg)
+    raw_cfg = cfg.get('rollups', {}).get('raw', {})
+    policies = [(raw_cfg.get('policy', 'autogen'),
+                 raw_cfg.get('retention', 'INF'), True)]
+    policies += [(policy_name(interval), retention, False)
+                 for interval, retention in intervals.items()]
+    existing = {policy['name']
+                for policy in client.get_list_retention_policies(database)}
+    for name, duration, default in policies:
+        my_logger.info('retention policy {}: {}'.format(name, duration))
+        if name in existing:
+            client.alter_retention_policy(name, database, duration=duration,
+                                          default=default or None)
+        else:
+            client.create_retention_policy(name, duration, 1, database,
+                                           default=default)
+
+
+def continuous_queries(database, cfg):
+    """
+    :return: dictionary of the continuous query SELECT statements by name
+    """
+    measurements, intervals, statistics = rollup_settings(cfg)
+    raw_policy = cfg.get('rollups', {}).get('raw', {}).get('policy', 'autogen')
+    functions = ', '.join(ROLLUP_STATISTICS[name][0] for name in statistics)
+    queries = {}
+    for measurement in measurements:
+        for interval in intervals:
+            name = 'cq_{}_{}'.format(measurement, interval)
+            queries[name] = (
+                'SELECT {} INTO "{}"."{}"."{}" FROM "{}"."{}"."{}" '
+                'GROUP BY time({}), *'.format(
+                    functions, database, policy_name(interval), measurement,
+                    database, raw_policy, measurement, interval))
+    return queries
+
+
+def set_up_continuous_queries(client, database, cfg):
+    """
+    Replace the rollup continuous queries, so changes of the configuration
+    take effect.
+    """
+    existing = set()
+    for entry in client.get_list_continuous_queries():
+        for query in entry.get(database, []):
+            existing.add(query['name'])
+    for name, select in continuous_queries(database, cfg).items():
+        if name in existing:
+            client.drop_continuous_query(name, database)
+        my_logger.info('continuous query {}: {}'.format(name, select))
+        client.create_continuous_query(name, select, database)
+
+
+def expire_local(store, cfg, now=None):
+    """
+    Delete the raw data and rollups of a LocalStore older than their
+    retention, the sqlite backend counterpart of the retention policies.
+    Meant to be run regularly, e.g. daily by cron.
+
+    :param store: LocalStore instance
+    :param cfg: configuration dictionary
+    :param now: current time in ns, default: now
+    :return: number of deleted rows
+    """
+    if now is None:
+        now = time.time_ns()
+    measurements, intervals, statistics = rollup_settings(cfg)
+    raw_retention = cfg.get('rollups', {}).get('raw', {}).get('retention', 'INF')
+    tables = [(measurement, raw_retention) for measurement in measurements]
+    tables += [(store.table_name(measurement, policy_name(interval)), retention)
+               for interval, retention in intervals.items()
+               for measurement in measurements]
+    deleted = 0
+    for table, retention in tables:
+        if retention.upper() != 'INF':
+            deleted += store.delete_before(
+                table, now - to_seconds(retention) * 10 ** 9)
+    return deleted
+
+
+def set_up_rollups(client, cfg):
+    """
+    Create the retention policies and, in mode influxdb, the continuous
+    queries configured in section rollups.
+    """
+    database = cfg['database']['name']
+    set_up_retention(client, database, cfg)
+    if cfg.get('rollups', {}).get('mode', 'local') == 'influxdb':
+        set_up_continuous_queries(client, database, cfg)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cfg = read_configuration(args)
+    if cfg['database'].get('backend', 'influxdb') == 'sqlite':
+        from localstore import LocalStore
+        expire_local(LocalStore(cfg['database'].get('path',
+                                                    'airmonitor.sqlite')), cfg)
+        sys.exit()
+    from influxdb import InfluxDBClient
+    client = InfluxDBClient(host=cfg['database']['host'],
+                            port=cfg['database']['port'],
+                            username=cfg['database']['user'],
+                            password=cfg['database']['password'],
+                            database=cfg['database']['name'])
+    set_up_rollups(client, cfg)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sensor driver abstraction and a scheduler polling several sensors
+concurrently, each on its own cadence, into one shared output.
+"""
+
+import logging
+import threading
+import time
+
+import metrics
+
+my_logger = logging.getLogger('MyLogger.sensor')
+
+
+class SensorDriver:
+    """
+    Base class for sensors polled by SensorScheduler.
+
+    Subclasses implement read() and, if the sensor needs it, start(), stop()
+    and close(). warm_up is the time in seconds between start() and the
+    first read(). tags are added to every point of the sensor, e.g. to tell
+    several sensors of the same type apart.
+    """
+
+    name = 'sensor'
+    warm_up = 0
+
+    def __init__(self, measurement, interval=60):
+        """
+        :param measurement: database measurement name for the readings
+        :param interval: seconds between readings in continuous mode
+        """
+        self.measurement = measurement
+        self.interval = interval
+        self.tags = {}
+
+    def start(self):
+        pass
+
+    def read(self):
+        """
+        :return: dictionary of field values, empty if the reading failed
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def close(self):
+        """ release the sensor after the last stop() """
+        pass
+
+    def schedule(self, stop_event):
+        """ tick times of continuous mode, see fixed_rate_schedule """
+        return fixed_rate_schedule(self.interval, stop_event)
+
+
+def make_point(measurement, fields, timestamp=None, tags=None):
+    """
+    Build a point in InfluxDBClient.write_points format, with the time as
+    integer ns since the epoch, so it need not be parsed again for writing.
+
+    :param measurement: measurement name
+    :param fields: dictionary of field values
+    :param timestamp: time in ns, defaults to now
+    :param tags: dictionary of tag values, none if empty
+    """
+    if timestamp is None:
+        timestamp = time.time_ns()
+    point = {
+        'measurement': measurement,
+        'time': timestamp,
+        'fields': fields,
+        }
+    if tags:
+        point['tags'] = dict(tags)
+    return point
+
+
+def fixed_rate_schedule(interval, stop_event, clock=time.monotonic):
+    """
+    Yield the tick times of a fixed rate schedule until stop_event is set.
+
+    Ticks are computed from the start time rather than from the end of the
+    previous cycle, so the duration of a cycle does not accumulate as drift.
+    Ticks missed because a cycle overran are skipped, not caught up.
+
+    :param interval: seconds between ticks
+    :param stop_event: threading.Event, ends the schedule when set
+    :param clock: monotonic clock function
+    """
+    next_tick = clock()
+    while not stop_event.is_set():
+        yield next_tick
+        next_tick += interval
+        now = clock()
+        if now > next_tick:
+            missed = int((now - next_tick) // interval) + 1
+            my_logger.warning('sample cycle overran, skipping {} '
+                              'tick(s)'.format(missed))
+            next_tick += missed * interval
+        stop_event.wait(next_tick - now)
+
+
+class SensorScheduler:
+    """
+    Poll sensor drivers concurrently, one thread per driver, and pass the
+    readings as points to a shared output function, e.g. Database.write.
+    The duration of a cycle is bounded by the slowest sensor rather than the
+    sum of all sensors.
+    """
+
+    def __init__(self, drivers, output, stop_event=None, retry_delay=5,
+                 max_retry_delay=300):
+        """
+        :param drivers: list of SensorDriver instances
+        :param output: function called with a list of points
+        :param stop_event: threading.Event, stops run() when set
+        :param retry_delay: seconds before starting a failed driver again in
+        continuous mode, doubled after every failure
+        :param max_retry_delay: max. seconds between start attempts
+        """
+        self.drivers = drivers
+        self.output = output
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    def sample(self, driver):
+        start = time.perf_counter()
+        try:
+            fields = driver.read()
+        except Exception:
+            my_logger.exception('reading {} failed'.format(driver.name))
+            fields = None
+        metrics.SAMPLE_SECONDS.labels(driver.name).observe(
+            time.perf_counter() - start)
+        if fields:
+            self.output([make_point(driver.measurement, fields,
+                                    tags=driver.tags)])
+        else:
+            metrics.SAMPLE_FAILURES.labels(driver.name).inc()
+            if fields is not None:
+                my_logger.error('no valid {} values received'.format(driver.name))
+
+    def start(self, driver, retry=False):
+        """
+        Start a driver, with retry until it started or stop_event is set.
+
+        :return: True if the driver started
+        """
+        delay = self.retry_delay
+        while not self.stop_event.is_set():
+            my_logger.info('start {} sensor'.format(driver.name))
+            try:
+                driver.start()
+                return True
+            except Exception:
+                if not retry:
+                    my_logger.exception('starting {} failed'.format(driver.name))
+                    return False
+                my_logger.exception('starting {} failed, retry in {} '
+                                    'seconds'.format(driver.name, delay))
+            metrics.SAMPLE_FAILURES.labels(driver.name).inc()
+            self.stop_event.wait(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+        return False
+
+    def poll(self, driver):
+        """ continuously sample one driver until stop_event is set """
+        if not self.start(driver, retry=True):
+            return
+        try:
+            self.stop_event.wait(driver.warm_up)
+            my_logger.info('sampling {} every {} seconds'.format(driver.name,
+                                                                 driver.interval))
+            for _ in driver.schedule(self.stop_event):
+                self.sample(driver)
+        finally:
+            my_logger.info('stop {} sensor'.format(driver.name))
+            driver.stop()
+
+    def cycle(self, driver):
+        """ start, sample once and stop one driver """
+        if not self.start(driver):
+            metrics.SAMPLE_FAILURES.labels(driver.name).inc()
+            return
+        try:
+            self.stop_event.wait(driver.warm_up)
+            self.sample(driver)
+        finally:
+            my_logger.info('stop {} sensor'.format(driver.name))
+            driver.stop()
+
+    def run(self):
+        """ poll all drivers on their own cadence until stop_event is set """
+        self.run_threads(self.poll)
+
+    def run_once(self):
+        """ take one reading from all drivers concurrently """
+        self.run_threads(self.cycle)
+
+    def run_threads(self, target):
+        threads = [threading.Thread(target=target, args=(driver,),
+                                    name=driver.name, daemon=True)
+                   for driver in self.drivers]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)  # keep the main thread interruptible
+        except KeyboardInterrupt:
+            self.stop_event.set()
+            for thread in threads:
+                thread.join()
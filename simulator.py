@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulated Sensirion SPS30 speaking SHDLC, for tests and benchmarks without
+the sensor hardware.
+
+SimulatedSPS30 can be passed to SHDLC as port, in place of a serial.Serial
+instance. PtyBridge serves a simulated sensor on a pseudo-terminal, so the
+complete serial path can be exercised with SHDLC(device=bridge.device).
+"""
+
+import argparse
+import collections
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+import pmmonitor
+
+PRODUCT_TYPE = '00080000'
+ARTICLE_CODE = ''  # empty on the SPS30, as per datasheet
+SERIAL_NUMBER = 'SIM0123456789ABC'
+AUTO_CLEANING_INTERVAL = 604800  # factory default, one week
+# typical indoor values, see airmonitor.log
+TYPICAL_VALUES = (10.4, 11.0, 11.3, 11.4, 73.4, 84.8, 85.4, 85.4, 85.4, 0.62)
+
+
+class SimulatedSPS30:
+    """
+    Serial port stand-in behaving like an SPS30 on the other end.
+
+    Commands written to the port are decoded and answered with byte-stuffed
+    MISO frames, which become readable after latency seconds. Responses can
+    be corrupted or dropped at random, and error states can be injected.
+    """
+
+    def __init__(self, latency=0.0, corruption=0.0, drop=0.0, timeout=1.5,
+                 serial_number=SERIAL_NUMBER, seed=None):
+        """
+        :param latency: seconds between command and response
+        :param corruption: probability of a response with one flipped bit
+        :param drop: probability of no response at all
+        :param timeout: read timeout in seconds, as on serial.Serial
+        :param serial_number: serial number reported by the sensor
+        :param seed: random seed for values, corruption and drops
+        """
+        self.latency = latency
+        self.corruption = corruption
+        self.drop = drop
+        self.timeout = timeout
+        self.serial_number = serial_number
+        self.rng = random.Random(seed)
+        self.is_open = True
+        self.measuring = False
+        self.output_format = pmmonitor.OUTPUT_FORMAT_FLOAT
+        self.auto_cleaning_interval = AUTO_CLEANING_INTERVAL
+        self.values = list(TYPICAL_VALUES)
+        self.injected_states = collections.deque()
+        self.received = bytearray()
+        self.pending = collections.deque()  # (ready time, bytes)
+        self.output = bytearray()
+        self.commands = collections.Counter()
+        self.condition = threading.Condition()
+
+    # serial.Serial interface
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def isOpen(self):
+        return self.is_open
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self.collect_ready()
+            return len(self.output)
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.pending.clear()
+            self.output.clear()
+
+    def write(self, data):
+        self.received += data
+        while True:
+            start = self.received.find(b'\x7e')
+            end = self.received.find(b'\x7e', start + 1)
+            if start < 0 or end < 0:
+                break
+            frame = bytes(self.received[start:end + 1])
+            del self.received[:end + 1]
+            self.handle_frame(frame)
+        return len(data)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                self.collect_ready()
+                if self.output:
+                    data = bytes(self.output[:size])
+                    del self.output[:size]
+                    return data
+                now = time.monotonic()
+                if now >= deadline:
+                    return b''
+                wait = deadline - now
+                if self.pending:
+                    wait = min(wait, max(self.pending[0][0] - now, 0))
+                self.condition.wait(wait)
+
+    def collect_ready(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.output += self.pending.popleft()[1]
+
+    # sensor behaviour
+
+    def inject_state(self, state, count=1):
+        """ answer the next count commands with the given error state """
+        self.injected_states.extend([state] * count)
+
+    def handle_frame(self, frame):
+        content = pmmonitor.unstuff_bytes(frame[1:-1])
+        if len(content) < 4 or pmmonitor.calculate_checksum(content[:-1]) != content[-1] \
+                or content[2] != len(content) - 4:
+            return  # the sensor ignores broken frames
+        command, data = content[1], content[3:-1]
+        self.commands[command] += 1
+        if self.injected_states:
+            state, payload = self.injected_states.popleft(), b''
+        else:
+            state, payload = self.execute(command, data)
+        if self.rng.random() < self.drop:
+            return
+        response = bytearray(pmmonitor.encode_miso_frame(command, state,
+                                                         payload))
+        if self.rng.random() < self.corruption:
+            pos = self.rng.randrange(1, len(response) - 1)
+            response[pos] ^= 1 << self.rng.randrange(8)
+        with self.condition:
+            self.pending.append((time.monotonic() + self.latency,
+                                 bytes(response)))
+            self.condition.notify_all()
+
+    def execute(self, command, data):
+        """
+        :return: tuple (state, payload) of the response
+        """
+        if command == 0x00:  # start measurement
+            if len(data) != 2:
+                return 0x01, b''
+            if data[0] != 0x01 or data[1] not in pmmonitor.MEASURED_VALUES_STRUCTS:
+                return 0x04, b''
+            if self.measuring:
+                return 0x43, b''
+            self.measuring = True
+            self.output_format = data[1]
+            return 0x00, b''
+        elif command == 0x01:  # stop measurement
+            if self.measuring is False:
+                return 0x43, b''
+            self.measuring = False
+            return 0x00, b''
+        elif command == 0x03:  # read measured values
+            if not self.measuring:
+                return 0x43, b''
+            return 0x00, self.measured_values()
+        elif command == 0x80:  # read / write auto cleaning interval
+            if len(data) == 1:
+                return 0x00, struct.pack('>I', self.auto_cleaning_interval)
+            if len(data) == 5:
+                self.auto_cleaning_interval = struct.unpack('>I', data[1:])[0]
+                return 0x00, b''
+            return 0x01, b''
+        elif command == 0x56:  # start fan cleaning
+            return (0x00, b'') if self.measuring else (0x43, b'')
+        elif command == 0xd0:  # device information
+            info = {0x01: PRODUCT_TYPE, 0x02: ARTICLE_CODE,
+                    0x03: self.serial_number}
+            if len(data) != 1 or data[0] not in info:
+                return 0x04, b''
+            return 0x00, info[data[0]].encode('ascii') + b'\x00'
+        elif command == 0xd3:  # device reset
+            self.measuring = False
+            self.auto_cleaning_interval = AUTO_CLEANING_INTERVAL
+            return 0x00, b''
+        return 0x02, b''
+
+    def measured_values(self):
+        """ random walk around typical indoor values """
+        self.values = [max(value + self.rng.gauss(0, 0.02 * typical), 0.0)
+                       for value, typical in zip(self.values, TYPICAL_VALUES)]
+        if self.output_format == pmmonitor.OUTPUT_FORMAT_INTEGER:
+            values = [int(round(value)) for value in self.values[:-1]]
+            values.append(int(round(self.values[-1] * 1000)))  # nm
+            return struct.pack('>10H', *values)
+        return struct.pack('>10f', *self.values)
+
+
+class PtyBridge:
+    """
+    Serve a SimulatedSPS30 on a pseudo-terminal. The slave side behaves like
+    a serial device and can be opened with pyserial.
+    """
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.sensor.timeout = 0.05
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.forward_commands,
+                                         daemon=True),
+                        threading.Thread(target=self.forward_responses,
+                                         daemon=True)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def forward_commands(self):
+        while not self.stopped.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if ready:
+                try:
+                    self.sensor.write(os.read(self.master, 1024))
+                except OSError:
+                    return
+
+    def forward_responses(self):
+        while not self.stopped.is_set():
+            data = self.sensor.read(1024)
+            if data:
+                os.write(self.master, data)
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def parse_args():
+    """ parse the args from the command line call """
+    parser = argparse.ArgumentParser(description='Simulate a Sensirion SPS30 '
+                                                 'on a pseudo-terminal.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds between command and response')
+    parser.add_argument('--corruption', type=float, default=0.0,
+                        help='probability of a corrupted response')
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help='probability of a missing response')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    bridge = PtyBridge(SimulatedSPS30(latency=args.latency,
+                                      corruption=args.corruption,
+                                      drop=args.drop)).start()
+    print('simulated SPS30 on {}, Ctrl-C to stop'.format(bridge.device))
+    try:
+        bridge.stopped.wait()
+    except KeyboardInterrupt:
+        bridge.close()
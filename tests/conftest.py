@@ -0,0 +1,28 @@
+"""
+Shared fixtures. The SPS30 tests run against the simulated sensor unless the
+environment variable SPS30_DEVICE names the serial device of a real one,
+e.g. SPS30_DEVICE=/dev/serial0 python -m pytest
+"""
+
+import os
+
+import pytest
+
+import pmmonitor
+from simulator import SimulatedSPS30
+
+
+@pytest.fixture
+def sps30_device():
+    """ serial device of a real SPS30, None to use the simulator """
+    return os.environ.get('SPS30_DEVICE')
+
+
+@pytest.fixture
+def pm_sensor(sps30_device):
+    if sps30_device:
+        shdlc = pmmonitor.SHDLC(device=sps30_device)
+    else:
+        shdlc = pmmonitor.SHDLC(port=SimulatedSPS30(seed=0))
+    yield pmmonitor.SensirionSPS30(shdlc)
+    shdlc.close_serial_port()
@@ -0,0 +1,206 @@
+"""
+Test suite for adaptive sampling, against the simulated SPS30
+"""
+
+import pytest
+
+import adaptive
+import metrics
+import pmmonitor
+from simulator import SimulatedSPS30
+
+PM25, PM10 = adaptive.PM_FIELDS
+INTERVALS = {'fast': 5, 'normal': 60, 'sparse': 600}
+
+
+class FakeClock:
+    """ monotonic clock and stop event stand-in, waiting advances the clock """
+
+    def __init__(self, stop_at):
+        self.now = 0.0
+        self.stop_at = stop_at
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def is_set(self):
+        return self.now >= self.stop_at
+
+    def wait(self, timeout):
+        self.now += max(timeout, 0)
+        self.waits.append(timeout)
+
+
+class StandInSensor:
+    """ sensor driver stand-in returning the values of a function of time """
+
+    name = 'stand-in'
+    measurement = 'SPS30'
+    interval = 60
+    warm_up = 10
+
+    def __init__(self, clock, values):
+        self.clock = clock
+        self.values = values
+        self.tags = {}
+        self.calls = []
+        self.failing_starts = 0
+
+    def start(self):
+        self.calls.append(('start', self.clock()))
+        if self.failing_starts and len(self.calls) > 1:
+            self.failing_starts -= 1
+            raise OSError('no response')
+
+    def read(self):
+        value = self.values(self.clock())
+        return {PM25: value, PM10: value}
+
+    def stop(self):
+        self.calls.append(('stop', self.clock()))
+
+    def close(self):
+        pass
+
+
+def feed(policy, values, interval=None):
+    modes = []
+    seconds = policy.readings[-1][0] + policy.interval if policy.readings else 0
+    for value in values:
+        modes.append(policy.update({PM25: value, PM10: value + 1.0}, seconds))
+        seconds += interval or policy.interval
+    return modes
+
+
+def test_stable_readings_back_off():
+    """ tests """
+    policy = adaptive.AdaptivePolicy(INTERVALS, calm_samples=3)
+    assert feed(policy, [5.0] * 7) == ['normal'] * 2 + ['sparse'] * 5
+    assert policy.interval == 600
+
+
+def test_rate_of_change_speeds_up():
+    """ tests """
+    policy = adaptive.AdaptivePolicy(INTERVALS, calm_samples=3)
+    policy.mode = 'sparse'
+    # 10 ug/m3 within the sparse interval of 10 minutes is 1 per minute
+    assert feed(policy, [5.0, 15.0]) == ['sparse', 'sparse']
+    # smoke, 60 ug/m3 in 10 minutes
+    assert feed(policy, [75.0]) == ['fast']
+    # keeps rising, then settles, the window of 5 minutes forgets the rise
+    modes = feed(policy, [95.0, 115.0] + [115.0] * 80)
+    assert modes[:60] == ['fast'] * 60
+    assert modes[-1] == 'sparse'
+
+
+def test_scatter_speeds_up():
+    """ tests """
+    policy = adaptive.AdaptivePolicy(INTERVALS, stddev=3.0, rate=1000.0)
+    assert feed(policy, [5.0, 15.0, 5.0, 15.0], interval=1)[-1] == 'fast'
+    # missing values neither speed up nor count as calm
+    assert adaptive.AdaptivePolicy(INTERVALS, calm_samples=1).update(
+        {PM25: None, PM10: float('nan')}, 0) == 'normal'
+
+
+def test_duty_cycled_schedule():
+    """ tests """
+    clock = FakeClock(stop_at=3000)
+    sensor = StandInSensor(clock, lambda seconds: 5.0)
+    driver = adaptive.AdaptiveDriver(
+        sensor, adaptive.AdaptivePolicy(INTERVALS, calm_samples=2),
+        min_off=120, clock=clock)
+    driver.start()
+    ticks = []
+    for tick in driver.schedule(clock):
+        ticks.append(tick)
+        driver.read()
+    driver.stop()
+    assert ticks == [0, 60, 660, 1260, 1860, 2460]
+    # the sensor runs in normal mode and is stopped between sparse samples
+    assert sensor.calls == [('start', 0), ('stop', 60), ('start', 650),
+                            ('stop', 660), ('start', 1250),
+                            ('stop', 1260), ('start', 1850),
+                            ('stop', 1860), ('start', 2450),
+                            ('stop', 2460)]
+    assert metrics.SAMPLING_INTERVAL.labels('stand-in').value == 600
+    assert metrics.SENSOR_MEASURING.labels('stand-in').value == 0
+
+
+def test_failed_restart_is_retried():
+    """ tests """
+    clock = FakeClock(stop_at=1300)
+    sensor = StandInSensor(clock, lambda seconds: 5.0)
+    sensor.failing_starts = 2
+    driver = adaptive.AdaptiveDriver(
+        sensor, adaptive.AdaptivePolicy(INTERVALS, calm_samples=2),
+        min_off=120, clock=clock)
+    driver.start()
+    ticks = []
+    for tick in driver.schedule(clock):
+        ticks.append(tick)
+        driver.read()
+    # retried after 5 and 10 seconds, the sample at 660 is taken late
+    assert sensor.calls[2:5] == [('start', 650), ('start', 655),
+                                 ('start', 665)]
+    assert ticks == [0, 60, 660, 1260]
+    assert ('start', 1250) in sensor.calls  # back to the regular schedule
+
+
+def test_schedule_follows_mode():
+    """ tests """
+    clock = FakeClock(stop_at=200)
+    sensor = StandInSensor(clock, lambda seconds: 5.0 if seconds < 60 else 80.0)
+    driver = adaptive.AdaptiveDriver(sensor, adaptive.AdaptivePolicy(INTERVALS),
+                                     clock=clock)
+    changes = metrics.SAMPLING_MODE_CHANGES.labels('stand-in', 'fast').value
+    driver.start()
+    ticks = []
+    for tick in driver.schedule(clock):
+        ticks.append(tick)
+        driver.read()
+    assert ticks[:4] == [0, 60, 65, 70]
+    assert ticks[-1] == 195
+    assert sensor.calls == [('start', 0)]  # never stopped in fast mode
+    assert metrics.SAMPLING_MODE_CHANGES.labels(
+        'stand-in', 'fast').value == changes + 1
+
+
+def test_simulated_sps30_stopped_between_samples():
+    """ tests """
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port))
+    sps30 = pmmonitor.SPS30Driver('SensirionSPS30', pm_sensor=pm_sensor)
+    clock = FakeClock(stop_at=1000)
+    driver = adaptive.make_adaptive(sps30, {'intervals': {'normal': 600},
+                                            'min_off': 60})
+    driver.clock = clock
+    driver.start()
+    assert port.measuring
+    schedule = driver.schedule(clock)
+    next(schedule)
+    assert set(driver.read()) == set(pmmonitor.MEASURED_VALUES_FIELDS)
+    next(schedule)
+    assert port.measuring and clock.now == 600
+    assert clock.waits == [590, 10]  # stopped until the warm-up
+    driver.stop()
+    assert not port.measuring
+    driver.stop()  # stopping twice is no command error
+
+
+def test_make_adaptive():
+    """ tests """
+    cfg = {'SensirionSPS30': {'measurement': 'SensirionSPS30', 'interval': 30,
+                              'adaptive': {'intervals': {'sparse': 300},
+                                           'calm_samples': 2}},
+           'DHT22': {'measurement': 'DHT22'}}
+    drivers = pmmonitor.make_drivers(cfg)
+    assert isinstance(drivers[0], adaptive.AdaptiveDriver)
+    assert drivers[0].policy.intervals == {'fast': 5, 'normal': 30,
+                                           'sparse': 300}
+    assert drivers[0].interval == 30
+    assert drivers[0].name == 'SensirionSPS30 /dev/serial0'
+    with pytest.raises(ValueError):
+        adaptive.make_adaptive(drivers[1], {'threshold': 1})
+    with pytest.raises(ValueError):
+        adaptive.make_adaptive(drivers[1], {'intervals': {'fast': 120}})
@@ -0,0 +1,93 @@
+"""
+Test suite for the sample ring buffer and aggregator.
+"""
+
+import numpy as np
+import pytest
+
+import aggregator
+
+
+def make_samples(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [{'a': float(a), 'b': float(b)}
+            for a, b in rng.normal(10, 2, (count, 2))]
+
+
+@pytest.mark.parametrize('count', [1, 5, 10, 25, 1003])
+def test_ring_statistics(count):
+    """ tests """
+    ring = aggregator.SampleRing(['a', 'b'], capacity=10)
+    samples = make_samples(count)
+    for sample in samples:
+        ring.append(sample)
+    window = np.array([[s['a'], s['b']] for s in samples[-10:]])
+    assert len(ring) == len(window)
+    np.testing.assert_allclose(ring.mean(), window.mean(axis=0))
+    np.testing.assert_allclose(ring.median(), np.median(window, axis=0))
+    np.testing.assert_allclose(ring.min(), window.min(axis=0))
+    np.testing.assert_allclose(ring.max(), window.max(axis=0))
+    if count > 1:
+        np.testing.assert_allclose(ring.stddev(), window.std(axis=0, ddof=1))
+    np.testing.assert_allclose(ring.filled(), window)
+
+
+def test_ring_missing_values():
+    """ tests """
+    ring = aggregator.SampleRing(['a', 'b'], capacity=3)
+    for sample in [{'a': 1.0, 'b': None}, {'a': 3.0}, {'a': 5.0, 'b': None},
+                   {'a': 7.0, 'b': 2.0, 'c': 9.0}]:
+        ring.append(sample)
+    np.testing.assert_allclose(ring.mean(), [5.0, 2.0])
+    np.testing.assert_allclose(ring.max(), [7.0, 2.0])
+    ring.clear()
+    assert len(ring) == 0
+    assert np.isnan(ring.median()).all()
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_aggregator_windows():
+    """ tests """
+    written = []
+    clock = FakeClock()
+    agg = aggregator.Aggregator(written.extend, window=60,
+                                statistics=['mean', 'max'], clock=clock)
+    for second in range(150):
+        clock.now = second
+        agg([{'measurement': 'SPS30', 'time': '', 'fields': {'pm': float(second)}},
+             {'measurement': 'DHT22', 'time': '', 'fields': {'t': 20.0}}])
+    assert len(written) == 4  # two windows for two measurements
+    sps30 = [point['fields'] for point in written
+             if point['measurement'] == 'SPS30']
+    assert sps30[0] == {'pm': 30.0, 'pm_max': 60.0}  # seconds 0 to 60
+    assert sps30[1] == {'pm': 90.5, 'pm_max': 120.0}  # seconds 61 to 120
+    agg.flush()
+    assert len(written) == 6
+    assert written[-2]['fields']['pm'] == 135.0  # seconds 121 to 149
+
+
+def test_aggregator_unknown_statistic():
+    """ tests """
+    with pytest.raises(ValueError):
+        aggregator.Aggregator(print, statistics=['mode'])
+
+
+def test_aggregator_series_per_tags():
+    """ tests """
+    written = []
+    agg = aggregator.Aggregator(written.extend, window=60, clock=FakeClock())
+    agg([{'measurement': 'SPS30', 'time': '', 'tags': {'serial_number': 'A'},
+          'fields': {'pm': 1.0}},
+         {'measurement': 'SPS30', 'time': '', 'tags': {'serial_number': 'B'},
+          'fields': {'pm': 3.0}}])
+    agg.flush()
+    assert sorted((point['tags']['serial_number'], point['fields']['pm'])
+                  for point in written) == [('A', 1.0), ('B', 3.0)]
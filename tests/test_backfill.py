@@ -0,0 +1,194 @@
+"""
+Test suite for the backfill from log and spool files
+"""
+
+import gzip
+import json
+import struct
+
+import pytest
+
+import backfill
+import pmmonitor
+from localstore import LocalStore
+
+SECOND = 10 ** 9
+VALUES = (10.5, 11.0, 11.25, 11.5, 73.5, 84.75, 85.5, 85.5, 85.5, 0.625)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    yield store
+    store.close()
+
+
+def measured_frame(values=VALUES, state=0x00):
+    return pmmonitor.encode_miso_frame(0x03, state, struct.pack('>10f', *values))
+
+
+def log_line(time, frame, style):
+    if style == 'list':
+        text = str([hex(byte) for byte in frame])
+    elif style == 'spaces':
+        text = ' '.join(hex(byte) for byte in frame)
+    else:
+        text = frame.hex()
+    return '2019-11-10 {},000 - INFO - get_response - received MISO frame: ' \
+           '{}\n'.format(time, text)
+
+
+def write_log(path, lines, compress=False):
+    opener = gzip.open if compress else open
+    with opener(path, 'wt') as log_file:
+        log_file.writelines(lines)
+    return str(path)
+
+
+def test_parse_frame():
+    """ tests """
+    frame = measured_frame()
+    for style in ('list', 'spaces', 'hex'):
+        text = log_line('00:00:00', frame, style).split(': ', 1)[1]
+        assert backfill.parse_frame(text.encode()) == frame
+    assert backfill.parse_frame(b'not a frame') is None
+
+
+def test_decode_measurement():
+    """ tests """
+    assert backfill.decode_measurement(measured_frame()) == VALUES
+    assert backfill.decode_measurement(measured_frame(state=0x43)) is None
+    assert backfill.decode_measurement(
+        pmmonitor.encode_miso_frame(0x00)) is None
+    broken = bytearray(measured_frame())
+    broken[10] ^= 0x01
+    assert backfill.decode_measurement(bytes(broken)) is None
+
+
+def test_iter_log_points(tmp_path):
+    """ tests """
+    doubled = tuple(2 * value for value in VALUES)
+    lines = [
+        '2019-11-10 00:00:00,000 - INFO - send_command - sending MOSI frame: '
+        '7e0003003c7e\n',
+        log_line('00:00:01', measured_frame(), 'list'),
+        log_line('00:00:03', measured_frame(doubled), 'spaces'),
+        log_line('00:00:04', measured_frame(state=0x43), 'list'),
+        log_line('00:01:00', measured_frame(), 'hex'),
+    ]
+    paths = [write_log(tmp_path / 'airmonitor.log.1.gz', lines[:3], True),
+             write_log(tmp_path / 'airmonitor.log', lines[3:])]
+    stats = {}
+    points = list(backfill.iter_log_points(paths, 'SensirionSPS30',
+                                           {'serial_number': 'ABC'}, 'UTC',
+                                           stats=stats))
+    assert stats == {'lines': 5, 'frames': 3, 'skipped': 1}
+    assert [point['time'] for point in points] == \
+        [1573344003 * SECOND, 1573344060 * SECOND]
+    assert points[0]['fields']['mass_concentration_PM1_0'] == 1.5 * VALUES[0]
+    assert points[1]['fields']['typical_particle_size'] == VALUES[-1]
+    assert points[0]['tags'] == {'serial_number': 'ABC'}
+
+
+def test_log_points_per_device(tmp_path):
+    """ tests """
+    doubled = tuple(2 * value for value in VALUES)
+    serial_request = pmmonitor.encode_mosi_frame(0xd0, b'\x03').hex()
+    serial_response = pmmonitor.encode_miso_frame(0xd0, 0x00,
+                                                  b'ABC\x00').hex()
+    lines = [
+        '2019-11-10 00:00:00,000 - DEBUG - send_command - sending MOSI frame '
+        'to /dev/ttyUSB0: {}\n'.format(serial_request),
+        '2019-11-10 00:00:00,000 - DEBUG - get_response - received MISO frame '
+        'from /dev/ttyUSB0: {}\n'.format(serial_response),
+    ]
+    for device, values in (('/dev/ttyUSB0', VALUES), ('/dev/serial0', doubled),
+                           ('/dev/ttyUSB0', VALUES), ('/dev/serial0', doubled)):
+        lines.append(log_line('00:00:01', measured_frame(values), 'hex')
+                     .replace('frame:', 'frame from {}:'.format(device)))
+    path = write_log(tmp_path / 'airmonitor.log', lines)
+    points = list(backfill.iter_log_points(
+        [path], 'SensirionSPS30', timezone='UTC',
+        serial_numbers={'/dev/serial0': 'DEF', '/dev/ttyUSB0': 'old'}))
+    assert [(point['tags'], point['fields']['mass_concentration_PM1_0'])
+            for point in points] == [({'serial_number': 'ABC'}, VALUES[0]),
+                                     ({'serial_number': 'DEF'}, doubled[0])]
+
+
+def test_cached_serial_numbers(tmp_path):
+    """ tests """
+    path = str(tmp_path / 'devices.json')
+    cache = backfill.DeviceCache(path)
+    cache.set('/dev/serial0', 'device_information',
+              {'product_name': 'SPS30', 'serial_number': 'ABC'})
+    cache.set('/dev/ttyUSB0', 'auto_cleaning_interval', 604800)
+    assert backfill.cached_serial_numbers(path) == {'/dev/serial0': 'ABC'}
+    assert backfill.cached_serial_numbers(None) == {}
+
+
+def test_log_time_zone(tmp_path):
+    """ tests """
+    path = write_log(tmp_path / 'airmonitor.log',
+                     [log_line('12:00:00', measured_frame(), 'hex')])
+    point, = backfill.iter_log_points([path], 'SPS30', timezone='Europe/Berlin')
+    assert point['time'] == (1573344000 + 11 * 3600) * SECOND
+
+
+def test_backfill_skips_stored_points(store):
+    """ tests """
+    store.write_points([{'measurement': 'SPS30', 'time': 60 * SECOND,
+                         'fields': {'value': 1.0}}])
+    points = [{'measurement': 'SPS30', 'time': seconds * SECOND,
+               'fields': {'value': 2.0}} for seconds in (0, 50, 70, 120)]
+    stats = backfill.backfill(store, iter(points), batch_size=3, tolerance=15)
+    assert stats == {'points': 4, 'duplicates': 2, 'written': 2}
+    assert list(store.query_range('SPS30', 0, 200 * SECOND)['time']) == \
+        [0, 60 * SECOND, 120 * SECOND]
+
+    again = backfill.backfill(store, iter(points), tolerance=15)
+    assert again['written'] == 0
+
+
+def test_spool_points(store, tmp_path):
+    """ tests """
+    batches = [[{'measurement': 'DHT22', 'time': '2019-11-10 00:00:00.000000',
+                 'fields': {'humidity': 50.0}}],
+               [{'measurement': 'DHT22', 'time': '2019-11-10 00:01:00.000000',
+                 'fields': {'humidity': 51.0}}]]
+    path = tmp_path / 'airmonitor_spool.jsonl'
+    path.write_text(''.join(json.dumps(batch) + '\n' for batch in batches)
+                    + '[{"torn')
+    stats = {}
+    backfill.backfill(store, backfill.iter_spool_points([str(path)], stats),
+                      stats=stats)
+    assert stats['written'] == 2
+    assert stats['skipped'] == 1
+    assert list(store.query_range('DHT22', 0, 2 * 10 ** 18)['humidity']) == \
+        [50.0, 51.0]
+
+
+def test_backfill_series_and_policies(store):
+    """ tests """
+    store.write_points([{'measurement': 'DHT22', 'time': 60 * SECOND,
+                         'tags': {'node': 'kitchen'},
+                         'fields': {'humidity': 1.0}}])
+    store.write_points([{'measurement': 'DHT22', 'time': 0,
+                         'fields': {'mean_humidity': 1.0}}],
+                       retention_policy='rollup_1m')
+    points = [{'measurement': 'DHT22', 'time': 60 * SECOND,
+               'tags': {'node': 'kitchen'}, 'fields': {'humidity': 2.0}},
+              {'measurement': 'DHT22', 'time': 60 * SECOND,
+               'tags': {'node': 'bedroom'}, 'fields': {'humidity': 2.0}},
+              {'measurement': 'DHT22', 'time': 0,
+               'fields': {'mean_humidity': 2.0},
+               'retention_policy': 'rollup_1m'},
+              {'measurement': 'DHT22', 'time': 60 * SECOND,
+               'fields': {'mean_humidity': 2.0},
+               'retention_policy': 'rollup_1m'}]
+    stats = backfill.backfill(store, iter(points), tolerance=15)
+    assert stats == {'points': 4, 'duplicates': 2, 'written': 2}
+    assert sorted(store.query_range('DHT22', 0, 200 * SECOND)['node']) == \
+        ['bedroom', 'kitchen']
+    assert list(store.query_range('rollup_1m.DHT22', 0, 200 * SECOND)[
+        'time']) == [0, 60 * SECOND]
+    assert 'mean_humidity' not in store.query_range('DHT22', 0, 200 * SECOND)
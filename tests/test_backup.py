@@ -0,0 +1,127 @@
+"""
+Test suite for the incremental backup, against the embedded SQLite store
+"""
+
+import os
+
+import pytest
+
+import backup
+from localstore import LocalStore
+
+HOUR = 3600 * 10 ** 9
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    yield store
+    store.close()
+
+
+def make_points(start, count, tags=None):
+    points = [{'measurement': 'DHT22', 'time': idx * HOUR,
+               'fields': {'humidity': 50.0 + idx, 'temperature': 20.0}}
+              for idx in range(start, start + count)]
+    if tags:
+        for point in points:
+            point['tags'] = tags
+    return points
+
+
+def test_incremental_backup(store, tmp_path):
+    """ tests """
+    target = str(tmp_path / 'backups')
+    store.write_points(make_points(0, 48))
+    first = backup.run_backup(store, ['DHT22', 'missing'], target,
+                              until=48 * HOUR, overlap_hours=0,
+                              chunk_hours=5)
+    assert first['ranges'] == {'DHT22': [0, 48 * HOUR]}
+    assert first['files'][0]['points'] == 48
+
+    store.write_points(make_points(48, 3, tags={'serial_number': 'ABC'}))
+    second = backup.run_backup(store, ['DHT22'], target, until=51 * HOUR,
+                               overlap_hours=0)
+    assert second['ranges'] == {'DHT22': [48 * HOUR, 51 * HOUR]}
+    assert second['files'][0]['points'] == 3
+    assert second['files'][0]['bytes'] < first['files'][0]['bytes']
+
+    assert backup.run_backup(store, ['DHT22'], target, until=51 * HOUR,
+                             overlap_hours=0) is None
+    assert len(backup.read_manifests(target)) == 2
+
+
+def test_restore(store, tmp_path):
+    """ tests """
+    target = str(tmp_path / 'backups')
+    store.write_points(make_points(0, 10))
+    backup.run_backup(store, ['DHT22'], target, until=10 * HOUR)
+    store.write_points(make_points(10, 5, tags={'serial_number': 'ABC'}))
+    backup.run_backup(store, ['DHT22'], target, until=20 * HOUR)
+
+    restored = LocalStore(str(tmp_path / 'restored.sqlite'))
+    # the point at 9h is exported twice, in the overlap of the second backup
+    assert backup.restore(restored, target, batch_size=4) == 16
+    original = store.query_range('DHT22', 0, 20 * HOUR)
+    copy = restored.query_range('DHT22', 0, 20 * HOUR)
+    assert copy.fillna('').to_dict('records') == \
+        original.fillna('').to_dict('records')
+    restored.close()
+
+
+def test_damaged_backup(store, tmp_path):
+    """ tests """
+    target = str(tmp_path / 'backups')
+    store.write_points(make_points(0, 10))
+    manifest = backup.run_backup(store, ['DHT22'], target, until=10 * HOUR)
+    path = os.path.join(target, manifest['id'], 'DHT22.lp.gz')
+    with open(path, 'ab') as backup_file:
+        backup_file.write(b'\x00')
+    assert backup.verify_backups(target) == [manifest['id'] + '/DHT22.lp.gz']
+    with pytest.raises(ValueError):
+        backup.restore(store, target)
+
+
+def test_interrupted_backup_is_repeated(store, tmp_path):
+    """ tests """
+    target = str(tmp_path / 'backups')
+    store.write_points(make_points(0, 10))
+    manifest = backup.run_backup(store, ['DHT22'], target, until=10 * HOUR)
+    os.remove(os.path.join(target, manifest['id'], backup.MANIFEST))
+    again = backup.run_backup(store, ['DHT22'], target, until=10 * HOUR)
+    assert again['ranges'] == {'DHT22': [0, 10 * HOUR]}
+
+
+def test_late_points_and_rollups(store, tmp_path):
+    """ tests """
+    target = str(tmp_path / 'backups')
+    store.write_points(make_points(0, 10))
+    store.write_points(make_points(0, 3), retention_policy='rollup_1h')
+    first = backup.run_backup(store, ['DHT22'], target, until=10 * HOUR,
+                              policies=[None, 'rollup_1h', 'rollup_1d'])
+    assert first['id'] == '19700101T100000Z'
+    assert first['ranges'] == {'DHT22': [0, 10 * HOUR],
+                               'rollup_1h.DHT22': [0, 10 * HOUR]}
+    assert [entry['retention_policy'] for entry in first['files']] == \
+        [None, 'rollup_1h']
+
+    store.write_points(make_points(9, 2))  # 9h written late, from the spool
+    second = backup.run_backup(store, ['DHT22'], target, until=12 * HOUR)
+    assert second['ranges'] == {'DHT22': [9 * HOUR, 12 * HOUR]}
+    assert second['files'][0]['points'] == 2
+
+    restored = LocalStore(str(tmp_path / 'restored.sqlite'))
+    backup.restore(restored, target)
+    assert len(restored.query_range('DHT22', 0, 20 * HOUR)) == 11
+    assert len(restored.query_range('rollup_1h.DHT22', 0, 20 * HOUR)) == 3
+    restored.close()
+
+
+def test_until_stays_behind_the_writers(store, tmp_path, monkeypatch):
+    """ tests """
+    monkeypatch.setattr(backup.time, 'time_ns', lambda: 10 * HOUR)
+    store.write_points(make_points(0, 10))
+    manifest = backup.run_backup(store, ['DHT22'], str(tmp_path / 'backups'),
+                                 settle=3600)
+    assert manifest['ranges'] == {'DHT22': [0, 9 * HOUR]}
+    assert manifest['files'][0]['points'] == 9
@@ -0,0 +1,273 @@
+"""
+Test suite for the outlier cleaner, using an in-memory stand-in for the
+InfluxDB clients.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cleaner
+
+HOUR = cleaner.NS_PER_HOUR
+DHT22_RULES = cleaner.DEFAULT_RULES['DHT22']
+
+
+class FakeResult:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_points(self):
+        return iter(self.rows)
+
+
+class FakeInfluxDB:
+    """ answers the series and time range queries issued by the cleaner """
+
+    def __init__(self, rows, tag_keys=()):
+        self.rows = sorted(rows, key=lambda row: row['time'])
+        self.tag_keys = tag_keys
+        self.queries = []
+        self.written = []
+
+    def query(self, query, epoch=None):
+        self.queries.append(query)
+        if query.startswith('show series'):
+            keys = sorted({','.join(['DHT22'] + [
+                '{}={}'.format(key, row[key]) for key in self.tag_keys])
+                for row in self.rows})
+            return FakeResult([{'key': key} for key in keys])
+        rows = self.rows
+        for key, value in re.findall(r'"(\w+)" = \'(\w*)\'', query):
+            rows = [row for row in rows if row.get(key, '') == value]
+        for op, value in re.findall(r'time (>=|<) (\d+)', query):
+            value = int(value)
+            if op == '>=':
+                rows = [row for row in rows if row['time'] >= value]
+            else:
+                rows = [row for row in rows if row['time'] < value]
+        if 'desc' in query:
+            rows = rows[::-1]
+        match = re.search(r'limit (\d+)', query)
+        if match:
+            rows = rows[:int(match.group(1))]
+        return FakeResult(rows)
+
+    def write_points(self, dataframe, measurement, tag_columns=None):
+        assert set(tag_columns) == set(self.tag_keys)
+        self.written.append(dataframe)
+
+
+def make_series(humidity):
+    return [{'time': idx * HOUR, 'humidity': value, 'temperature': 20.0 + idx}
+            for idx, value in enumerate(humidity)]
+
+
+def fixed_rows(db):
+    if not db.written:
+        return {}
+    fixed = pd.concat(db.written)
+    return {int(time.value // HOUR): row['humidity']
+            for time, row in fixed.iterrows()}
+
+
+@pytest.mark.parametrize('chunk_hours', [1, 2.5, 4, 100])
+def test_chunked_cleaning(chunk_hours):
+    """ tests """
+    db = FakeInfluxDB(make_series([50, 60, 120, 70, 50, 101, 40, 30]))
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=8 * HOUR, chunk_hours=chunk_hours)
+    assert count == 2
+    assert fixed_rows(db) == {2: 65.0, 5: 45.0}
+    assert len([q for q in db.queries if 'time < ' in q]) >= 8 / chunk_hours
+
+
+def test_outlier_at_chunk_boundary():
+    """ tests """
+    db = FakeInfluxDB(make_series([50, 60, 70, 120, 80, 60]))
+    cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                           until=6 * HOUR, chunk_hours=4)
+    assert fixed_rows(db) == {3: 75.0}
+
+
+def test_high_water_mark(tmp_path):
+    """ tests """
+    state_path = str(tmp_path / 'state.json')
+    db = FakeInfluxDB(make_series([50, 60, 70, 130]))
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=4 * HOUR, state_path=state_path)
+    assert count == 0  # last row waits for a valid right neighbour
+    assert cleaner.read_state(state_path) == {'DHT22': 3 * HOUR}
+
+    db.rows.extend(make_series([0, 0, 0, 0, 90, 120, 100])[4:])
+    db.queries = []
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=7 * HOUR, state_path=state_path)
+    assert count == 2
+    assert fixed_rows(db) == {3: 80.0, 5: 95.0}
+    assert all('time >= 0 ' not in query for query in db.queries)
+    assert cleaner.read_state(state_path) == {'DHT22': 6 * HOUR + 1}
+
+
+def test_since_until_window():
+    """ tests """
+    db = FakeInfluxDB(make_series([50, 120, 60, 70, 130, 80, 110, 40]))
+    cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                           since=3 * HOUR, until=5 * HOUR)
+    assert fixed_rows(db) == {4: 75.0}
+
+
+def test_to_ns():
+    """ tests """
+    assert cleaner.to_ns('1970-01-01T01:00:00Z') == HOUR
+    assert cleaner.to_ns('1970-01-01 01:00') == HOUR
+    assert cleaner.to_ns(None) is None
+
+
+def make_frame(values, seconds=None):
+    if seconds is None:
+        seconds = range(len(values))
+    index = pd.to_datetime([10 ** 9 * sec for sec in seconds], utc=True)
+    return pd.DataFrame({'value': values, 'other': [1.0] * len(values)},
+                        index=index)
+
+
+@pytest.mark.parametrize('values, rule, flagged', [
+    ([5, -1, 5, 200, 5], {'min': 0, 'max': 100}, [1, 3]),
+    ([5, 5, 5, 50, 5, 6, 5], {'spike': {'window': 5, 'threshold': 3}}, [3]),
+    ([5, 5, 5, 5.1, 5, 5], {'spike': {'window': 5, 'min_deviation': 1}}, []),
+    ([5, 6, 40, 7, 8], {'max_rate': 10}, [2]),
+    ([5, 6, 40, 41, 42], {'max_rate': 10}, []),  # step, not a spike
+])
+def test_detect_outliers(values, rule, flagged):
+    """ tests """
+    bad = cleaner.detect_outliers(make_frame(values), {'value': rule})
+    assert list(bad['value'].to_numpy().nonzero()[0]) == flagged
+    assert not bad['other'].any()
+
+
+def test_detect_outliers_also_repair():
+    """ tests """
+    rules = {'value': {'max': 100, 'also_repair': ['other']}}
+    bad = cleaner.detect_outliers(make_frame([5, 101, 5]), rules)
+    assert list(bad['other']) == [False, True, False]
+
+
+@pytest.mark.parametrize('values, seconds, repaired', [
+    ([10, 200, 200, 40], [0, 1, 2, 3], [10, 20, 30, 40]),  # run of outliers
+    ([10, 200, 40], [0, 1, 4], [10, 17.5, 40]),  # time weighted
+    ([200, 10, 20], [0, 1, 2], [10, 10, 20]),  # first row
+    ([10, 20, 200], [0, 1, 2], [10, 20, 20]),  # last row
+])
+def test_repair_outliers(values, seconds, repaired):
+    """ tests """
+    frame = make_frame(values, seconds)
+    bad = cleaner.detect_outliers(frame, {'value': {'max': 100}})
+    result = cleaner.repair_outliers(frame, bad)
+    assert list(result['value']) == repaired
+
+
+def test_chunking_does_not_change_result():
+    """ tests """
+    rng = np.random.default_rng(1)
+    values = 50 + rng.normal(0, 1, 300)
+    values[[20, 21, 22, 100, 101, 250]] = [300, 310, 320, 400, -50, 500]
+    rules = {'humidity': {'min': 0, 'max': 100,
+                          'spike': {'window': 9, 'threshold': 6},
+                          'max_rate': 0.01}}
+    results = []
+    for chunk_hours in (7, 50, 1000):
+        db = FakeInfluxDB(make_series(list(values)))
+        cleaner.clean_outliers(db, db, 'DHT22', rules, until=300 * HOUR,
+                               chunk_hours=chunk_hours)
+        results.append(fixed_rows(db))
+    assert results[0] == results[1] == results[2]
+    assert {20, 21, 22, 100, 101, 250} <= set(results[0])
+
+
+def test_clean_outliers_local_store(tmp_path):
+    """ tests """
+    store = cleaner.LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    humidity = [50.0, 51.0, 150.0, 52.0, 53.0]
+    store.write_points([{'measurement': 'DHT22', 'time': row['time'],
+                         'fields': {'humidity': row['humidity'],
+                                    'temperature': row['temperature']}}
+                        for row in make_series(humidity)])
+    fixed = cleaner.clean_outliers(store, store, 'DHT22',
+                                   cleaner.DEFAULT_RULES['DHT22'],
+                                   until=len(humidity) * HOUR)
+    assert fixed == 1
+    rows = store.query_range('DHT22', 0, len(humidity) * HOUR)
+    assert rows['humidity'].tolist() == [50.0, 51.0, 51.5, 52.0, 53.0]
+
+
+def test_series_cleaned_separately(tmp_path):
+    """ tests """
+    state_path = str(tmp_path / 'state.json')
+    kitchen = make_series([50, 60, 120, 70, 50])
+    bedroom = make_series([90, 91, 92, 93, 94])  # valid, but far off
+    rows = [dict(row, node='kitchen') for row in kitchen] + \
+        [dict(row, node='bedroom') for row in bedroom]
+    db = FakeInfluxDB(rows, tag_keys=('node',))
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=5 * HOUR, state_path=state_path)
+    assert count == 1
+    assert fixed_rows(db) == {2: 65.0}
+    assert list(db.written[0]['node']) == ['kitchen']
+    assert cleaner.read_state(state_path) == {
+        'DHT22,node=bedroom': 4 * HOUR + 1, 'DHT22,node=kitchen': 4 * HOUR + 1}
+
+
+def test_parse_series_key():
+    """ tests """
+    assert cleaner.parse_series_key('DHT22') == {}
+    assert cleaner.parse_series_key(
+        r'DHT22,node=living\ room,serial_number=a\,b') == {
+        'node': 'living room', 'serial_number': 'a,b'}
+
+
+def test_tagged_local_store(tmp_path):
+    """ tests """
+    store = cleaner.LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    for node, humidity in (('kitchen', [50.0, 51.0, 150.0, 52.0, 53.0]),
+                           ('bedroom', [90.0, 91.0, 92.0, 93.0, 94.0])):
+        store.write_points([{'measurement': 'DHT22', 'time': row['time'],
+                             'tags': {'node': node},
+                             'fields': {'humidity': row['humidity'],
+                                        'temperature': row['temperature']}}
+                            for row in make_series(humidity)])
+    assert cleaner.clean_outliers(store, store, 'DHT22', DHT22_RULES,
+                                  until=5 * HOUR) == 1
+    rows = store.query_range('DHT22', 0, 5 * HOUR, tags={'node': 'kitchen'})
+    assert rows['humidity'].tolist() == [50.0, 51.0, 51.5, 52.0, 53.0]
+    assert len(store.query_range('DHT22', 0, 5 * HOUR)) == 10  # no copies
+
+
+def test_rows_after_until_are_context(tmp_path):
+    """ tests """
+    state_path = str(tmp_path / 'state.json')
+    db = FakeInfluxDB(make_series([50, 60, 70, 80, 200, 90]))
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=4 * HOUR, state_path=state_path)
+    assert count == 0
+    assert cleaner.read_state(state_path) == {'DHT22': 4 * HOUR}
+    count = cleaner.clean_outliers(db, db, 'DHT22', DHT22_RULES,
+                                   until=6 * HOUR, state_path=state_path)
+    assert count == 1
+    assert fixed_rows(db) == {4: 85.0}
+
+
+@pytest.mark.parametrize('humidity, rules, fixed', [
+    ([120, 50, 55, 60, 65], {'humidity': {'max': 100}}, {0: 50.0}),
+    ([50, 90, 50, 55, 60], {'humidity': {'max_rate': 0.005}}, {1: 50.0}),
+])
+def test_leading_outlier_independent_of_chunks(humidity, rules, fixed):
+    """ tests """
+    for chunk_hours in (1, 100):
+        db = FakeInfluxDB(make_series(humidity))
+        cleaner.clean_outliers(db, db, 'DHT22', rules, until=5 * HOUR,
+                               chunk_hours=chunk_hours)
+        assert fixed_rows(db) == fixed
@@ -0,0 +1,231 @@
+"""
+Test suite for the collector gateway and the client pushing to it, with a
+local HTTP server as stand-in for the InfluxDB write endpoint.
+"""
+
+import asyncio
+import gzip
+import http.server
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import collector
+import lineprotocol
+from localstore import LocalStore
+
+
+class WriteStandIn(http.server.BaseHTTPRequestHandler):
+    """ records the decompressed bodies of /write requests """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.bodies.append(body.decode())
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Gateway(threading.Thread):
+    """ collector serving on free local ports in its own event loop """
+
+    def __init__(self, gateway):
+        super().__init__(daemon=True)
+        self.collector = gateway
+        self.ready = threading.Event()
+        self.ports = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        await collector.serve(self.collector, '127.0.0.1', 0, 0,
+                              self.stop_event, self.started)
+
+    def started(self, http_port, udp_port):
+        self.ports = (http_port, udp_port)
+        self.ready.set()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+        self.join()
+        self.collector.close()
+
+
+@pytest.fixture
+def backend():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WriteStandIn)
+    server.bodies = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def gateway(backend):
+    gateway = Gateway(collector.Collector(
+        lambda: lineprotocol.LineProtocolClient(
+            '127.0.0.1', backend.server_port, database='airmonitor'),
+        batch_size=1000, flush_interval=0.05, pool_size=2))
+    gateway.start()
+    assert gateway.ready.wait(5)
+    yield gateway
+    gateway.close()
+
+
+def make_points(count, start=0):
+    return [{'measurement': 'DHT22', 'time': idx * 10 ** 9,
+             'fields': {'humidity': 50.0 + idx, 'temperature': 20.5}}
+            for idx in range(start, start + count)]
+
+
+def written_lines(backend, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        lines = [line for body in backend.bodies for line in body.split('\n')]
+        if len(lines) >= count:
+            return lines
+        time.sleep(0.01)
+    return lines
+
+
+def test_frame_batch():
+    """ tests """
+    payload = lineprotocol.frame_batch(b'a v=1 1\nb v=2 2', 'pi 1', '42', 7,
+                                       'rollup_1h')
+    assert lineprotocol.parse_batch(gzip.compress(payload)) == (
+        'pi 1', '42', 7, 'rollup_1h', b'a v=1 1\nb v=2 2')
+    with pytest.raises(ValueError):
+        lineprotocol.parse_batch(b'a v=1 1')
+    with pytest.raises(ValueError):
+        lineprotocol.parse_batch(gzip.compress(payload)[:-4])
+
+
+def test_sequence_tracker():
+    """ tests """
+    tracker = collector.SequenceTracker(window=10)
+    assert [tracker.accept('a', seq) for seq in (1, 3, 2, 3, 1)] == \
+        [True, True, True, False, False]
+    assert tracker.accept('b', 1)  # streams are independent
+    assert tracker.accept('a', 30)
+    assert not tracker.accept('a', 20)  # beyond the window
+    assert tracker.accept('a', 25)
+    assert tracker.streams['a'][1] == {25, 30}  # bounded by the window
+    tracker.expire(0, now=time.monotonic() + 1)
+    assert tracker.streams == {}
+
+
+def test_push_over_http(gateway, backend):
+    """ tests """
+    clients = [lineprotocol.CollectorClient('127.0.0.1', gateway.ports[0],
+                                            node=node)
+               for node in ('kitchen', 'bedroom')]
+    for start in range(0, 100, 10):
+        for client in clients:
+            client.write_points(make_points(10, start))
+    lines = written_lines(backend, 200)
+    assert len(lines) == 200
+    assert len(backend.bodies) < 20  # merged, not one write per push
+    points = [lineprotocol.parse_line(line) for line in lines]
+    assert sorted(point['tags']['node'] for point in points) == \
+        ['bedroom'] * 100 + ['kitchen'] * 100
+    for client in clients:
+        client.close()
+
+
+def test_push_over_udp(gateway, backend):
+    """ tests """
+    client = lineprotocol.CollectorClient('127.0.0.1', gateway.ports[1],
+                                          node='kitchen', transport='udp',
+                                          max_datagram=300)
+    client.write_points(make_points(40))
+    assert client.seq > 1  # split to fit the datagrams
+    lines = written_lines(backend, 40)
+    assert sorted(lineprotocol.parse_line(line)['time'] for line in lines) == \
+        [point['time'] for point in make_points(40)]
+    client.close()
+
+
+def test_retry_is_not_written_twice(gateway, backend):
+    """ tests """
+    client = lineprotocol.CollectorClient('127.0.0.1', gateway.ports[0],
+                                          node='kitchen')
+    gateway.collector.max_backlog = 0
+    with pytest.raises(lineprotocol.ServerError):  # 503, overloaded
+        client.write_points(make_points(5))
+    gateway.collector.max_backlog = 1000
+    client.write_points(make_points(5))  # repeated with the same seq
+    body = client.encoder.encode(make_points(5))
+    payload = lineprotocol.frame_batch(body, 'kitchen', client.session, 1)
+    assert gateway.collector.push(payload) == 'duplicate'
+    assert len(written_lines(backend, 5)) == 5
+    time.sleep(0.2)
+    assert len(written_lines(backend, 5)) == 5
+    client.close()
+
+
+class FlakyClient:
+    """ database client failing the first writes """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.bodies = []
+
+    def write(self, body, retention_policy=None):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('database down')
+        self.bodies.append((retention_policy, body.decode()))
+
+    def close(self):
+        pass
+
+
+def test_database_down_requeues():
+    """ tests """
+    client = FlakyClient(failures=1)
+    gateway = collector.Collector(lambda: client, batch_size=3, pool_size=1)
+    for seq, policy in ((1, None), (2, 'rollup_1h')):
+        body = '\n'.join('m v={} {}'.format(idx, idx) for idx in range(4))
+        assert gateway.push(gzip.compress(lineprotocol.frame_batch(
+            body.encode(), 'kitchen', 's', seq, policy))) == 'accepted'
+    assert asyncio.run(gateway.flush()) is False
+    assert gateway.backlog == 3  # the first write failed
+    assert asyncio.run(gateway.flush()) is True
+    assert gateway.backlog == 0
+    assert sorted(line for _, body in client.bodies
+                  for line in body.split('\n')) == sorted(
+        ['m v={} {}'.format(idx, idx) for idx in range(4)] * 2)
+    assert gateway.push(b'garbage') == 'invalid'
+    gateway.close()
+
+
+def test_sqlite_locked_requeues(tmp_path):
+    """ tests """
+    store = LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    write_points = store.write_points
+    locked = [True]
+
+    def locked_write_points(points, **kwargs):
+        if locked.pop() if locked else False:
+            raise sqlite3.OperationalError('database is locked')
+        return write_points(points, **kwargs)
+
+    store.write_points = locked_write_points
+    gateway = collector.Collector(lambda: store, pool_size=1)
+    assert gateway.push(lineprotocol.frame_batch(
+        b'DHT22 humidity=50.0 1000000000', 'kitchen', 's', 1)) == 'accepted'
+    assert asyncio.run(gateway.flush()) is False
+    assert asyncio.run(gateway.flush()) is True
+    assert list(store.query_range('DHT22', 0, 10 ** 10)['humidity']) == [50.0]
+    gateway.close()
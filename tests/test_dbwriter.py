@@ -0,0 +1,214 @@
+"""
+Test suite for the batched database writer, using a local HTTP server as
+stand-in for the InfluxDB write endpoint.
+"""
+
+import http.server
+import socket
+import sqlite3
+import threading
+
+import pytest
+from influxdb import InfluxDBClient
+
+import dbwriter
+import lineprotocol
+from localstore import LocalStore
+
+
+class InfluxDBStandIn(http.server.BaseHTTPRequestHandler):
+    """ accepts /write requests and records the line protocol bodies """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.bodies.append(body.decode())
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port=0):
+    server = http.server.HTTPServer(('127.0.0.1', port), InfluxDBStandIn)
+    server.bodies = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_points(count, start=0):
+    return [{'measurement': 'DHT22',
+             'time': '2019-11-17 23:25:{:02d}.000000'.format(idx % 60),
+             'fields': {'humidity': float(idx)}}
+            for idx in range(start, start + count)]
+
+
+@pytest.fixture
+def server():
+    server = start_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_flush_by_size(server):
+    """ tests """
+    client = InfluxDBClient('127.0.0.1', server.server_port, database='test')
+    writer = dbwriter.BatchWriter(client, batch_size=10, flush_interval=60)
+    writer.start()
+    for idx in range(10):
+        writer.write(make_points(1, idx))
+    writer.close()
+    assert len(server.bodies) == 1
+    assert len(server.bodies[0].splitlines()) == 10  # one request
+
+
+def test_flush_by_age(server):
+    """ tests """
+    client = InfluxDBClient('127.0.0.1', server.server_port, database='test')
+    writer = dbwriter.BatchWriter(client, batch_size=100, flush_interval=0.1)
+    writer.start()
+    writer.write(make_points(3))
+    for _ in range(50):
+        if server.bodies:
+            break
+        threading.Event().wait(0.05)
+    assert len(server.bodies) == 1
+    writer.close()
+
+
+def test_spool_and_replay(tmp_path):
+    """ tests """
+    port = free_port()
+    spool_path = str(tmp_path / 'spool.jsonl')
+    client = InfluxDBClient('127.0.0.1', port, database='test', timeout=1)
+    writer = dbwriter.BatchWriter(client, batch_size=100, flush_interval=60,
+                                  spool_path=spool_path)
+    writer.write(make_points(5))
+    assert writer.flush() is False  # database down, batch spooled
+    writer.write(make_points(5, 5))
+    assert writer.flush() is False
+    assert writer.spool.backlog() == 2
+
+    server = start_server(port)
+    try:
+        writer.write(make_points(1, 10))
+        assert writer.flush() is True
+        assert writer.spool.backlog() == 0
+        assert len(server.bodies) == 3  # new batch + 2 spooled batches
+        assert sum([len(body.splitlines()) for body in server.bodies]) == 11
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_spool_replace(tmp_path):
+    """ tests """
+    spool = dbwriter.Spool(str(tmp_path / 'spool.jsonl'))
+    spool.append(make_points(2))
+    spool.append(make_points(3))
+    batches = spool.read()
+    assert [len(points) for points in batches] == [2, 3]
+    spool.replace(batches[1:])
+    assert [len(points) for points in spool.read()] == [3]
+    spool.replace([])
+    assert spool.read() == []
+
+
+def test_group_by_policy():
+    """ tests """
+    points = make_points(3)
+    points[1]['retention_policy'] = 'rollup_1m'
+    groups = dbwriter.group_by_policy(points)
+    assert [(policy, len(group)) for policy, group in groups] == [
+        (None, 2), ('rollup_1m', 1)]
+
+
+class LockedStore(LocalStore):
+    """ LocalStore locked by another writer for the first writes """
+
+    def __init__(self, path, locked):
+        super().__init__(path)
+        self.locked = locked
+
+    def write_points(self, points, **kwargs):
+        if self.locked:
+            self.locked -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return super().write_points(points, **kwargs)
+
+
+def test_client_errors():
+    """ tests """
+    retry_errors, rejected_errors = dbwriter.client_errors(
+        lineprotocol.LineProtocolClient())
+    assert ConnectionError in retry_errors
+    assert lineprotocol.ClientError in rejected_errors
+    assert sqlite3.OperationalError not in retry_errors
+    retry_errors, rejected_errors = dbwriter.client_errors(
+        InfluxDBClient(database='test'))
+    assert any(error.__module__.startswith('requests')
+               for error in retry_errors)
+
+
+def test_sqlite_locked_is_retried(tmp_path):
+    """ tests """
+    store = LockedStore(str(tmp_path / 'airmonitor.sqlite'), locked=1)
+    assert sqlite3.OperationalError in dbwriter.client_errors(store)[0]
+    writer = dbwriter.BatchWriter(store, batch_size=100, flush_interval=60,
+                                  spool_path=str(tmp_path / 'spool.jsonl'))
+    points = [{'measurement': 'DHT22', 'time': idx * 10 ** 9,
+               'fields': {'humidity': float(idx)}} for idx in range(3)]
+    writer.start()
+    writer.write(points)
+    assert writer.flush() is False
+    assert writer.thread.is_alive()
+    assert writer.spool.backlog() == 1
+    writer.write(points[:1])
+    assert writer.flush() is True
+    assert len(store.query_range('DHT22', 0, 10 ** 10)) == 3
+    writer.close()
+    store.close()
+
+
+class RecordingClient:
+    """ client stand-in failing like LineEncoder on legacy string times """
+
+    def __init__(self):
+        self.points = []
+
+    def write_points(self, points, **kwargs):
+        for point in points:
+            '{:d}'.format(point['time'])
+        self.points.extend(points)
+
+
+def test_unexpected_error_keeps_writing(tmp_path):
+    """ tests """
+    client = RecordingClient()
+    spool_path = str(tmp_path / 'spool.jsonl')
+    writer = dbwriter.BatchWriter(client, batch_size=3, flush_interval=60,
+                                  spool_path=spool_path)
+    writer.start()
+    writer.write(make_points(3))  # string times, flushed by the thread
+    for _ in range(100):
+        if writer.spool.backlog():
+            break
+        threading.Event().wait(0.01)
+    assert writer.spool.backlog() == 1
+    assert writer.thread.is_alive()
+    good = [{'measurement': 'DHT22', 'time': 10 ** 9,
+             'fields': {'humidity': 50.0}}]
+    writer.write(good)
+    assert writer.flush() is True
+    assert client.points == good
+    # the failing batch does not hold up the spool
+    assert writer.spool.backlog() == 0
+    assert dbwriter.Spool(spool_path + '.failed').read() == [make_points(3)]
+    writer.close()
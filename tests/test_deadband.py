@@ -0,0 +1,81 @@
+"""
+Test suite for the deadband filter
+"""
+
+import pytest
+
+import deadband
+
+SECOND = 10 ** 9
+RULES = {'DHT22': {'humidity': {'absolute': 0.5},
+                   'temperature': {'absolute': 0.2, 'relative': 0.05}}}
+
+
+def make_point(seconds, humidity, temperature=20.0, tags=None):
+    point = {'measurement': 'DHT22', 'time': seconds * SECOND,
+             'fields': {'humidity': humidity, 'temperature': temperature}}
+    if tags:
+        point['tags'] = tags
+    return point
+
+
+def test_deadband():
+    """ tests """
+    written = []
+    band = deadband.Deadband(written.extend, RULES, heartbeat=600)
+    band([make_point(0, 50.0)])  # first point of the series
+    band([make_point(60, 50.4)])  # within the deadband
+    band([make_point(120, 50.6)])  # 0.6 from the last written point
+    band([make_point(180, 50.6, 21.0)])  # 1.0 but not 5 % of 20
+    band([make_point(240, 50.6, 22.0)])  # 2.0 and more than 5 % of 20
+    band([make_point(300, 50.6, None)])  # missing value, nothing to write
+    assert [point['time'] // SECOND for point in written] == [0, 120, 240]
+    assert written[-1]['fields'] == {'humidity': 50.6, 'temperature': 22.0}
+
+
+def test_heartbeat_and_series():
+    """ tests """
+    written = []
+    band = deadband.Deadband(written.extend, RULES, heartbeat=600)
+    for seconds in range(0, 1300, 60):
+        band([make_point(seconds, 50.0, tags={'pin': '4'}),
+              make_point(seconds, 50.0, tags={'pin': '17'})])
+    assert [(point['tags']['pin'], point['time'] // SECOND)
+            for point in written] == [('4', 0), ('17', 0), ('4', 600),
+                                      ('17', 600), ('4', 1200), ('17', 1200)]
+
+
+def test_pass_through():
+    """ tests """
+    written = []
+    band = deadband.Deadband(written.extend, RULES)
+    other = {'measurement': 'SPS30', 'time': 0, 'fields': {'pm': 1.0}}
+    rollup = dict(make_point(0, 50.0), retention_policy='rollup_1h')
+    band([other, other, rollup, rollup])
+    assert written == [other, other, rollup, rollup]
+
+
+def test_state_restored(tmp_path):
+    """ tests """
+    state_path = str(tmp_path / 'deadband.json')
+    written = []
+    band = deadband.Deadband(written.extend, RULES, state_path=state_path)
+    band([make_point(0, 50.0)])
+    band.flush()
+    restarted = deadband.Deadband(written.extend, RULES, state_path=state_path)
+    restarted([make_point(60, 50.1)])
+    restarted([make_point(120, 51.0)])
+    assert [point['time'] // SECOND for point in written] == [0, 120]
+
+
+def test_make_deadband(tmp_path):
+    """ tests """
+    cfg = {'DHT22': {'measurement': 'DHT22'},
+           'deadband': {'heartbeat': 60, 'state': str(tmp_path / 'state.json'),
+                        'DHT22': RULES['DHT22']}}
+    band = deadband.make_deadband(print, cfg)
+    assert band.rules == RULES
+    assert band.heartbeat_ns == 60 * SECOND
+    cfg['deadband']['DHT22']['humidity'] = {'percent': 1}
+    with pytest.raises(ValueError):
+        deadband.make_deadband(print, cfg)
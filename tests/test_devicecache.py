@@ -0,0 +1,54 @@
+"""
+Test suite for the device metadata cache
+"""
+
+import devicecache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_persists(tmp_path):
+    """ tests """
+    path = str(tmp_path / 'devices.json')
+    cache = devicecache.DeviceCache(path)
+    cache.set('/dev/ttyUSB0', 'auto_cleaning_interval', 604800)
+    cache = devicecache.DeviceCache(path)
+    assert cache.get('/dev/ttyUSB0', 'auto_cleaning_interval') == 604800
+    assert cache.get('/dev/ttyUSB1', 'auto_cleaning_interval') is None
+
+
+def test_cache_ttl():
+    """ tests """
+    clock = FakeClock()
+    cache = devicecache.DeviceCache(None, ttl=60, clock=clock)
+    cache.set('/dev/serial0', 'device_information', {'serial_number': 'X'})
+    clock.now += 60
+    assert cache.get('/dev/serial0', 'device_information') == {'serial_number': 'X'}
+    clock.now += 1
+    assert cache.get('/dev/serial0', 'device_information') is None
+
+
+def test_cache_invalidate(tmp_path):
+    """ tests """
+    cache = devicecache.DeviceCache(str(tmp_path / 'devices.json'))
+    cache.set('/dev/serial0', 'a', 1)
+    cache.set('/dev/serial0', 'b', 2)
+    cache.invalidate('/dev/serial0', 'a')
+    assert cache.get('/dev/serial0', 'a') is None
+    assert cache.get('/dev/serial0', 'b') == 2
+    cache.invalidate('/dev/serial0')
+    assert cache.get('/dev/serial0', 'b') is None
+
+
+def test_cache_unreadable(tmp_path):
+    """ tests """
+    path = tmp_path / 'devices.json'
+    path.write_text('{"/dev/serial0": ')
+    assert devicecache.DeviceCache(str(path)).get('/dev/serial0', 'a') is None
@@ -0,0 +1,62 @@
+"""
+Test suite for the import cost of the acquisition modules, measured with
+python -X importtime in a new interpreter
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# imported on use only, by the backends and sensors that need them
+DEFERRED_MODULES = ('pandas', 'numpy', 'influxdb', 'requests', 'yaml',
+                    'serial', 'Adafruit_DHT')
+# cumulative import time of pmmonitor, several times the typical value on a
+# desktop, the full import was over 500 ms
+IMPORT_BUDGET_US = 150000
+
+
+def run_python(code, cwd=ROOT, importtime=False):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    options = ['-X', 'importtime'] if importtime else []
+    return subprocess.run([sys.executable] + options + ['-c', code], cwd=cwd,
+                          env=env, capture_output=True, text=True, check=True)
+
+
+def import_times(module):
+    """
+    :return: dictionary of the cumulative import time in us per module
+    """
+    times = {}
+    stderr = run_python('import ' + module, importtime=True).stderr
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_deferred_imports():
+    """ tests """
+    for module in ('pmmonitor', 'sensors', 'dbwriter', 'localstore',
+                   'metrics', 'devicecache'):
+        imported = import_times(module)
+        assert module in imported
+        assert not [name for name in imported
+                    if name.split('.')[0] in DEFERRED_MODULES], module
+
+
+def test_import_time_budget():
+    """ tests """
+    best = min(import_times('pmmonitor')['pmmonitor'] for _ in range(3))
+    assert best < IMPORT_BUDGET_US
+
+
+def test_import_without_side_effects(tmp_path):
+    """ tests """
+    run_python('import logging, pmmonitor\n'
+               'assert not logging.getLogger("MyLogger").handlers',
+               cwd=str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,123 @@
+"""
+Test suite for the line protocol encoder, parser and client, using a local
+HTTP server as stand-in for the InfluxDB write endpoint.
+"""
+
+import gzip
+import http.server
+import threading
+import urllib.parse
+
+import pytest
+
+import dbwriter
+import lineprotocol
+
+
+class WriteStandIn(http.server.BaseHTTPRequestHandler):
+    """ records the decompressed bodies and parameters of /write requests """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.server.requests.append(
+            (dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query)),
+             body.decode()))
+        status = self.server.statuses.pop(0) if self.server.statuses else 204
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), WriteStandIn)
+    server.requests = []
+    server.statuses = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_points(count):
+    return [{'measurement': 'DHT22', 'time': idx * 10 ** 9,
+             'tags': {'pin': '4'},
+             'fields': {'humidity': 50.0 + idx, 'temperature': 20.5}}
+            for idx in range(count)]
+
+
+def test_encode():
+    """ tests """
+    encoder = lineprotocol.LineEncoder()
+    line = encoder.line('my meas,urement', {'serial number': 'a=b,c', 'a': 1},
+                        {'value': 1.5, 'count': 3, 'ok': True,
+                         'note': 'say "hi", ok', 'missing': None,
+                         'nan': float('nan')}, 42)
+    assert line == ('my\\ meas\\,urement,a=1,serial\\ number=a\\=b\\,c '
+                    'value=1.5,count=3i,ok=true,note="say \\"hi\\", ok" 42')
+    assert encoder.line('DHT22', None, {'humidity': None}, 42) is None
+    assert encoder.encode(make_points(2)) == (
+        b'DHT22,pin=4 humidity=50.0,temperature=20.5 0\n'
+        b'DHT22,pin=4 humidity=51.0,temperature=20.5 1000000000')
+    assert len(encoder.series) == 2  # one escaped key per series
+
+
+def test_parse_line():
+    """ tests """
+    encoder = lineprotocol.LineEncoder()
+    point = {'measurement': 'my meas,urement',
+             'tags': {'serial number': 'a=b,c'},
+             'fields': {'value': 1.5, 'count': 3, 'ok': True,
+                        'note': 'say "hi", ok'},
+             'time': 42}
+    line = encoder.line(point['measurement'], point['tags'], point['fields'],
+                        point['time'])
+    assert lineprotocol.parse_line(line + '\n') == point
+
+
+def test_client_write(server):
+    """ tests """
+    client = lineprotocol.LineProtocolClient('127.0.0.1', server.server_port,
+                                             'user', 'secret', 'airmonitor')
+    client.write_points(make_points(5), batch_size=2,
+                        retention_policy='rollup_1m')
+    assert len(server.requests) == 3
+    params, body = server.requests[0]
+    assert params == {'db': 'airmonitor', 'precision': 'n', 'rp': 'rollup_1m',
+                      'u': 'user', 'p': 'secret'}
+    assert [lineprotocol.parse_line(line)
+            for _, body in server.requests
+            for line in body.split('\n')] == make_points(5)
+    client.close()
+
+
+def test_client_errors(server):
+    """ tests """
+    client = lineprotocol.LineProtocolClient('127.0.0.1', server.server_port,
+                                             database='airmonitor',
+                                             compress=False)
+    server.statuses = [500, 400]
+    with pytest.raises(lineprotocol.ServerError):
+        client.write_points(make_points(1))
+    with pytest.raises(lineprotocol.ClientError):
+        client.write_points(make_points(1))
+    client.write_points(make_points(1))
+    assert len(server.requests) == 3
+
+
+def test_batch_writer_spools_while_down(tmp_path):
+    """ tests """
+    server = http.server.HTTPServer(('127.0.0.1', 0), WriteStandIn)
+    port = server.server_port
+    server.server_close()
+    client = lineprotocol.LineProtocolClient('127.0.0.1', port, timeout=1)
+    writer = dbwriter.BatchWriter(client, batch_size=10, flush_interval=60,
+                                  spool_path=str(tmp_path / 'spool.jsonl'))
+    writer.write(make_points(3))
+    assert writer.flush() is False
+    assert writer.spool.read() == [make_points(3)]
@@ -0,0 +1,91 @@
+"""
+Test suite for the embedded SQLite store
+"""
+
+import pandas as pd
+import pytest
+
+import localstore
+
+HOUR = 3600 * 10 ** 9
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = localstore.LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    yield store
+    store.close()
+
+
+def make_points(count, measurement='DHT22'):
+    return [{'measurement': measurement, 'time': idx * HOUR,
+             'fields': {'humidity': 50.0 + idx, 'temperature': 20.0}}
+            for idx in range(count)]
+
+
+def test_to_ns():
+    """ tests """
+    assert localstore.to_ns('1970-01-01 00:00:01.000001') == 1000001000
+    assert localstore.to_ns('2019-11-08T21:16:45Z') == 1573247805 * 10 ** 9
+    assert localstore.to_ns(42) == 42
+
+
+def test_write_query(store):
+    """ tests """
+    store.write_points(make_points(10))
+    rows = store.query_range('DHT22', 2 * HOUR, 5 * HOUR)
+    assert list(rows['time']) == [2 * HOUR, 3 * HOUR, 4 * HOUR]
+    assert list(rows.columns) == ['time', 'humidity', 'temperature']
+    assert list(store.query_before('DHT22', 5 * HOUR, 2)['humidity']) == [53.0, 54.0]
+    assert list(store.query_first('DHT22', 8 * HOUR, 5)['time']) == [8 * HOUR, 9 * HOUR]
+    assert store.query_range('SensirionSPS30', 0, HOUR).empty
+
+
+def test_upsert_and_new_fields(store):
+    """ tests """
+    store.write_points(make_points(2))
+    store.write_points([{'measurement': 'DHT22', 'time': HOUR,
+                         'fields': {'humidity': 99.0, 'pressure': 1013.0}}])
+    rows = store.query_range('DHT22', 0, 2 * HOUR)
+    assert len(rows) == 2
+    assert rows['humidity'].tolist() == [50.0, 99.0]
+    assert rows['temperature'].tolist() == [20.0, 20.0]
+    assert rows['pressure'].isna().tolist() == [True, False]
+
+
+def test_tags_and_policies(store):
+    """ tests """
+    points = make_points(1, 'SensirionSPS30')
+    points.append(dict(points[0], tags={'serial_number': 'A'}))
+    store.write_points(points)
+    store.write_points(make_points(1), retention_policy='rollup_1h')
+    rows = store.query_range('SensirionSPS30', 0, HOUR)
+    assert len(rows) == 2
+    assert rows['serial_number'].tolist()[1] == 'A'
+    assert len(store.query_range('rollup_1h.DHT22', 0, HOUR)) == 1
+
+
+def test_dataframe_write(store):
+    """ tests """
+    frame = pd.DataFrame({'humidity': [1.0, float('nan')]},
+                         index=pd.to_datetime([0, HOUR], utc=True))
+    store.write_points(make_points(2))
+    store.write_points(frame, 'DHT22')
+    rows = store.query_range('DHT22', 0, 2 * HOUR)
+    assert rows['humidity'].tolist() == [1.0, 51.0]
+
+
+def test_query_aggregate(store):
+    """ tests """
+    store.write_points(make_points(48))
+    days = store.query_aggregate('DHT22', 0, 48 * HOUR, 24 * HOUR)
+    assert days['time'].tolist() == [0, 24 * HOUR]
+    assert days['mean_humidity'].tolist() == [61.5, 85.5]
+    assert days['max_humidity'].tolist() == [73.0, 97.0]
+
+
+def test_delete_before(store):
+    """ tests """
+    store.write_points(make_points(10))
+    assert store.delete_before('DHT22', 4 * HOUR) == 4
+    assert store.query_first('DHT22')['time'].iloc[0] == 4 * HOUR
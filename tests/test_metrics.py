@@ -0,0 +1,61 @@
+"""
+Test suite for the performance metrics
+"""
+
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_render():
+    """ tests """
+    registry = metrics.Registry()
+    errors = metrics.Counter('x_errors_total', 'Errors', ['code'],
+                             registry=registry)
+    backlog = metrics.Gauge('x_backlog', 'Backlog', registry=registry)
+    latency = metrics.Histogram('x_seconds', 'Latency', buckets=(0.1, 1.0),
+                                registry=registry)
+    errors.labels('0x43').inc()
+    errors.labels('0x43').inc()
+    backlog.set(3)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+    lines = registry.render().splitlines()
+    assert '# TYPE x_errors counter' in lines
+    assert 'x_errors_total{code="0x43"} 2' in lines
+    assert 'x_backlog 3' in lines
+    assert 'x_seconds_bucket{le="0.1"} 1' in lines
+    assert 'x_seconds_bucket{le="1.0"} 2' in lines
+    assert 'x_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'x_seconds_count 3' in lines
+    assert registry.fields() == {'x_errors_total_0x43': 2.0,
+                                 'x_backlog': 3.0,
+                                 'x_seconds_sum': 5.55,
+                                 'x_seconds_count': 3.0}
+
+
+def test_labels_mismatch():
+    """ tests """
+    counter = metrics.Counter('y_total', 'Y', ['a', 'b'],
+                              registry=metrics.Registry())
+    with pytest.raises(ValueError):
+        counter.labels('only one')
+
+
+def test_server():
+    """ tests """
+    registry = metrics.Registry()
+    metrics.Gauge('z_value', 'Z', registry=registry).set(1.5)
+    server = metrics.MetricsServer(port=0, registry=registry).start()
+    try:
+        url = 'http://127.0.0.1:{}/metrics'.format(server.port)
+        with urllib.request.urlopen(url, timeout=5) as response:
+            body = response.read().decode('utf-8')
+        assert 'z_value 1.5' in body.splitlines()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url.replace('metrics', 'other'), timeout=5)
+    finally:
+        server.close()
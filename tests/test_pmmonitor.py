@@ -3,10 +3,16 @@ Test suite for particulate matter sensor Sensirion SPS30:
 https://www.sensirion.com/en/environmental-sensors/particulate-matter-sensors-pm25/
 """
 
+import logging
 import pytest
+import queue
+import struct
 import time
 
+from aggregator import Aggregator
+import metrics
 import pmmonitor
+from simulator import SimulatedSPS30
 
 TESTS_BUILD_MOSI_FRAME = [
     ('0x0', ['0x1', '0x3'],
@@ -77,6 +83,162 @@ TESTS_VALIDATE_MISO_STATE = [
 ]
 
 
+START_ACK = bytes.fromhex('7e000000' '00ff7e')
+STOP_ACK = bytes.fromhex('7e000100' '00fe7e')
+
+TESTS_FRAME_READER = [
+    ([START_ACK], [START_ACK]),  # complete frame in one read
+    ([START_ACK[:2], START_ACK[2:5], START_ACK[5:]], [START_ACK]),  # partial reads
+    ([START_ACK + STOP_ACK], [START_ACK, STOP_ACK]),  # two frames in one read
+    ([START_ACK + STOP_ACK[:3], STOP_ACK[3:]], [START_ACK, STOP_ACK]),  # leftover
+    ([b'\x00\xff' + START_ACK], [START_ACK]),  # garbage before frame start
+    ([START_ACK[3:] + STOP_ACK], [STOP_ACK]),  # tail of a missed frame
+]
+
+
+class FakeSerial:
+    """ serial port stand-in returning the given chunks on consecutive reads """
+
+    def __init__(self, chunks, timeout=0.01):
+        self.chunks = list(chunks)
+        self.timeout = timeout
+        self.written = []
+
+    @property
+    def in_waiting(self):
+        return len(self.chunks[0]) if self.chunks else 0
+
+    def read(self, size=1):
+        if not self.chunks:
+            time.sleep(self.timeout)
+            return b''
+        chunk = self.chunks.pop(0)
+        if len(chunk) > size:
+            self.chunks.insert(0, chunk[size:])
+        return chunk[:size]
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+
+@pytest.mark.parametrize('chunks, frames', TESTS_FRAME_READER)
+def test_frame_reader(chunks, frames):
+    """ tests """
+    reader = pmmonitor.FrameReader(FakeSerial(chunks))
+    assert [reader.read_frame() for _ in frames] == frames
+    assert reader.buffer == bytearray()
+
+
+def test_frame_reader_timeout():
+    """ tests """
+    reader = pmmonitor.FrameReader(FakeSerial([START_ACK[:4]]), timeout=0.05)
+    with pytest.raises(pmmonitor.MISOFrameError):
+        reader.read_frame()
+    assert reader.buffer == bytearray()
+
+
+def test_frame_reader_keeps_deadline():
+    """ tests """
+    port = FakeSerial([START_ACK[:4]], timeout=1.5)
+    reader = pmmonitor.FrameReader(port)
+    start = time.monotonic()
+    with pytest.raises(pmmonitor.MISOFrameError):
+        reader.read_frame(timeout=0.1)
+    assert time.monotonic() - start < 0.5  # not the port timeout of 1.5 s
+    assert port.timeout == pmmonitor.READ_POLL_TIMEOUT
+
+
+class CountingTimeoutSerial(FakeSerial):
+    """ counts the timeout changes, each one reconfigures a real port """
+
+    changes = 0
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.changes += 1
+        self._timeout = value
+
+
+def test_frame_reader_sets_timeout_once():
+    """ tests """
+    chunks = [bytes([byte]) for byte in START_ACK * 3]
+    port = CountingTimeoutSerial(chunks, timeout=1.5)
+    reader = pmmonitor.FrameReader(port)
+    assert [reader.read_frame() for _ in range(3)] == [START_ACK] * 3
+    assert port.changes == 2  # the constructor and the first frame
+
+
+def test_shdlc_get_response_returns_on_frame_end():
+    """ tests """
+    port = FakeSerial([START_ACK], timeout=1.5)
+    shdlc = pmmonitor.SHDLC(port=port)
+    shdlc.send_command(0x00, b'\x01\x03')
+    start = time.monotonic()
+    payload = shdlc.get_response()
+    assert time.monotonic() - start < 0.5
+    assert payload == b''
+    assert port.written == [bytes.fromhex('7e0000020103f97e')]
+
+
+# Read Measured Values response from airmonitor.log
+MEASURED_VALUES_FRAME = bytes.fromhex('7e000300284126bada413098db4135176f413719e7'
+                                      '4292cf6042a9aa7442aac5e342aae05e42aae5fc'
+                                      '3f1e2124487e')
+
+
+def make_miso_frame(command, payload, state=0x00):
+    content = bytes((0x00, command, state, len(payload))) + payload
+    content += bytes([pmmonitor.calculate_checksum(content)])
+    return b'\x7e' + pmmonitor.stuff_bytes(content) + b'\x7e'
+
+
+def test_decode_measured_values_float():
+    """ tests """
+    payload = pmmonitor.decode_miso_frame(MEASURED_VALUES_FRAME, 0x03)[1]
+    values = pmmonitor.decode_measured_values(payload)
+    assert values.mass_concentration_PM1_0 == pytest.approx(10.4206, abs=1e-4)
+    assert values.typical_particle_size == pytest.approx(0.6177, abs=1e-4)
+    assert list(values._asdict()) == list(pmmonitor.MEASURED_VALUES_FIELDS)
+
+
+def test_decode_measured_values_integer():
+    """ tests """
+    payload = struct.pack('>10H', 10, 11, 12, 13, 92, 106, 107, 107, 107, 618)
+    values = pmmonitor.decode_measured_values(
+        payload, pmmonitor.OUTPUT_FORMAT_INTEGER)
+    assert values.mass_concentration_PM2_5 == 11
+    assert values.typical_particle_size == pytest.approx(0.618)
+
+
+def test_decode_measured_values_length():
+    """ tests """
+    with pytest.raises(pmmonitor.MISOFrameError):
+        pmmonitor.decode_measured_values(b'\x00' * 20)
+
+
+@pytest.mark.parametrize('output_format', [pmmonitor.OUTPUT_FORMAT_FLOAT,
+                                           pmmonitor.OUTPUT_FORMAT_INTEGER])
+def test_read_measured_values_fake_serial(output_format):
+    """ tests """
+    values_struct = pmmonitor.MEASURED_VALUES_STRUCTS[output_format]
+    payload = values_struct.pack(*range(1, 11))
+    port = FakeSerial([make_miso_frame(0x00, b''),
+                       make_miso_frame(0x03, payload)])
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port),
+                                         output_format=output_format)
+    pm_sensor.start_measurement()
+    values = pm_sensor.read_measured_values()
+    assert port.written[0] == pmmonitor.encode_mosi_frame(
+        0x00, bytes((0x01, output_format)))
+    assert values['mass_concentration_PM1_0'] == 1
+    assert set(values) == set(pmmonitor.MEASURED_VALUES_FIELDS)
+
+
 @pytest.mark.parametrize('command, data, solution', TESTS_BUILD_MOSI_FRAME)
 def test_build_mosi_frame(command, data, solution):
     """ tests """
@@ -84,6 +246,14 @@ def test_build_mosi_frame(command, data, solution):
     assert frame == solution
 
 
+@pytest.mark.parametrize('command, data, solution', TESTS_BUILD_MOSI_FRAME)
+def test_encode_mosi_frame(command, data, solution):
+    """ tests """
+    frame = pmmonitor.encode_mosi_frame(int(command, 16),
+                                        pmmonitor.hex_list_to_bytes(data))
+    assert frame == pmmonitor.hex_list_to_bytes(solution)
+
+
 @pytest.mark.parametrize('frame, unstuffed_frame', TESTS_UNSTUFFING)
 def test_frame_unstuffing(frame, unstuffed_frame):
     """ tests """
@@ -91,11 +261,53 @@ def test_frame_unstuffing(frame, unstuffed_frame):
     assert frame == unstuffed_frame
 
 
+@pytest.mark.parametrize('frame, unstuffed_frame', TESTS_UNSTUFFING)
+def test_unstuff_bytes(frame, unstuffed_frame):
+    """ tests """
+    frame = pmmonitor.unstuff_bytes(pmmonitor.hex_list_to_bytes(frame))
+    assert frame == pmmonitor.hex_list_to_bytes(unstuffed_frame)
+
+
+@pytest.mark.parametrize('content', [b'', b'\x00\x03\x00', b'\x7e\x7d\x11\x13',
+                                     b'\x7d\x5e\x7d\x5d', bytes(range(256))])
+def test_stuff_unstuff_bytes_roundtrip(content):
+    """ tests """
+    stuffed = pmmonitor.stuff_bytes(content)
+    assert not set(stuffed) & {0x7e, 0x11, 0x13}
+    assert pmmonitor.unstuff_bytes(stuffed) == content
+
+
+def test_decode_miso_frame():
+    """ tests """
+    frame = bytes.fromhex('7e000300047d5e7d5d7d317d33' + '00' + '7e')
+    frame = frame[:-2] + bytes([pmmonitor.calculate_checksum(
+        pmmonitor.unstuff_bytes(frame[1:-2]))]) + frame[-1:]
+    state, payload = pmmonitor.decode_miso_frame(frame, 0x03)
+    assert state == 0x00
+    assert payload == b'\x7e\x7d\x11\x13'
+
+
+@pytest.mark.parametrize('resp_frame, last_cmd, err_msg',
+                         TESTS_VALIDATE_MISO_FRAME)
+def test_decode_miso_frame_errors(resp_frame, last_cmd, err_msg):
+    """ tests """
+    with pytest.raises(pmmonitor.MISOFrameError) as excinfo:
+        pmmonitor.decode_miso_frame(pmmonitor.hex_list_to_bytes(resp_frame),
+                                    int(last_cmd, 16))
+    assert excinfo.value.args[0] == err_msg
+
+
+def test_decode_miso_frame_too_short():
+    """ tests """
+    with pytest.raises(pmmonitor.MISOFrameError):
+        pmmonitor.decode_miso_frame(b'', 0x00)
+
+
 @pytest.mark.parametrize('resp_frame, last_cmd, err_msg',
                          TESTS_VALIDATE_MISO_FRAME)
 def test_validate_miso_frame(resp_frame, last_cmd, err_msg):
     """ tests """
-    shdlc = pmmonitor.SHDLC()
+    shdlc = pmmonitor.SHDLC(port=FakeSerial([]))
     shdlc.last_cmd = last_cmd
     with pytest.raises(pmmonitor.MISOFrameError) as excinfo:
         shdlc.validate_miso_frame(resp_frame)
@@ -112,40 +324,36 @@ def test_validate_miso_state(resp_frame, err_msg, err_code):
     assert excinfo.value.args[1] == err_code
 
 
-def test_start_stop_measurement():
+def test_start_stop_measurement(pm_sensor):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     ret_start = pm_sensor.start_measurement()
     ret_stop = pm_sensor.stop_measurement()
-    assert ret_start == []
-    assert ret_stop == []
+    assert ret_start == b''
+    assert ret_stop == b''
 
 
-def test_read_measured_values():
-    pm_sensor = pmmonitor.SensirionSPS30()
+def test_read_measured_values(pm_sensor):
     ret_start = pm_sensor.start_measurement()
     values = pm_sensor.read_measured_values()
     ret_stop = pm_sensor.stop_measurement()
-    assert ret_start == []
+    assert ret_start == b''
     assert set(values.keys()) == set(['mass_concentration_PM1_0', 'mass_concentration_PM2_5',
                                       'mass_concentration_PM4_0', 'mass_concentration_PM10',
                                       'number_concentration_PM0_5', 'number_concentration_PM1_0',
                                       'number_concentration_PM2_5', 'number_concentration_PM4_0',
                                       'number_concentration_PM10','typical_particle_size'])
     assert all([isinstance(val, float) for val in values.values()])
-    assert ret_stop == []
+    assert ret_stop == b''
 
 
-def test_read_auto_cleaning_interval():
+def test_read_auto_cleaning_interval(pm_sensor):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     resp = pm_sensor.read_auto_cleaning_interval()
     assert resp == 604800
 
 
-def test_write_auto_cleaning_interval():
+def test_write_auto_cleaning_interval(pm_sensor):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     ret_read1 = pm_sensor.read_auto_cleaning_interval()
     pm_sensor.write_auto_cleaning_interval(65535)
     ret_read2 = pm_sensor.read_auto_cleaning_interval()
@@ -156,21 +364,19 @@ def test_write_auto_cleaning_interval():
     assert ret_read3 == 604800
 
 
-def test_start_fan_cleaning():
+def test_start_fan_cleaning(pm_sensor, sps30_device):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     ret_start = pm_sensor.start_measurement()
     ret_clean = pm_sensor.start_fan_cleaning()
-    time.sleep(10)
+    time.sleep(10 if sps30_device else 0)
     ret_stop = pm_sensor.stop_measurement()
-    assert ret_start == []
-    assert ret_clean == []
-    assert ret_stop == []
+    assert ret_start == b''
+    assert ret_clean == b''
+    assert ret_stop == b''
 
 
-def test_get_device_information():
+def test_get_device_information(pm_sensor):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     resp = pm_sensor.get_device_information()
     assert set(resp.keys()) == set(['article_code',
                                     'product_name',
@@ -179,9 +385,247 @@ def test_get_device_information():
     assert isinstance(resp['serial_number'], str)
 
 
-def test_device_reset():
+def test_device_reset(pm_sensor):
     """ test """
-    pm_sensor = pmmonitor.SensirionSPS30()
     resp = pm_sensor.device_reset()
-    assert resp == []
+    assert resp == b''
+
+
+def make_simulated_driver(serial_number, latency=0.0):
+    port = SimulatedSPS30(latency=latency, serial_number=serial_number, seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port))
+    driver = pmmonitor.SPS30Driver('SensirionSPS30', pm_sensor=pm_sensor)
+    driver.warm_up = 0
+    return driver
+
+
+def test_make_drivers_devices():
+    """ tests """
+    cfg = {'SensirionSPS30': {'measurement': 'SensirionSPS30',
+                              'devices': ['/dev/ttyUSB0', '/dev/ttyUSB1']},
+           'DHT22': {'measurement': 'DHT22'}}
+    drivers = pmmonitor.make_drivers(cfg)
+    assert [driver.name for driver in drivers] == [
+        'SensirionSPS30 /dev/ttyUSB0', 'SensirionSPS30 /dev/ttyUSB1', 'DHT22']
+    assert drivers[1].device == '/dev/ttyUSB1'
+
+
+def test_sps30_drivers_in_parallel():
+    """ tests """
+    points = []
+    drivers = [make_simulated_driver('SPS30-{}'.format(idx), latency=0.05)
+               for idx in range(4)]
+    start = time.monotonic()
+    pmmonitor.SensorScheduler(drivers, points.extend).run_once()
+    # 6 commands of 0.05 seconds per sensor, 1.2 seconds if serialized
+    assert time.monotonic() - start < 0.6
+    assert sorted(point['tags']['serial_number'] for point in points) == [
+        'SPS30-0', 'SPS30-1', 'SPS30-2', 'SPS30-3']
+    assert all(len(point['fields']) == 10 for point in points)
+
 
+def test_sps30_metadata_cache(tmp_path):
+    """ tests """
+    path = str(tmp_path / 'devices.json')
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port),
+                                         cache=pmmonitor.DeviceCache(path))
+    info = pm_sensor.get_device_information()
+    assert pm_sensor.read_auto_cleaning_interval() == 604800
+    assert port.commands[0xd0] == 3 and port.commands[0x80] == 1
+    # restart with the same cache file
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port),
+                                         cache=pmmonitor.DeviceCache(path))
+    assert pm_sensor.get_device_information() == info
+    assert pm_sensor.read_auto_cleaning_interval() == 604800
+    assert sum(port.commands.values()) == 0
+    pm_sensor.write_auto_cleaning_interval(3600)
+    assert pm_sensor.read_auto_cleaning_interval() == 3600
+    pm_sensor.device_reset()
+    pm_sensor.get_device_information()
+    assert pm_sensor.read_auto_cleaning_interval() == 604800
+    assert port.commands[0xd0] == 3 and port.commands[0x80] == 3
+
+
+def test_read_auto_cleaning_interval_error():
+    """ tests """
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port))
+    port.inject_state(0x28)  # not recoverable
+    assert pm_sensor.read_auto_cleaning_interval() is None
+    assert pm_sensor.read_auto_cleaning_interval() == 604800
+
+
+def test_submit_during_command():
+    """ tests """
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port))
+    with pm_sensor.lock:  # a command in flight
+        start = time.monotonic()
+        future = pm_sensor.submit(pm_sensor.read_auto_cleaning_interval)
+        assert time.monotonic() - start < 0.1
+        assert not future.done()
+    assert future.result(timeout=5) == 604800
+    pm_sensor.close()
+
+
+def test_configure_logging():
+    """ tests """
+    try:
+        pmmonitor.configure_logging({'logging': {'level': 'info',
+                                                 'transport': 'WARNING',
+                                                 'trace': True}})
+        assert pmmonitor.my_logger.level == logging.INFO
+        assert pmmonitor.transport_logger.level == logging.WARNING
+        assert pmmonitor.trace_logger.isEnabledFor(logging.DEBUG)
+        pmmonitor.configure_logging({'logging': {'trace': False}})
+        assert not pmmonitor.trace_logger.isEnabledFor(logging.DEBUG)
+    finally:
+        pmmonitor.configure_logging({'logging': {'level': 'DEBUG',
+                                                 'transport': 'NOTSET'}})
+
+
+def test_deferred_queue_handler():
+    """ tests """
+    log_queue = queue.Queue()
+    handler = pmmonitor.DeferredQueueHandler(log_queue)
+    record = logging.LogRecord('MyLogger', logging.INFO, __file__, 1,
+                               'frame %s', (b'\x7e'.hex(),), None)
+    handler.emit(record)
+    queued = log_queue.get_nowait()
+    assert queued.args == ('7e',)  # formatted by the listener, not here
+    assert queued.getMessage() == 'frame 7e'
+
+
+def test_metrics_driver():
+    """ tests """
+    registry = metrics.Registry()
+    metrics.Gauge('pmmonitor_spool_batches', 'Spool', registry=registry).set(2)
+    driver = pmmonitor.MetricsDriver(registry=registry)
+    assert driver.read() == {'pmmonitor_spool_batches': 2.0}
+
+
+def test_metrics_bypass_aggregation():
+    """ tests """
+    written = []
+    aggregator = Aggregator(written.extend, window=0)
+    output = pmmonitor.bypass_output(aggregator, written.extend, 'pmmonitor')
+    output([{'measurement': 'pmmonitor', 'time': 1, 'fields': {'a': 1.0}}])
+    output([{'measurement': 'pmmonitor', 'time': 2,
+             'fields': {'a': 2.0, 'b': 1.0}},
+            {'measurement': 'DHT22', 'time': 2, 'fields': {'humidity': 50.0}}])
+    assert [point['fields'] for point in written
+            if point['measurement'] == 'pmmonitor'] == [
+        {'a': 1.0}, {'a': 2.0, 'b': 1.0}]
+    assert [point['fields'] for point in written
+            if point['measurement'] == 'DHT22'] == [{'humidity': 50.0}]
+
+
+class DHT22StandIn:
+    """ DHT22 stand-in answering with the given readings, one per call """
+
+    def __init__(self, readings, duration=0.0, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.readings = list(readings)
+        self.duration = duration
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = []  # (start, end) of the reads
+
+    def __call__(self):
+        call = [self.clock(), None]
+        self.calls.append(call)
+        self.sleep(self.duration)
+        call[1] = self.clock()
+        return self.readings.pop(0) if self.readings else (None, None)
+
+
+class FakeClock:
+    """ monotonic clock, sleeping advances it """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_dht22_driver(sensor, budget=1.0, max_age=300):
+    driver = pmmonitor.DHT22Driver('DHT22', budget=budget, max_age=max_age,
+                                   read_function=sensor)
+    driver.min_interval = 0.05
+    return driver
+
+
+def test_dht22_rejects_impossible_values():
+    """ tests """
+    clock = FakeClock()
+    sensor = DHT22StandIn([(None, None), (130.2, 21.0), (45.5, 21.0)],
+                          duration=0.5, clock=clock, sleep=clock.sleep)
+    driver = pmmonitor.DHT22Driver('DHT22', budget=6.0, read_function=sensor,
+                                   clock=clock, sleep=clock.sleep)
+    assert driver.read() == {'humidity': 45.5, 'temperature': 21.0}
+    # the reads keep the min. interval of the sensor between them
+    assert sensor.calls == [[0.0, 0.5], [2.5, 3.0], [5.0, 5.5]]
+    # no time left in the budget for a third read, the last one is served
+    sensor.readings = [(None, None), (None, None), (45.5, 21.0)]
+    clock.now = 10.0
+    driver.budget = 4.5
+    assert driver.read() == {'humidity': 45.5, 'temperature': 21.0, 'age': 7.5}
+    assert len(sensor.calls) == 5
+    driver.close()
+
+
+def test_dht22_budget_and_last_good():
+    """ tests """
+    sensor = DHT22StandIn([(45.5, 21.0)])
+    driver = make_dht22_driver(sensor, budget=0.2)
+    assert driver.read() == {'humidity': 45.5, 'temperature': 21.0}
+    stale = metrics.SAMPLE_STALE.labels('DHT22').value
+    sensor.duration = 1.0  # hanging read
+    start = time.monotonic()
+    fields = driver.read()
+    assert time.monotonic() - start < 0.5
+    assert fields['humidity'] == 45.5 and 0 < fields['age'] < 0.5
+    assert metrics.SAMPLE_STALE.labels('DHT22').value == stale + 1
+    # the hanging read is waited for, not started again
+    driver.read()
+    assert len(sensor.calls) == 2
+    driver.max_age = 0
+    assert driver.read() == {}
+    driver.close()
+
+
+class RecordingDatabase:
+    """ Database stand-in keeping the written points """
+
+    def __init__(self):
+        self.points = []
+
+    def write(self, points):
+        self.points.extend(points)
+
+    def close(self):
+        pass
+
+
+class ConstantSensor(pmmonitor.SensorDriver):
+
+    def read(self):
+        return {'humidity': 50.0}
+
+
+def test_run_once_with_local_rollups(monkeypatch, caplog):
+    """ tests """
+    database = RecordingDatabase()
+    monkeypatch.setattr(pmmonitor, 'open_database', lambda cfg: database)
+    monkeypatch.setattr(pmmonitor, 'make_drivers',
+                        lambda cfg, samples: [ConstantSensor('DHT22')])
+    pmmonitor.run_once({'rollups': {'mode': 'local'}})
+    assert 'no rollups are computed' in caplog.text
+    assert [point['fields'] for point in database.points] == \
+        [{'humidity': 50.0}]  # the raw sample is written all the same
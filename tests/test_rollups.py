@@ -0,0 +1,161 @@
+"""
+Test suite for the rollups
+"""
+
+import numpy as np
+import pytest
+
+import rollups
+from localstore import LocalStore
+
+CFG = {
+    'database': {'name': 'airmonitor'},
+    'SensirionSPS30': {'measurement': 'SensirionSPS30'},
+    'DHT22': {'measurement': 'DHT22'},
+    'rollups': {'mode': 'influxdb',
+                'measurements': ['DHT22'],
+                'intervals': {'1m': '90d', '1h': 'INF'},
+                'raw': {'retention': '30d'}},
+}
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeInfluxDB:
+
+    def __init__(self, policies=('autogen',), queries=()):
+        self.policies = list(policies)
+        self.queries = list(queries)
+        self.calls = []
+
+    def get_list_retention_policies(self, database=None):
+        return [{'name': name} for name in self.policies]
+
+    def create_retention_policy(self, name, duration, replication,
+                                database=None, default=False):
+        self.calls.append(('create_rp', name, duration, default))
+
+    def alter_retention_policy(self, name, database=None, duration=None,
+                               default=None):
+        self.calls.append(('alter_rp', name, duration, default))
+
+    def get_list_continuous_queries(self):
+        return [{'airmonitor': [{'name': name, 'query': ''}
+                                for name in self.queries]}]
+
+    def drop_continuous_query(self, name, database=None):
+        self.calls.append(('drop_cq', name))
+
+    def create_continuous_query(self, name, select, database=None):
+        self.calls.append(('create_cq', name, select))
+
+
+def test_to_seconds():
+    """ tests """
+    assert rollups.to_seconds('1m') == 60
+    assert rollups.to_seconds('2h') == 7200
+    with pytest.raises(ValueError):
+        rollups.to_seconds('1 day')
+
+
+def test_local_rollups(tmp_path):
+    """ tests """
+    state_path = str(tmp_path / 'rollups.json')
+    written = []
+    clock = FakeClock()
+    rollup = rollups.Rollups(written.extend, ['DHT22'], intervals=['1m', '1h'],
+                             statistics=['mean', 'max', 'p95'], clock=clock,
+                             state_path=state_path)
+    for second in range(0, 150, 10):
+        clock.now = second
+        rollup([{'measurement': 'DHT22', 'time': '', 'tags': {'pin': '4'},
+                 'fields': {'t': float(second)}},
+                {'measurement': 'other', 'time': '', 'fields': {'x': 1.0}}])
+    raw = [point for point in written if 'retention_policy' not in point]
+    minutes = [point for point in written if 'retention_policy' in point]
+    assert len(raw) == 30
+    assert [point['fields']['mean_t'] for point in minutes] == [25.0, 85.0]
+    assert minutes[0]['fields']['max_t'] == 50.0
+    assert minutes[0]['fields']['percentile_t'] == pytest.approx(47.5)
+    assert minutes[1]['time'] == 60 * 10 ** 9
+    assert minutes[1]['retention_policy'] == 'rollup_1m'
+    assert minutes[1]['tags'] == {'pin': '4'}
+    clock.now = 180
+    rollup.flush()  # the minute is complete, the hour is kept for a restart
+    assert written[-1]['time'] == 120 * 10 ** 9
+    assert [point for point in written
+            if point.get('retention_policy') == 'rollup_1h'] == []
+
+    written.clear()
+    restarted = rollups.Rollups(written.extend, ['DHT22'],
+                                intervals=['1m', '1h'],
+                                statistics=['mean', 'max', 'p95'],
+                                clock=clock, state_path=state_path)
+    clock.now = 3600
+    restarted([{'measurement': 'DHT22', 'time': '', 'tags': {'pin': '4'},
+                'fields': {'t': 1000.0}}])
+    hours = [point for point in written
+             if point.get('retention_policy') == 'rollup_1h']
+    assert len(hours) == 1
+    assert hours[0]['time'] == 0
+    assert hours[0]['fields']['mean_t'] == 70.0
+    assert hours[0]['fields']['max_t'] == 140.0
+
+
+def test_bucket_statistics_beyond_capacity():
+    """ tests """
+    statistics = rollups.BucketStatistics(['t', 'h'], capacity=100)
+    for value in range(10000):
+        statistics.append({'t': float(value)})
+    assert len(statistics) == 10000
+    assert len(statistics.samples) <= 100
+    assert list(statistics.mean())[0] == 4999.5
+    assert list(statistics.min())[0] == 0.0
+    assert list(statistics.max())[0] == 9999.0
+    # spread over the whole bucket, not only the last samples
+    assert statistics.p95()[0] == pytest.approx(9500, rel=0.02)
+    assert np.isnan(statistics.mean()[1]) and np.isnan(statistics.max()[1])
+
+
+def test_set_up_rollups():
+    """ tests """
+    client = FakeInfluxDB(queries=['cq_DHT22_1m'])
+    rollups.set_up_rollups(client, CFG)
+    assert ('alter_rp', 'autogen', '30d', True) in client.calls
+    assert ('create_rp', 'rollup_1h', 'INF', False) in client.calls
+    assert ('drop_cq', 'cq_DHT22_1m') in client.calls
+    selects = {call[1]: call[2] for call in client.calls
+               if call[0] == 'create_cq'}
+    assert selects['cq_DHT22_1h'] == (
+        'SELECT mean(*), min(*), max(*), percentile(*, 95) INTO '
+        '"airmonitor"."rollup_1h"."DHT22" FROM "airmonitor"."autogen"."DHT22" '
+        'GROUP BY time(1h), *')
+
+
+def test_set_up_rollups_local():
+    """ tests """
+    client = FakeInfluxDB()
+    rollups.set_up_rollups(client, dict(CFG, rollups=dict(CFG['rollups'],
+                                                          mode='local')))
+    assert not [call for call in client.calls if call[0].endswith('_cq')]
+
+
+def test_expire_local(tmp_path):
+    """ tests """
+    store = LocalStore(str(tmp_path / 'airmonitor.sqlite'))
+    day = 86400 * 10 ** 9
+    points = [{'measurement': 'DHT22', 'time': idx * day, 'fields': {'t': 1.0}}
+              for idx in range(100)]
+    store.write_points(points)
+    store.write_points(points, retention_policy='rollup_1m')
+    store.write_points(points, retention_policy='rollup_1h')
+    deleted = rollups.expire_local(store, CFG, now=100 * day)
+    assert deleted == 70 + 10  # raw after 30d, rollup_1m after 90d
+    assert len(store.query_range('rollup_1h.DHT22', 0, 100 * day)) == 100
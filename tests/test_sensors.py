@@ -0,0 +1,153 @@
+"""
+Test suite for the sensor driver abstraction and scheduler.
+"""
+
+import threading
+import time
+
+import pytest
+
+import sensors
+
+
+class FakeClock:
+    """ monotonic clock and stop event stand-in, waiting advances the clock """
+
+    def __init__(self, stop_after):
+        self.now = 100.0
+        self.waits = 0
+        self.stop_after = stop_after
+
+    def __call__(self):
+        return self.now
+
+    def is_set(self):
+        return self.waits >= self.stop_after
+
+    def wait(self, timeout):
+        self.now += max(timeout, 0)
+        self.waits += 1
+
+
+@pytest.mark.parametrize('durations, ticks', [
+    ([0.5, 0.5, 0.5, 0.5], [100.0, 110.0, 120.0, 130.0]),  # no drift
+    ([9.9, 0.1, 0.1], [100.0, 110.0, 120.0]),  # long cycle, no drift either
+    ([25.0, 0.1, 0.1], [100.0, 130.0, 140.0]),  # overrun, skip missed ticks
+])
+def test_fixed_rate_schedule(durations, ticks):
+    """ tests """
+    clock = FakeClock(stop_after=len(durations))
+    result = []
+    for tick, duration in zip(sensors.fixed_rate_schedule(10, clock, clock),
+                              durations):
+        result.append(tick)
+        clock.now += duration  # time spent sampling
+    assert result == ticks
+
+
+class SlowSensor(sensors.SensorDriver):
+    """ sensor stand-in taking duration seconds per reading """
+
+    def __init__(self, name, duration, interval=60):
+        super().__init__(name, interval)
+        self.name = name
+        self.duration = duration
+        self.calls = []
+
+    def start(self):
+        self.calls.append('start')
+
+    def read(self):
+        time.sleep(self.duration)
+        self.calls.append('read')
+        return {'value': self.duration}
+
+    def stop(self):
+        self.calls.append('stop')
+
+
+class FailingSensor(SlowSensor):
+
+    def read(self):
+        raise IOError('sensor not responding')
+
+
+def test_make_point_tags():
+    """ tests """
+    assert 'tags' not in sensors.make_point('a', {'value': 1})
+    point = sensors.make_point('a', {'value': 1}, tags={'serial_number': 'X'})
+    assert point['tags'] == {'serial_number': 'X'}
+
+
+def test_run_once_is_concurrent():
+    """ tests """
+    points = []
+    drivers = [SlowSensor('a', 0.3), SlowSensor('b', 0.3), SlowSensor('c', 0.3)]
+    start = time.monotonic()
+    sensors.SensorScheduler(drivers, points.extend).run_once()
+    assert time.monotonic() - start < 0.6  # slowest sensor, not the sum
+    assert sorted(point['measurement'] for point in points) == ['a', 'b', 'c']
+    assert all('tags' not in point for point in points)
+    assert all(driver.calls == ['start', 'read', 'stop'] for driver in drivers)
+
+
+def test_run_own_cadence():
+    """ tests """
+    points = []
+    lock = threading.Lock()
+
+    def output(new_points):
+        with lock:
+            points.extend(new_points)
+
+    stop = threading.Event()
+    drivers = [SlowSensor('fast', 0, interval=0.05),
+               SlowSensor('slow', 0, interval=0.5),
+               FailingSensor('broken', 0, interval=0.05)]
+    scheduler = sensors.SensorScheduler(drivers, output, stop)
+    threading.Timer(0.4, stop.set).start()
+    scheduler.run()
+    fast = len([point for point in points if point['measurement'] == 'fast'])
+    slow = len([point for point in points if point['measurement'] == 'slow'])
+    assert fast >= 5
+    assert slow == 1
+    assert all(driver.calls[-1] == 'stop' for driver in drivers)
+
+
+class UnpluggedSensor(SlowSensor):
+    """ sensor stand-in failing to start the first times """
+
+    def __init__(self, name, failures, interval=60):
+        super().__init__(name, 0, interval)
+        self.failures = failures
+
+    def start(self):
+        if self.failures:
+            self.failures -= 1
+            self.calls.append('failed start')
+            raise IOError('serial port not found')
+        super().start()
+
+
+def test_poll_retries_start(caplog):
+    """ tests """
+    points = []
+    stop = threading.Event()
+    driver = UnpluggedSensor('late', failures=2, interval=0.05)
+    scheduler = sensors.SensorScheduler([driver], points.extend, stop,
+                                        retry_delay=0.01)
+    threading.Timer(0.3, stop.set).start()
+    scheduler.run()
+    assert driver.calls[:3] == ['failed start', 'failed start', 'start']
+    assert driver.calls[-1] == 'stop'
+    assert points
+    assert 'starting late failed, retry in 0.01 seconds' in caplog.text
+
+
+def test_run_once_start_failure():
+    """ tests """
+    points = []
+    drivers = [UnpluggedSensor('broken', failures=1), SlowSensor('ok', 0)]
+    sensors.SensorScheduler(drivers, points.extend).run_once()
+    assert drivers[0].calls == ['failed start']  # neither read nor stopped
+    assert [point['measurement'] for point in points] == ['ok']
@@ -0,0 +1,164 @@
+"""
+Test suite for the simulated Sensirion SPS30
+"""
+
+import time
+
+import pytest
+
+import metrics
+import pmmonitor
+from simulator import PtyBridge, SimulatedSPS30
+
+
+def make_sensor(timeouts=pmmonitor.COMMAND_TIMEOUTS, **kwargs):
+    port = SimulatedSPS30(seed=0, **kwargs)
+    pm_sensor = pmmonitor.SensirionSPS30(pmmonitor.SHDLC(port=port),
+                                         backoff=0.001, reset_delay=0,
+                                         timeouts=timeouts)
+    return port, pm_sensor
+
+
+def test_read_measured_values():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    pm_sensor.start_measurement()
+    first = pm_sensor.read_measured_record()
+    second = pm_sensor.read_measured_record()
+    assert first != second
+    assert first.mass_concentration_PM2_5 == pytest.approx(11.0, rel=0.5)
+    assert port.commands[0x03] == 2
+
+
+def test_read_measured_values_integer():
+    """ tests """
+    port = SimulatedSPS30(seed=0)
+    pm_sensor = pmmonitor.SensirionSPS30(
+        pmmonitor.SHDLC(port=port),
+        output_format=pmmonitor.OUTPUT_FORMAT_INTEGER)
+    pm_sensor.start_measurement()
+    values = pm_sensor.read_measured_record()
+    assert values.mass_concentration_PM10 == int(values.mass_concentration_PM10)
+    assert values.typical_particle_size == pytest.approx(0.62, rel=0.5)
+
+
+def test_byte_stuffing():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    pm_sensor.write_auto_cleaning_interval(0x7e7d1113)
+    assert pm_sensor.read_auto_cleaning_interval() == 0x7e7d1113
+    assert pm_sensor.device_reset() == b''
+    assert pm_sensor.read_auto_cleaning_interval() == 604800
+
+
+def test_state_errors():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    assert pm_sensor.stop_measurement() is False  # 0x43, not measuring
+    assert pm_sensor.start_measurement() == b''
+    port.inject_state(0x28, count=2)  # not recoverable
+    assert pm_sensor.start_fan_cleaning() is False
+    assert pm_sensor.read_measured_values() == {}
+    assert pm_sensor.start_fan_cleaning() == b''
+    assert pm_sensor.send_receive(0x42, b'') is False  # unknown command
+
+
+def test_recover_running_measurement():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    port.measuring = True  # left running by a previous run
+    assert pm_sensor.start_measurement() == b''
+    assert port.measuring
+    assert port.commands[0x01] == 1 and port.commands[0x00] == 2
+
+
+def test_recover_idle_sensor():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    assert len(pm_sensor.read_measured_values()) == 10
+    assert port.commands[0x00] == 1 and port.commands[0x03] == 2
+
+
+def test_recover_persistent_state_error():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    pm_sensor.start_measurement()
+    port.inject_state(0x43, count=3)  # read, restart, read again
+    assert len(pm_sensor.read_measured_values()) == 10
+    assert port.commands[0xd3] == 1
+    port.inject_state(0x43, count=10)
+    assert pm_sensor.read_measured_values() == {}
+
+
+def test_corruption():
+    """ tests """
+    port, pm_sensor = make_sensor(corruption=1.0)
+    with pytest.raises(pmmonitor.MISOFrameError):
+        pm_sensor.start_measurement()
+    assert port.commands[0x00] == pm_sensor.retries + 1
+
+
+def test_retry_corrupted_frames():
+    """ tests """
+    port, pm_sensor = make_sensor(corruption=0.3)
+    pm_sensor.start_measurement()
+    records = [pm_sensor.read_measured_record() for _ in range(50)]
+    assert all(record is not None for record in records)
+    assert port.commands[0x03] > 50
+
+
+def test_drop():
+    """ tests """
+    port, pm_sensor = make_sensor(drop=1.0, timeout=0.05, timeouts={})
+    pm_sensor.shdlc.reader.timeout = 0.05
+    with pytest.raises(pmmonitor.MISOFrameError):
+        pm_sensor.start_measurement()
+
+
+def test_submit():
+    """ tests """
+    port, pm_sensor = make_sensor(latency=0.01)
+    pm_sensor.start_measurement()
+    futures = [pm_sensor.submit(pm_sensor.read_measured_record)
+               for _ in range(5)]
+    info = pm_sensor.submit(pm_sensor.get_device_information)
+    assert all(future.result(timeout=5) is not None for future in futures)
+    assert info.result(timeout=5)['serial_number'] == 'SIM0123456789ABC'
+    pm_sensor.close()
+    assert not port.is_open
+
+
+def test_latency():
+    """ tests """
+    port, pm_sensor = make_sensor(latency=0.05)
+    start = time.monotonic()
+    pm_sensor.start_measurement()
+    assert 0.05 <= time.monotonic() - start < 1.0
+
+
+def test_pty_bridge():
+    """ tests """
+    bridge = PtyBridge(SimulatedSPS30(seed=0)).start()
+    try:
+        shdlc = pmmonitor.SHDLC(device=bridge.device)
+        pm_sensor = pmmonitor.SensirionSPS30(shdlc)
+        assert pm_sensor.start_measurement() == b''
+        assert len(pm_sensor.read_measured_values()) == 10
+        info = pm_sensor.get_device_information()
+        assert info['serial_number'] == 'SIM0123456789ABC'
+        shdlc.close_serial_port()
+    finally:
+        bridge.close()
+
+
+def test_metrics():
+    """ tests """
+    port, pm_sensor = make_sensor()
+    before = metrics.COMMAND_SECONDS.labels('0x03').samples()[-1][-1]
+    errors = metrics.STATE_ERRORS.labels('0x01', '0x43').samples()[0][-1]
+    pm_sensor.start_measurement()
+    pm_sensor.read_measured_values()
+    pm_sensor.stop_measurement()
+    pm_sensor.stop_measurement()  # 0x43, not measuring
+    assert metrics.COMMAND_SECONDS.labels('0x03').samples()[-1][-1] == before + 1
+    assert metrics.STATE_ERRORS.labels('0x01', '0x43').samples()[0][-1] == errors + 1